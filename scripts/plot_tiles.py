@@ -22,19 +22,22 @@ from __future__ import annotations
 
 import argparse
 import math
+import sys
 from pathlib import Path
 from typing import List, Tuple
 
 from PIL import Image
 
+# A colagem das tiles e a mesma do png_trajeto do backend (geo/tiles.py, sem Django).
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vai_paqueta_backend"))
+from geo.tiles import TILE_SIZE, colar_tiles  # noqa: E402
+
 # BBox padrao: Ilha de Paqueta
 SOUTH = -22.774914
 WEST = -43.133396
 NORTH = -22.741042
 EAST = -43.090621
 
-TILE_SIZE = 256
-
 
 def _deg2num(lat_deg: float, lon_deg: float, zoom: int) -> Tuple[int, int]:
     lat_rad = math.radians(lat_deg)
@@ -82,22 +85,7 @@ def stitch_tiles(
     height = (y_to - y_from + 1) * TILE_SIZE
 
     canvas = Image.new("RGBA", (width, height), (235, 235, 235, 255))
-    missing: List[Path] = []
-
-    for x in range(x_from, x_to + 1):
-        for y in range(y_from, y_to + 1):
-            tile_path = tiles_dir / str(zoom) / str(x) / f"{y}.png"
-            if not tile_path.exists():
-                missing.append(tile_path)
-                continue
-            try:
-                tile = Image.open(tile_path).convert("RGBA")
-            except Exception:
-                missing.append(tile_path)
-                continue
-            dx = (x - x_from) * TILE_SIZE
-            dy = (y - y_from) * TILE_SIZE
-            canvas.paste(tile, (dx, dy))
+    missing = colar_tiles(canvas, tiles_dir, zoom, x_from, x_to, y_from, y_to)
     return canvas, missing
 
 
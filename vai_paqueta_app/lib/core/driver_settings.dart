@@ -27,8 +27,10 @@ class PassengerSettings {
   static const Duration corridaPollIntervalMin = Duration(seconds: 3);
   /// Intervalo máximo do polling (HTTP) quando há backoff.
   static const Duration corridaPollIntervalMax = Duration(seconds: 10);
-  /// Intervalo do polling de motoristas online no mapa.
+  /// Intervalo do polling de motoristas online no mapa (só sem WebSocket; com ele as posições chegam por push).
   static const Duration motoristasOnlinePollingInterval = Duration(seconds: 3);
+  /// Meia largura (graus) da área assinada para motoristas próximos via WebSocket (~5 km).
+  static const double motoristasProximosRaioGraus = 0.045;
   /// Tempo mínimo para liberar cancelamento após corrida aceita.
   static const Duration tempoMinimoCancelamentoAposAceite = Duration(minutes: 2);
   /// Tempo mínimo para liberar finalização após corrida iniciada.
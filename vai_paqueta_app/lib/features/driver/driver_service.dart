@@ -21,16 +21,28 @@ class DriverService {
     });
   }
 
+  // ETag da última resposta de para_motorista (por perfil): o backend responde 304 se nada mudou.
+  static int? _etagPerfilId;
+  static String? _etagCorrida;
+  static Map<String, dynamic>? _ultimaCorrida;
+
   Future<Map<String, dynamic>?> corridaAtribuida(int perfilId) async {
+    final etag = _etagPerfilId == perfilId ? _etagCorrida : null;
     final resp = await _dio.get(
       '/corridas/para_motorista/$perfilId/',
-      options: Options(validateStatus: (_) => true),
+      options: Options(
+        validateStatus: (_) => true,
+        headers: {if (etag != null) 'If-None-Match': etag},
+      ),
     );
+    if (resp.statusCode == 304) return _ultimaCorrida;
     if (resp.statusCode == 404) return null;
     if (resp.statusCode == 200 && resp.data is Map<String, dynamic>) {
       final data = resp.data as Map<String, dynamic>;
-      if (data.isEmpty) return null;
-      return data;
+      _etagPerfilId = perfilId;
+      _etagCorrida = resp.headers.value('etag');
+      _ultimaCorrida = data.isEmpty ? null : data;
+      return _ultimaCorrida;
     }
     return null;
   }
@@ -91,6 +91,7 @@ class _PassengerPageState extends ConsumerState<PassengerPage> with WidgetsBindi
   bool _posCarregada = false;
   int _lugaresSolicitados = 1;
   List<MotoristaProximo> _motoristasOnline = [];
+  bool _nearbyAssinado = false;
   Timer? _motoristasOnlineTimer;
   bool _carregandoMotoristasOnline = false;
   final GeoService _geo = GeoService();
@@ -1479,12 +1480,65 @@ class _PassengerPageState extends ConsumerState<PassengerPage> with WidgetsBindi
   void _iniciarMotoristasOnlinePolling() {
     if (!mounted || !_podeMostrarMotoristasOnline()) return;
     _motoristasOnlineTimer?.cancel();
-    _motoristasOnlineTimer = Timer.periodic(PassengerSettings.motoristasOnlinePollingInterval, (_) => _atualizarMotoristasOnline());
     unawaited(_atualizarMotoristasOnline());
+    if (_wsConnected && _realtime != null) {
+      // Com WebSocket, só a carga inicial vem do REST; depois as posições chegam por push.
+      _assinarMotoristasProximos();
+      return;
+    }
+    _motoristasOnlineTimer = Timer.periodic(PassengerSettings.motoristasOnlinePollingInterval, (_) => _atualizarMotoristasOnline());
+  }
+
+  LatLng _referenciaMotoristasOnline() {
+    return _origemLatLng ??
+        _mapDefaultCenter ??
+        const LatLng(MapTileConfig.defaultCenterLat, MapTileConfig.defaultCenterLng);
+  }
+
+  void _assinarMotoristasProximos() {
+    final referencia = _referenciaMotoristasOnline();
+    const raio = PassengerSettings.motoristasProximosRaioGraus;
+    _realtime?.subscribeNearby(
+      sul: referencia.latitude - raio,
+      oeste: referencia.longitude - raio,
+      norte: referencia.latitude + raio,
+      leste: referencia.longitude + raio,
+    );
+    _nearbyAssinado = true;
+  }
+
+  void _aplicarMotoristaProximo(String type, Map<String, dynamic> event) {
+    final perfilId = event['perfil_id'];
+    if (!mounted || perfilId is! int || !_podeMostrarMotoristasOnline()) return;
+    final lista = _motoristasOnline.where((m) => m.perfilId != perfilId).toList();
+    final lat = event['latitude'];
+    final lng = event['longitude'];
+    if (type == 'driver_nearby' && lat is num && lng is num) {
+      final bearing = event['bearing'];
+      final distKm = const Distance().as(
+        LengthUnit.Kilometer,
+        _referenciaMotoristasOnline(),
+        LatLng(lat.toDouble(), lng.toDouble()),
+      );
+      lista.add(MotoristaProximo(
+        perfilId: perfilId,
+        latitude: lat.toDouble(),
+        longitude: lng.toDouble(),
+        distKm: distKm,
+        bearing: bearing is num ? bearing.toDouble() : null,
+      ));
+    }
+    setState(() {
+      _motoristasOnline = lista;
+    });
   }
 
   void _pararMotoristasOnlinePolling({bool limpar = false}) {
     _motoristasOnlineTimer?.cancel();
+    if (_nearbyAssinado) {
+      _realtime?.unsubscribeNearby();
+      _nearbyAssinado = false;
+    }
     if (limpar && mounted) {
       setState(() {
         _motoristasOnline = [];
@@ -1494,9 +1548,7 @@ class _PassengerPageState extends ConsumerState<PassengerPage> with WidgetsBindi
 
   Future<void> _atualizarMotoristasOnline() async {
     if (!mounted || !_podeMostrarMotoristasOnline()) return;
-    final referencia = _origemLatLng ??
-        _mapDefaultCenter ??
-        const LatLng(MapTileConfig.defaultCenterLat, MapTileConfig.defaultCenterLng);
+    final referencia = _referenciaMotoristasOnline();
     if (_carregandoMotoristasOnline) return;
     _carregandoMotoristasOnline = true;
     try {
@@ -1544,6 +1596,7 @@ class _PassengerPageState extends ConsumerState<PassengerPage> with WidgetsBindi
     _realtime?.disconnect(reconnect: false);
     _realtime = null;
     _wsConnected = false;
+    _nearbyAssinado = false;
     _wsPerfilId = null;
   }
 
@@ -1552,11 +1605,15 @@ class _PassengerPageState extends ConsumerState<PassengerPage> with WidgetsBindi
     setState(() => _wsConnected = true);
     _corridaTimer?.cancel();
     _realtime?.sendSync();
+    _sincronizarMotoristasOnline();
   }
 
   void _onRealtimeDisconnected() {
     if (!mounted) return;
     setState(() => _wsConnected = false);
+    // Assinaturas morrem com a conexão: volta ao polling até reconectar.
+    _nearbyAssinado = false;
+    _sincronizarMotoristasOnline();
     if (_corridaIdAtual != null) {
       _iniciarPollingCorrida();
     }
@@ -1575,6 +1632,10 @@ class _PassengerPageState extends ConsumerState<PassengerPage> with WidgetsBindi
       }
       return;
     }
+    if (type == 'driver_nearby' || type == 'driver_gone') {
+      _aplicarMotoristaProximo(type, event);
+      return;
+    }
     if (type == 'driver_location') {
       final corridaId = event['corrida_id'];
       if (_corridaIdAtual == null) return;
@@ -116,11 +116,22 @@ class RidesService {
   final Dio _dio = ApiClient.client;
 
   Future<List<CorridaResumo>> listarCorridas({int? perfilId}) async {
-    final resp = await _dio.get('/corridas/', queryParameters: {
-      if (perfilId != null) 'perfil_id': perfilId,
-    });
-    final data = resp.data as List<dynamic>;
-    return data.map((e) => CorridaResumo.fromJson(e as Map<String, dynamic>)).toList();
+    // A listagem é paginada por cursor ({next, previous, results}): segue `next` até acabar.
+    final corridas = <CorridaResumo>[];
+    String? cursor;
+    do {
+      final resp = await _dio.get('/corridas/', queryParameters: {
+        if (perfilId != null) 'perfil_id': perfilId,
+        if (cursor != null) 'cursor': cursor,
+      });
+      final body = resp.data;
+      final data = (body is Map<String, dynamic> ? body['results'] : body) as List<dynamic>;
+      corridas.addAll(data.map((e) => CorridaResumo.fromJson(e as Map<String, dynamic>)));
+      final next = body is Map<String, dynamic> ? body['next'] as String? : null;
+      // Só o cursor do `next`: o host nele é o que o servidor enxerga, que pode não ser o do app.
+      cursor = next == null ? null : Uri.parse(next).queryParameters['cursor'];
+    } while (cursor != null);
+    return corridas;
   }
 
   Future<CorridaResumo> solicitar({
@@ -146,15 +157,27 @@ class RidesService {
     return CorridaResumo.fromJson(resp.data as Map<String, dynamic>);
   }
 
+  // ETag da última resposta de para_passageiro (por perfil): o backend responde 304 se nada mudou.
+  static int? _etagPerfilId;
+  static String? _etagCorrida;
+  static CorridaResumo? _ultimaCorrida;
+
   Future<CorridaResumo?> buscarCorridaAtiva({required int perfilId}) async {
+    final etag = _etagPerfilId == perfilId ? _etagCorrida : null;
     final resp = await _dio.get(
       '/corridas/para_passageiro/$perfilId/',
-      options: Options(validateStatus: (_) => true),
+      options: Options(
+        validateStatus: (_) => true,
+        headers: {if (etag != null) 'If-None-Match': etag},
+      ),
     );
+    if (resp.statusCode == 304) return _ultimaCorrida;
     if (resp.statusCode != 200 || resp.data is! Map<String, dynamic>) return null;
     final data = resp.data as Map<String, dynamic>;
-    if (data.isEmpty) return null;
-    return CorridaResumo.fromJson(data);
+    _etagPerfilId = perfilId;
+    _etagCorrida = resp.headers.value('etag');
+    _ultimaCorrida = data.isEmpty ? null : CorridaResumo.fromJson(data);
+    return _ultimaCorrida;
   }
 
   Future<List<MotoristaProximo>> motoristasProximos({
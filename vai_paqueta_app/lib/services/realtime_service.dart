@@ -34,6 +34,8 @@ class RealtimeService {
   bool _connecting = false;
   bool _shouldReconnect = true;
   int _attempt = 0;
+  int? _lastRideId;
+  int? _lastSeq;
 
   static const int _jwtGraceSeconds = 30;
 
@@ -119,6 +121,13 @@ class RealtimeService {
   }
 
   void sendSync() {
+    // Com um seq conhecido, o servidor reenvia só os eventos perdidos (ou responde como sync).
+    final rideId = _lastRideId;
+    final seq = _lastSeq;
+    if (rideId != null && seq != null) {
+      send({'type': 'resume', 'ride_id': rideId, 'seq': seq});
+      return;
+    }
     send({'type': 'sync'});
   }
 
@@ -130,6 +139,23 @@ class RealtimeService {
     send({'type': 'unsubscribe_ride', 'ride_id': rideId});
   }
 
+  /// Assina as células da grade que cobrem o retângulo (motoristas próximos por push).
+  void subscribeNearby({
+    required double sul,
+    required double oeste,
+    required double norte,
+    required double leste,
+  }) {
+    send({
+      'type': 'subscribe_nearby',
+      'bbox': [sul, oeste, norte, leste],
+    });
+  }
+
+  void unsubscribeNearby() {
+    send({'type': 'unsubscribe_nearby'});
+  }
+
   Uri _buildUri(String? token) {
     final base = ApiConfig.baseOrigin;
     final baseUri = Uri.parse(base);
@@ -200,9 +226,22 @@ class RealtimeService {
       onConnected?.call();
       return;
     }
+    _trackSeq(data);
     onEvent(data);
   }
 
+  void _trackSeq(Map<String, dynamic> data) {
+    final seq = data['seq'];
+    if (seq is! int) return;
+    final corrida = data['corrida'];
+    final rideId = corrida is Map<String, dynamic> ? corrida['id'] : data['ride_id'];
+    if (rideId is! int) return;
+    if (rideId != _lastRideId || _lastSeq == null || seq > _lastSeq!) {
+      _lastRideId = rideId;
+      _lastSeq = seq;
+    }
+  }
+
   void _handleDisconnect() {
     if (_channel == null) return;
     _subscription?.cancel();
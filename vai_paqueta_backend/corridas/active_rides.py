@@ -0,0 +1,96 @@
+"""
+Mapa motorista -> corrida ativa (id da corrida e do passageiro) no cache do Django.
+
+Usado no caminho quente dos pings: o fan-out da localização e a checagem de "motorista ocupado"
+não precisam consultar o banco. O mapa é atualizado a cada gravação de Corrida (após o commit);
+motoristas sem corrida também ficam em cache (marcador negativo) até a próxima mudança.
+"""
+
+from __future__ import annotations
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .models import Corrida
+
+ACTIVE_STATUSES = ["aguardando", "aceita", "em_andamento"]
+
+_SEM_CORRIDA = 0
+
+
+def _chave(perfil_id: int) -> str:
+    return f"corridas:motorista_ativa:{perfil_id}"
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "ACTIVE_RIDE_CACHE_SECONDS", 300))
+
+
+def corrida_ativa_do_motorista(perfil_id: int) -> tuple[int, int | None] | None:
+    """
+    (corrida_id, cliente_id) da corrida ativa do motorista, ou None. Só consulta o banco em cache miss.
+    """
+    valor = cache.get(_chave(perfil_id))
+    if valor is None:
+        corrida = (
+            Corrida.objects.filter(motorista_id=perfil_id, status__in=ACTIVE_STATUSES)
+            .order_by("-atualizado_em", "-criado_em")
+            .values_list("id", "cliente_id")
+            .first()
+        )
+        valor = list(corrida) if corrida else _SEM_CORRIDA
+        # add, não set: se um handler gravou o mapa depois da consulta acima, o valor dele prevalece.
+        cache.add(_chave(perfil_id), valor, _ttl())
+    if valor == _SEM_CORRIDA:
+        return None
+    return valor[0], valor[1]
+
+
+def corrida_salva(corrida: Corrida, motorista_anterior_id: int | None = None) -> None:
+    """
+    Atualiza o mapa depois de uma gravação (post_save; bulk_update precisa chamar direto).
+    """
+    atualizar_mapa(corrida.id, corrida.cliente_id, corrida.motorista_id, corrida.status, motorista_anterior_id)
+
+
+def atualizar_mapa(
+    corrida_id: int,
+    cliente_id: int | None,
+    motorista_id: int | None,
+    status: str,
+    motorista_anterior_id: int | None = None,
+) -> None:
+    if motorista_anterior_id and motorista_anterior_id != motorista_id:
+        cache.delete(_chave(motorista_anterior_id))
+    if not motorista_id:
+        return
+    if status in ACTIVE_STATUSES:
+        cache.set(_chave(motorista_id), [corrida_id, cliente_id], _ttl())
+    else:
+        # A corrida saiu dos estados ativos; a próxima consulta confirma (e guarda o negativo).
+        cache.delete(_chave(motorista_id))
+
+
+@receiver(post_init, sender=Corrida)
+def _guardar_motorista_carregado(sender, instance: Corrida, **kwargs):
+    # Via __dict__ para não disparar consulta em instâncias com motorista adiado (.only()).
+    instance._motorista_id_carregado = instance.__dict__.get("motorista_id")
+
+
+@receiver(post_save, sender=Corrida)
+def _atualizar_mapa(sender, instance: Corrida, **kwargs):
+    anterior = getattr(instance, "_motorista_id_carregado", None)
+    instance._motorista_id_carregado = instance.motorista_id
+    valores = (instance.id, instance.cliente_id, instance.motorista_id, instance.status, anterior)
+    # Só depois do commit: um rollback não pode deixar o mapa apontando para estado que não existe.
+    transaction.on_commit(lambda: atualizar_mapa(*valores))
+
+
+@receiver(post_delete, sender=Corrida)
+def _remover_do_mapa(sender, instance: Corrida, **kwargs):
+    if instance.motorista_id:
+        perfil_id = instance.motorista_id
+        transaction.on_commit(lambda: cache.delete(_chave(perfil_id)))
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Corrida, LocalizacaoPing, Perfil, UserContato
+from .models import Corrida, EventoCorrida, LocalizacaoPing, Perfil, UserContato
 
 
 @admin.register(UserContato)
@@ -49,3 +49,11 @@ class LocalizacaoPingAdmin(admin.ModelAdmin):
     def perfil_nome(self, obj):
         return getattr(obj.perfil, "nome", "")
 
+
+@admin.register(EventoCorrida)
+class EventoCorridaAdmin(admin.ModelAdmin):
+    list_display = ("id", "corrida", "canal", "tipo", "tentativas", "disponivel_em", "publicado_em", "criado_em")
+    list_filter = ("canal", "tipo", "publicado_em")
+    search_fields = ("corrida__id", "tipo", "erro")
+    list_select_related = ("corrida",)
+    readonly_fields = ("criado_em",)
@@ -6,3 +6,6 @@ class CorridasConfig(AppConfig):
     name = "corridas"
     verbose_name = "Corridas"
 
+    def ready(self):
+        from . import active_rides  # noqa: F401 (registra os sinais do mapa de corridas ativas)
+        from . import principal  # noqa: F401 (invalida o cache do principal autenticado)
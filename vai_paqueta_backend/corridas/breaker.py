@@ -0,0 +1,57 @@
+"""
+Disjuntor (circuit breaker) para o Redis no caminho das requisições (cache e presença).
+
+Depois de DISJUNTOR_FALHAS falhas seguidas o disjuntor abre e, por DISJUNTOR_ABERTO_SECONDS, as chamadas
+nem tentam o Redis (quem chama cai no banco ou trata como cache vazio). Passado esse tempo uma única
+chamada de teste passa: sucesso fecha o disjuntor, falha reabre. Junto com o timeout curto dos sockets
+(REDIS_TIMEOUT_SECONDS), uma queda do Redis custa um timeout por janela, não um por requisição.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+
+from django.conf import settings
+
+
+class Disjuntor:
+    def __init__(self, nome: str):
+        self.nome = nome
+        self._lock = threading.Lock()
+        self._falhas = 0
+        self._aberto_ate = 0.0
+        self._testando = False
+
+    def _limite_falhas(self) -> int:
+        return max(1, int(getattr(settings, "DISJUNTOR_FALHAS", 3)))
+
+    def _segundos_aberto(self) -> float:
+        return float(getattr(settings, "DISJUNTOR_ABERTO_SECONDS", 10))
+
+    @property
+    def aberto(self) -> bool:
+        with self._lock:
+            return self._falhas >= self._limite_falhas()
+
+    def permitir(self) -> bool:
+        with self._lock:
+            if self._falhas < self._limite_falhas():
+                return True
+            if time.monotonic() < self._aberto_ate or self._testando:
+                return False
+            # Meio-aberto: só esta chamada testa o Redis; as demais seguem no caminho alternativo.
+            self._testando = True
+            return True
+
+    def sucesso(self) -> None:
+        with self._lock:
+            self._falhas = 0
+            self._testando = False
+
+    def falha(self) -> None:
+        with self._lock:
+            self._falhas += 1
+            self._testando = False
+            if self._falhas >= self._limite_falhas():
+                self._aberto_ate = time.monotonic() + self._segundos_aberto()
@@ -0,0 +1,140 @@
+"""
+Coalescência da localização do motorista por corrida: no máximo LOCATION_FANOUT_MAX_HZ envios por
+segundo para cada corrida, ficando sempre o último ping (last-value-wins). Movimento grande desde o
+último envio sai na hora, e uma mudança de status descarrega o ping pendente antes do evento.
+"""
+
+from __future__ import annotations
+
+import heapq
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Optional
+
+from django.conf import settings
+
+# Estados sem envio há mais que isso são descartados (corrida encerrada, motorista parado).
+_ESTADO_MAX_IDADE_S = 120.0
+
+
+def _distancia_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    # Equiretangular: suficiente para decidir se o motorista andou alguns metros.
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371000.0 * math.hypot(x, y)
+
+
+@dataclass
+class _EstadoCorrida:
+    ultimo_envio: float = 0.0
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    pendente: Optional[tuple[list[str], dict, float, float]] = None
+    agendado: bool = False
+
+
+@dataclass(order=True)
+class _Prazo:
+    quando: float
+    corrida_id: int = field(compare=False)
+
+
+class CoalescedorLocalizacao:
+    def __init__(self, enviar: Callable[[Iterable[str], dict], None]):
+        self._enviar = enviar
+        self._cond = threading.Condition()
+        self._estados: dict[int, _EstadoCorrida] = {}
+        self._prazos: list[_Prazo] = []
+        self._pid: int | None = None
+
+    def _intervalo(self) -> float:
+        hz = float(getattr(settings, "LOCATION_FANOUT_MAX_HZ", 1.0))
+        return 1.0 / hz if hz > 0 else 0.0
+
+    def publicar(self, corrida_id: int, groups: list[str], payload: dict, lat: float, lng: float) -> None:
+        intervalo = self._intervalo()
+        if not intervalo:
+            self._enviar(groups, payload)
+            return
+        limiar_m = float(getattr(settings, "LOCATION_FANOUT_MIN_MOVE_M", 30.0))
+        agora = time.monotonic()
+        with self._cond:
+            self._podar(agora)
+            estado = self._estados.setdefault(corrida_id, _EstadoCorrida())
+            andou = (
+                estado.lat is not None
+                and limiar_m > 0
+                and _distancia_m(estado.lat, estado.lng, lat, lng) >= limiar_m
+            )
+            if agora - estado.ultimo_envio >= intervalo or andou:
+                estado.ultimo_envio = agora
+                estado.lat, estado.lng = lat, lng
+                estado.pendente = None
+                enviar_agora = True
+            else:
+                estado.pendente = (groups, payload, lat, lng)
+                if not estado.agendado:
+                    estado.agendado = True
+                    heapq.heappush(self._prazos, _Prazo(estado.ultimo_envio + intervalo, corrida_id))
+                    self._garantir_thread()
+                    self._cond.notify()
+                enviar_agora = False
+        if enviar_agora:
+            self._enviar(groups, payload)
+
+    def descarregar(self, corrida_id: int) -> None:
+        """
+        Envia já o ping pendente da corrida (chamado antes de eventos de status).
+        """
+        with self._cond:
+            estado = self._estados.get(corrida_id)
+            if not estado or not estado.pendente:
+                return
+            groups, payload, lat, lng = estado.pendente
+            estado.pendente = None
+            estado.ultimo_envio = time.monotonic()
+            estado.lat, estado.lng = lat, lng
+        self._enviar(groups, payload)
+
+    def _podar(self, agora: float) -> None:
+        if len(self._estados) < 1024:
+            return
+        for corrida_id in [
+            cid
+            for cid, estado in self._estados.items()
+            if not estado.pendente and agora - estado.ultimo_envio > _ESTADO_MAX_IDADE_S
+        ]:
+            del self._estados[corrida_id]
+
+    def _garantir_thread(self) -> None:
+        # Chamado com o lock; recria a thread após fork.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._executar, name="coalescedor-localizacao", daemon=True).start()
+
+    def _executar(self) -> None:
+        while True:
+            with self._cond:
+                while not self._prazos or self._prazos[0].quando > time.monotonic():
+                    espera = self._prazos[0].quando - time.monotonic() if self._prazos else None
+                    self._cond.wait(timeout=espera)
+                prazo = heapq.heappop(self._prazos)
+                estado = self._estados.get(prazo.corrida_id)
+                if not estado:
+                    continue
+                estado.agendado = False
+                if not estado.pendente:
+                    continue
+                groups, payload, lat, lng = estado.pendente
+                estado.pendente = None
+                estado.ultimo_envio = time.monotonic()
+                estado.lat, estado.lng = lat, lng
+            try:
+                self._enviar(groups, payload)
+            except Exception:
+                # Localização é efêmera: o próximo ping substitui a que falhou.
+                pass
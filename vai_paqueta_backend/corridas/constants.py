@@ -1 +1,4 @@
 PING_MAX_AGE_MINUTES = 5
+
+# Tempo que o motorista tem para aceitar uma corrida oferecida antes de ela voltar para a fila.
+OFERTA_MAX_AGE_MINUTES = 2
@@ -1,14 +1,36 @@
 from __future__ import annotations
 
+import math
 from typing import Optional
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
 
+from . import presence, replay
+from .dispatch import _auto_atribuir_por_ping
 from .models import Corrida, LocalizacaoPing, Perfil
-from .realtime import ACTIVE_STATUSES, group_driver, group_passenger, group_ride, notify_driver_location
+from .protocol import PONG, SUBPROTOCOLO_BINARIO, decodificar_ping
+from .realtime import (
+    ACTIVE_STATUSES,
+    celulas_bbox,
+    group_driver,
+    group_passenger,
+    group_ride,
+    notify_driver_location,
+    notify_motorista_proximo,
+    notify_motorista_saiu,
+)
 from .serializers import CorridaSerializer
-from .views import _auto_atribuir_por_ping
+
+
+def _bbox_valido(bbox) -> bool:
+    # O JSON aceita NaN/Infinity, que quebrariam o cálculo das células da grade.
+    return (
+        isinstance(bbox, list)
+        and len(bbox) == 4
+        and all(isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in bbox)
+    )
 
 
 class BaseRideConsumer(AsyncJsonWebsocketConsumer):
@@ -16,13 +38,19 @@ class BaseRideConsumer(AsyncJsonWebsocketConsumer):
     perfil_id: int = 0
     perfil_tipo: str = ""
     base_group: Optional[str] = None
+    binario: bool = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Grupos ride_<id> desta conexão, em ordem de assinatura (dict como conjunto ordenado).
+        self.corridas_assinadas: dict[int, None] = {}
 
     async def connect(self):
         user = self.scope.get("user")
         if not user or not user.is_authenticated:
             await self.close(code=4401)
             return
-        perfil = await self._get_perfil(user.id)
+        perfil = await self._get_perfil(user)
         if not perfil:
             await self.close(code=4404)
             return
@@ -33,7 +61,9 @@ class BaseRideConsumer(AsyncJsonWebsocketConsumer):
         self.perfil_id = perfil.id
         self.perfil_tipo = perfil.tipo
         self.base_group = self._base_group_name(perfil)
-        await self.accept()
+        # JSON é o padrão; o app pode negociar o subprotocolo binário para ping/localização.
+        self.binario = SUBPROTOCOLO_BINARIO in (self.scope.get("subprotocols") or [])
+        await self.accept(subprotocol=SUBPROTOCOLO_BINARIO if self.binario else None)
         if self.base_group:
             await self.channel_layer.group_add(self.base_group, self.channel_name)
         await self.send_json(
@@ -47,27 +77,73 @@ class BaseRideConsumer(AsyncJsonWebsocketConsumer):
     async def disconnect(self, close_code):
         if self.base_group:
             await self.channel_layer.group_discard(self.base_group, self.channel_name)
+        # Sem isso cada corrida assinada deixa um membro morto no channel layer até o group_expiry.
+        for ride_id in list(self.corridas_assinadas):
+            await self._desassinar(ride_id)
 
     async def receive_json(self, content, **kwargs):
         msg_type = (content.get("type") or "").lower()
         if msg_type == "subscribe_ride":
             ride_id = content.get("ride_id")
             if isinstance(ride_id, int) and await self._pode_assinar_corrida(ride_id):
-                await self.channel_layer.group_add(group_ride(ride_id), self.channel_name)
+                await self._assinar(ride_id)
                 await self.send_json({"type": "subscribed", "ride_id": ride_id})
             return
         if msg_type == "unsubscribe_ride":
             ride_id = content.get("ride_id")
             if isinstance(ride_id, int):
-                await self.channel_layer.group_discard(group_ride(ride_id), self.channel_name)
+                await self._desassinar(ride_id)
                 await self.send_json({"type": "unsubscribed", "ride_id": ride_id})
             return
+        if msg_type == "resume":
+            # Reconexão: reenvia só os eventos perdidos; sem buffer que cubra a lacuna, vira sync.
+            ride_id = content.get("ride_id")
+            seq = content.get("seq")
+            if isinstance(ride_id, int) and isinstance(seq, int):
+                perdidos = await replay.aeventos_desde(ride_id, self.perfil_id, seq)
+                if perdidos is not None:
+                    await self._assinar(ride_id)
+                    for payload in perdidos:
+                        await self.send_json(payload)
+                    ultimo = perdidos[-1]["seq"] if perdidos else seq
+                    await self.send_json({"type": "resumed", "ride_id": ride_id, "seq": ultimo})
+                    return
+            msg_type = "sync"
         if msg_type == "sync":
-            data = await self._get_corrida_ativa()
-            await self.send_json({"type": "ride_update", "corrida": data})
+            data, seq = await self._get_corrida_ativa()
+            await self.send_json({"type": "ride_update", "corrida": data, "seq": seq})
+            return
+
+    async def _assinar(self, ride_id: int):
+        if ride_id in self.corridas_assinadas:
             return
+        limite = max(1, int(getattr(settings, "WS_MAX_RIDE_SUBSCRIPTIONS", 5)))
+        while self.corridas_assinadas and len(self.corridas_assinadas) >= limite:
+            # Acima do limite sai a assinatura mais antiga; o app é avisado como num unsubscribe.
+            mais_antiga = next(iter(self.corridas_assinadas))
+            await self._desassinar(mais_antiga)
+            await self.send_json({"type": "unsubscribed", "ride_id": mais_antiga})
+        await self.channel_layer.group_add(group_ride(ride_id), self.channel_name)
+        self.corridas_assinadas[ride_id] = None
+
+    async def _desassinar(self, ride_id: int):
+        self.corridas_assinadas.pop(ride_id, None)
+        await self.channel_layer.group_discard(group_ride(ride_id), self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None:
+            if self.binario:
+                await self.receive_binario(bytes_data)
+            return
+        await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    async def receive_binario(self, dados: bytes):
+        return
 
     async def corrida_event(self, event):
+        if self.binario and event.get("binario"):
+            await self.send(bytes_data=event["binario"])
+            return
         payload = event.get("event")
         if payload:
             await self.send_json(payload)
@@ -79,8 +155,12 @@ class BaseRideConsumer(AsyncJsonWebsocketConsumer):
         return None
 
     @database_sync_to_async
-    def _get_perfil(self, user_id: int) -> Optional[Perfil]:
-        return Perfil.objects.filter(user_id=user_id).first()
+    def _get_perfil(self, user) -> Optional[Perfil]:
+        # O JWTAuthMiddleware entrega o usuário com o perfil anexado (corridas.principal).
+        try:
+            return user.perfil_app
+        except Perfil.DoesNotExist:
+            return None
 
     @database_sync_to_async
     def _pode_assinar_corrida(self, corrida_id: int) -> bool:
@@ -101,7 +181,7 @@ class BaseRideConsumer(AsyncJsonWebsocketConsumer):
     @database_sync_to_async
     def _get_corrida_ativa(self):
         if not self.perfil_id:
-            return None
+            return None, None
         if self.perfil_tipo == "ecotaxista":
             corrida = (
                 Corrida.objects.filter(motorista_id=self.perfil_id, status__in=ACTIVE_STATUSES)
@@ -114,10 +194,23 @@ class BaseRideConsumer(AsyncJsonWebsocketConsumer):
                 .order_by("-atualizado_em", "-criado_em")
                 .first()
             )
-        return CorridaSerializer(corrida).data if corrida else None
+        if not corrida:
+            return None, None
+        return CorridaSerializer(corrida).data, replay.ultimo_seq(corrida.id)
 
 
 class DriverConsumer(BaseRideConsumer):
+    async def connect(self):
+        await super().connect()
+        if self.perfil_id:
+            await database_sync_to_async(presence.marcar_online)(self.perfil_id)
+
+    async def disconnect(self, close_code):
+        if self.perfil_id:
+            await database_sync_to_async(presence.marcar_offline)(self.perfil_id)
+            await database_sync_to_async(notify_motorista_saiu)(self.perfil_id)
+        await super().disconnect(close_code)
+
     def _perfil_autorizado(self, perfil: Perfil) -> bool:
         return perfil.tipo == "ecotaxista"
 
@@ -140,6 +233,15 @@ class DriverConsumer(BaseRideConsumer):
             return
         await super().receive_json(content, **kwargs)
 
+    async def receive_binario(self, dados: bytes):
+        ping = decodificar_ping(dados)
+        if not ping or not self.perfil_id:
+            return
+        await self._registrar_ping(
+            ping["latitude"], ping["longitude"], ping["precisao_m"], ping["corrida_id"], ping["bearing"]
+        )
+        await self.send(bytes_data=PONG)
+
     @database_sync_to_async
     def _registrar_ping(self, lat, lng, precisao_m=None, corrida_id=None, bearing=None):
         if not self.perfil_id:
@@ -151,6 +253,7 @@ class DriverConsumer(BaseRideConsumer):
             precisao_m=precisao_m,
             bearing=bearing,
         )
+        presence.marcar_online(self.perfil_id)
         try:
             perfil = Perfil.objects.filter(id=self.perfil_id).first()
             if perfil:
@@ -166,9 +269,51 @@ class DriverConsumer(BaseRideConsumer):
             ping_em=ping.criado_em,
             corrida_id=corrida_id if isinstance(corrida_id, int) else None,
         )
+        notify_motorista_proximo(
+            perfil_id=self.perfil_id,
+            latitude=float(ping.latitude),
+            longitude=float(ping.longitude),
+            bearing=ping.bearing,
+            ping_em=ping.criado_em,
+        )
 
 
 class PassengerConsumer(BaseRideConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Células da grade assinadas para o mapa de motoristas próximos (grupos cell_<i>_<j>).
+        self.celulas_assinadas: set[str] = set()
+
+    async def disconnect(self, close_code):
+        await self._assinar_celulas([])
+        await super().disconnect(close_code)
+
+    async def receive_json(self, content, **kwargs):
+        msg_type = (content.get("type") or "").lower()
+        if msg_type == "subscribe_nearby":
+            # bbox = [sul, oeste, norte, leste] da área visível do mapa.
+            bbox = content.get("bbox")
+            if not _bbox_valido(bbox):
+                await self.send_json({"type": "error", "detail": "bbox inválido."})
+                return
+            limite = max(1, int(getattr(settings, "WS_MAX_NEARBY_CELLS", 49)))
+            await self._assinar_celulas(celulas_bbox(*bbox, limite=limite))
+            await self.send_json({"type": "nearby_subscribed", "celulas": len(self.celulas_assinadas)})
+            return
+        if msg_type == "unsubscribe_nearby":
+            await self._assinar_celulas([])
+            await self.send_json({"type": "nearby_unsubscribed"})
+            return
+        await super().receive_json(content, **kwargs)
+
+    async def _assinar_celulas(self, celulas: list[str]):
+        novas = set(celulas)
+        for grupo in self.celulas_assinadas - novas:
+            await self.channel_layer.group_discard(grupo, self.channel_name)
+        for grupo in novas - self.celulas_assinadas:
+            await self.channel_layer.group_add(grupo, self.channel_name)
+        self.celulas_assinadas = novas
+
     def _perfil_autorizado(self, perfil: Perfil) -> bool:
         return perfil.tipo in ("passageiro", "cliente")
 
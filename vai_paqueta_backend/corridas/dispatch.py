@@ -0,0 +1,565 @@
+from __future__ import annotations
+
+import math
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from geo import views as geo_views
+
+from .active_rides import corrida_ativa_do_motorista, corrida_salva
+from .constants import PING_MAX_AGE_MINUTES
+from .models import Corrida, LocalizacaoPing, Perfil
+from .realtime import ACTIVE_STATUSES, notify_corrida
+
+MAX_MOTORISTAS_TENTADOS = 50
+AUTO_MATCH_RADIUS_KM = 3.0
+AUTO_MATCH_LIMIT = 50
+
+MODO_IMEDIATO = "imediato"
+MODO_LOTE = "lote"
+
+DISTANCIA_LINHA_RETA = "linha_reta"
+DISTANCIA_ESTRADA = "estrada"
+
+# Custo usado para pares proibidos (motorista já tentado ou fora do raio).
+_CUSTO_PROIBIDO = 1e9
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    # Distância aproximada em km entre dois pontos lat/lng
+    r = 6371
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * r * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def _limitar_motoristas_tentados(lista):
+    if not lista:
+        return []
+    unique = list(dict.fromkeys(int(x) for x in lista if x is not None))
+    if len(unique) > MAX_MOTORISTAS_TENTADOS:
+        unique = unique[-MAX_MOTORISTAS_TENTADOS:]
+    return unique
+
+
+def _modo_distancia(modo: str | None = None) -> str:
+    return modo or getattr(settings, "DISPATCH_DISTANCE", DISTANCIA_LINHA_RETA)
+
+
+_DISTANCIAS_LOCK = threading.Lock()
+# nó da origem -> {nó: distância em metros}; LRU simples, válido só para o grafo em _DISTANCIAS_GRAFO.
+_DISTANCIAS_CACHE: "OrderedDict[int, dict[int, float]]" = OrderedDict()
+_DISTANCIAS_GRAFO: dict[str, object] = {"graph": None}
+
+
+def _distancias_do_no(graph: geo_views.RoadGraph, origem_id: int) -> dict[int, float]:
+    with _DISTANCIAS_LOCK:
+        if _DISTANCIAS_GRAFO["graph"] is not graph:
+            # Malha recarregada (arquivo de vias mudou): as buscas do grafo anterior não valem mais.
+            _DISTANCIAS_CACHE.clear()
+            _DISTANCIAS_GRAFO["graph"] = graph
+        distancias = _DISTANCIAS_CACHE.get(origem_id)
+        if distancias is not None:
+            _DISTANCIAS_CACHE.move_to_end(origem_id)
+            return distancias
+    distancias = graph.distances_from(origem_id)
+    limite = int(getattr(settings, "DISPATCH_ROAD_CACHE_SIZE", 512))
+    with _DISTANCIAS_LOCK:
+        if _DISTANCIAS_GRAFO["graph"] is graph:
+            _DISTANCIAS_CACHE[origem_id] = distancias
+            while len(_DISTANCIAS_CACHE) > limite:
+                _DISTANCIAS_CACHE.popitem(last=False)
+    return distancias
+
+
+def limpar_cache_distancias() -> None:
+    with _DISTANCIAS_LOCK:
+        _DISTANCIAS_CACHE.clear()
+        _DISTANCIAS_GRAFO["graph"] = None
+
+
+def grafo_de_vias(modo: str | None = None) -> geo_views.RoadGraph | None:
+    """
+    Malha de vias usada no modo "estrada" (None em linha reta ou sem malha). Quem calcula várias
+    origens seguidas carrega uma vez e repassa em `grafo` para distancias_ate_origem.
+    """
+    if _modo_distancia(modo) != DISTANCIA_ESTRADA:
+        return None
+    graph, _, _ = geo_views._load_road_graph()
+    return graph if graph is not None and graph.nodes else None
+
+
+def distancias_ate_origem(
+    lat: float,
+    lng: float,
+    motoristas: dict[int, tuple[float, float]],
+    modo: str | None = None,
+    nos_motoristas: dict[int, tuple[int | None, float | None]] | None = None,
+    grafo: geo_views.RoadGraph | None = None,
+) -> dict[int, float]:
+    """
+    Distância em km de cada motorista até a origem (lat, lng).
+
+    No modo "estrada" roda uma única busca um-para-muitos na malha a partir do nó mais próximo da
+    origem (cacheada por nó) e lê dela a distância de todos os candidatos, somando os trechos de
+    encaixe na malha. Motoristas sem caminho ficam de fora. Sem malha disponível, usa linha reta.
+    `nos_motoristas` guarda o nó de cada motorista entre chamadas do mesmo tick e `grafo` evita
+    reler o arquivo de vias a cada chamada (veja grafo_de_vias).
+    """
+    if not motoristas:
+        return {}
+    if _modo_distancia(modo) == DISTANCIA_ESTRADA:
+        graph = grafo if grafo is not None else grafo_de_vias(modo)
+        if graph is not None:
+            origem_id, origem_snap = graph.nearest_node(lat, lng)
+            if origem_id is not None:
+                distancias = _distancias_do_no(graph, origem_id)
+                nos = nos_motoristas if nos_motoristas is not None else {}
+                resultado: dict[int, float] = {}
+                for perfil_id, (m_lat, m_lng) in motoristas.items():
+                    if perfil_id not in nos:
+                        nos[perfil_id] = graph.nearest_node(m_lat, m_lng)
+                    no_id, snap = nos[perfil_id]
+                    if no_id is None or no_id not in distancias:
+                        continue
+                    resultado[perfil_id] = (distancias[no_id] + (origem_snap or 0.0) + (snap or 0.0)) / 1000.0
+                return resultado
+    return {
+        perfil_id: _haversine_km(lat, lng, m_lat, m_lng) for perfil_id, (m_lat, m_lng) in motoristas.items()
+    }
+
+
+def despacho_em_lote() -> bool:
+    """
+    Indica se as atribuições ficam a cargo do despachante periódico (modo "lote").
+    """
+    return getattr(settings, "DISPATCH_MODE", MODO_IMEDIATO) == MODO_LOTE
+
+
+def _auto_atribuir_por_ping(perfil: Perfil, lat: float, lng: float) -> Corrida | None:
+    if perfil.tipo != "ecotaxista":
+        return None
+    if despacho_em_lote():
+        return None
+    if corrida_ativa_do_motorista(perfil.id):
+        return None
+    candidatas = (
+        Corrida.objects.filter(
+            status="aguardando",
+            motorista__isnull=True,
+            origem_lat__isnull=False,
+            origem_lng__isnull=False,
+        )
+        .order_by("-criado_em")[:AUTO_MATCH_LIMIT]
+    )
+    candidatas = list(candidatas)
+    if not candidatas:
+        return None
+    grafo = grafo_de_vias()
+    melhor = None
+    melhor_dist = None
+    motorista = {perfil.id: (lat, lng)}
+    nos_motoristas: dict[int, tuple[int | None, float | None]] = {}
+    for corrida in candidatas:
+        if perfil.id in (corrida.motoristas_tentados or []):
+            continue
+        dist = distancias_ate_origem(
+            float(corrida.origem_lat),
+            float(corrida.origem_lng),
+            motorista,
+            nos_motoristas=nos_motoristas,
+            grafo=grafo,
+        ).get(perfil.id)
+        if dist is None or dist > AUTO_MATCH_RADIUS_KM:
+            continue
+        if melhor_dist is None or dist < melhor_dist:
+            melhor = corrida
+            melhor_dist = dist
+    if not melhor:
+        return None
+    with transaction.atomic():
+        corrida = Corrida.objects.select_for_update().get(pk=melhor.id)
+        if corrida.status != "aguardando" or corrida.motorista_id:
+            return None
+        if Corrida.objects.filter(motorista=perfil, status__in=ACTIVE_STATUSES).exists():
+            return None
+        corrida.motorista = perfil
+        tentativa_lista = set(corrida.motoristas_tentados or [])
+        tentativa_lista.add(perfil.id)
+        corrida.motoristas_tentados = _limitar_motoristas_tentados(list(tentativa_lista))
+        corrida.save(update_fields=["motorista", "status", "atualizado_em", "motoristas_tentados"])
+        notify_corrida(corrida, event_type="ride_assigned")
+        return corrida
+
+
+def atribuir_motorista_proximo(
+    corrida: Corrida, excluir_motorista_id: int | None = None, allow_reset: bool = True
+) -> Perfil | None:
+    """
+    Seleciona automaticamente um ecotaxista próximo baseado em pings recentes.
+    No modo "lote" não faz nada: a corrida espera o próximo tick do despachante.
+    """
+    if despacho_em_lote():
+        return None
+    if corrida.origem_lat is None or corrida.origem_lng is None:
+        return None
+    limite_tempo = timezone.now() - timedelta(minutes=PING_MAX_AGE_MINUTES)
+    pings = (
+        LocalizacaoPing.objects.select_related("perfil__user")
+        .filter(perfil__tipo="ecotaxista", criado_em__gte=limite_tempo)
+        .order_by("-criado_em")
+    )
+    vistos: dict[int, LocalizacaoPing] = {}
+    excluidos = set(corrida.motoristas_tentados or [])
+    total_pingados = 0
+    for ping in pings:
+        if ping.perfil_id in vistos:
+            continue
+        if excluir_motorista_id and ping.perfil_id == excluir_motorista_id:
+            continue
+        total_pingados += 1
+        if ping.perfil_id in excluidos:
+            continue
+        vistos[ping.perfil_id] = ping
+    distancias = distancias_ate_origem(
+        float(corrida.origem_lat),
+        float(corrida.origem_lng),
+        {perfil_id: (float(ping.latitude), float(ping.longitude)) for perfil_id, ping in vistos.items()},
+    )
+    candidatos = [(dist, vistos[perfil_id].perfil) for perfil_id, dist in distancias.items()]
+    candidatos.sort(key=lambda x: x[0])
+    if not candidatos and allow_reset and excluidos and total_pingados:
+        # Tentou todos os pingados; limpa tentados e tenta novamente
+        corrida.motoristas_tentados = []
+        corrida.save(update_fields=["motoristas_tentados", "atualizado_em"])
+        return atribuir_motorista_proximo(corrida, excluir_motorista_id=excluir_motorista_id, allow_reset=False)
+    if not candidatos:
+        return None
+    novo_motorista = candidatos[0][1]
+    corrida.motorista = novo_motorista
+    corrida.status = "aguardando"
+    corrida.aceita_em = None
+    corrida.iniciada_em = None
+    corrida.concluida_em = None
+    tentativa_lista = set(corrida.motoristas_tentados or [])
+    tentativa_lista.add(novo_motorista.id)
+    corrida.motoristas_tentados = _limitar_motoristas_tentados(list(tentativa_lista))
+    corrida.save(
+        update_fields=[
+            "motorista",
+            "status",
+            "atualizado_em",
+            "motoristas_tentados",
+            "aceita_em",
+            "iniciada_em",
+            "concluida_em",
+        ]
+    )
+    notify_corrida(corrida, event_type="ride_assigned")
+    return novo_motorista
+
+
+def _hungaro(custos: list[list[float]]) -> list[int]:
+    """
+    Atribuição de custo mínimo (algoritmo húngaro, caminhos aumentantes) para uma matriz n x m com n <= m.
+    Retorna, para cada linha, o índice da coluna atribuída. Complexidade O(n² m).
+    """
+    n = len(custos)
+    if n == 0:
+        return []
+    m = len(custos[0])
+    inf = float("inf")
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    dono = [0] * (m + 1)  # dono[j] = linha (1-based) atribuída à coluna j
+    caminho = [0] * (m + 1)
+    for i in range(1, n + 1):
+        dono[0] = i
+        j0 = 0
+        minv = [inf] * (m + 1)
+        usado = [False] * (m + 1)
+        while True:
+            usado[j0] = True
+            i0 = dono[j0]
+            linha = custos[i0 - 1]
+            ui0 = u[i0]
+            delta = inf
+            j1 = 0
+            for j in range(1, m + 1):
+                if usado[j]:
+                    continue
+                atual = linha[j - 1] - ui0 - v[j]
+                if atual < minv[j]:
+                    minv[j] = atual
+                    caminho[j] = j0
+                if minv[j] < delta:
+                    delta = minv[j]
+                    j1 = j
+            for j in range(m + 1):
+                if usado[j]:
+                    u[dono[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if dono[j0] == 0:
+                break
+        while j0:
+            j1 = caminho[j0]
+            dono[j0] = dono[j1]
+            j0 = j1
+    resultado = [-1] * n
+    for j in range(1, m + 1):
+        if dono[j]:
+            resultado[dono[j] - 1] = j - 1
+    return resultado
+
+
+def resolver_atribuicao(
+    corridas: Iterable[tuple[int, float, float, Iterable[int]]],
+    motoristas: dict[int, tuple[float, float]],
+    raio_km: float = AUTO_MATCH_RADIUS_KM,
+    modo_distancia: str | None = None,
+) -> list[tuple[int, int, float]]:
+    """
+    Resolve a atribuição global corridas x motoristas minimizando a distância total até a origem.
+
+    `corridas` é uma lista de (corrida_id, origem_lat, origem_lng, motoristas_tentados) e
+    `motoristas` mapeia perfil_id -> (lat, lng) do último ping. Pares com motorista já tentado
+    ou fora de `raio_km` nunca são formados. Retorna (corrida_id, perfil_id, distancia_km).
+    """
+    corridas = list(corridas)
+    motorista_ids = list(motoristas)
+    if not corridas or not motorista_ids:
+        return []
+    custos: list[list[float]] = []
+    nos_motoristas: dict[int, tuple[int | None, float | None]] = {}
+    grafo = grafo_de_vias(modo_distancia)
+    for _, lat, lng, tentados in corridas:
+        excluidos = set(tentados or [])
+        distancias = distancias_ate_origem(
+            lat, lng, motoristas, modo=modo_distancia, nos_motoristas=nos_motoristas, grafo=grafo
+        )
+        linha = []
+        for perfil_id in motorista_ids:
+            dist = distancias.get(perfil_id)
+            if perfil_id in excluidos or dist is None or dist > raio_km:
+                linha.append(_CUSTO_PROIBIDO)
+                continue
+            linha.append(dist)
+        custos.append(linha)
+
+    # O lado menor vira as linhas do húngaro.
+    transposto = len(corridas) > len(motorista_ids)
+    if transposto:
+        custos = [list(coluna) for coluna in zip(*custos)]
+    n = len(custos)
+    # Basta considerar as n colunas mais baratas de cada linha: qualquer solução ótima pode ser
+    # trocada para uma que só use essas colunas, o que reduz bastante o problema quando há
+    # muito mais corridas do que motoristas (ou vice-versa).
+    colunas: set[int] = set()
+    for linha in custos:
+        if len(linha) > n:
+            colunas.update(sorted(range(len(linha)), key=linha.__getitem__)[:n])
+        else:
+            colunas.update(range(len(linha)))
+    colunas_ordenadas = sorted(colunas)
+    reduzida = [[linha[j] for j in colunas_ordenadas] for linha in custos]
+    escolha = _hungaro(reduzida)
+
+    pares = []
+    for i, j_reduzida in enumerate(escolha):
+        if j_reduzida < 0:
+            continue
+        j = colunas_ordenadas[j_reduzida]
+        custo = custos[i][j]
+        if custo >= _CUSTO_PROIBIDO:
+            continue
+        idx_corrida, idx_motorista = (j, i) if transposto else (i, j)
+        pares.append((corridas[idx_corrida][0], motorista_ids[idx_motorista], custo))
+    return pares
+
+
+def _motoristas_livres() -> dict[int, tuple[float, float]]:
+    """
+    Último ping recente de cada ecotaxista sem corrida ativa (nem oferta pendente).
+    """
+    limite_tempo = timezone.now() - timedelta(minutes=PING_MAX_AGE_MINUTES)
+    ocupados = set(
+        Corrida.objects.filter(status__in=ACTIVE_STATUSES, motorista__isnull=False).values_list(
+            "motorista_id", flat=True
+        )
+    )
+    pings = (
+        LocalizacaoPing.objects.filter(perfil__tipo="ecotaxista", criado_em__gte=limite_tempo)
+        .order_by("-criado_em")
+        .values_list("perfil_id", "latitude", "longitude")
+    )
+    livres: dict[int, tuple[float, float]] = {}
+    for perfil_id, lat, lng in pings:
+        if perfil_id in livres or perfil_id in ocupados:
+            continue
+        livres[perfil_id] = (float(lat), float(lng))
+    return livres
+
+
+def despachar_lote(limite: Optional[int] = None) -> list[Corrida]:
+    """
+    Um tick do despachante: junta corridas aguardando e motoristas livres, resolve a atribuição
+    global e grava todas as atribuições numa única transação.
+    """
+    limite = limite or int(getattr(settings, "DISPATCH_BATCH_MAX_CORRIDAS", 1000))
+    pendentes = list(
+        Corrida.objects.filter(
+            status="aguardando",
+            motorista__isnull=True,
+            origem_lat__isnull=False,
+            origem_lng__isnull=False,
+        )
+        .order_by("criado_em")
+        .values_list("id", "origem_lat", "origem_lng", "motoristas_tentados")[:limite]
+    )
+    if not pendentes:
+        return []
+    motoristas = _motoristas_livres()
+    if not motoristas:
+        return []
+    pares = resolver_atribuicao(
+        [(cid, float(lat), float(lng), tentados) for cid, lat, lng, tentados in pendentes],
+        motoristas,
+    )
+    if not pares:
+        return []
+
+    atribuidas: list[Corrida] = []
+    with transaction.atomic():
+        corridas = Corrida.objects.select_for_update().in_bulk([corrida_id for corrida_id, _, _ in pares])
+        ocupados = set(
+            Corrida.objects.filter(
+                motorista_id__in=[perfil_id for _, perfil_id, _ in pares],
+                status__in=ACTIVE_STATUSES,
+            ).values_list("motorista_id", flat=True)
+        )
+        agora = timezone.now()
+        for corrida_id, perfil_id, _ in pares:
+            corrida = corridas.get(corrida_id)
+            if not corrida or corrida.status != "aguardando" or corrida.motorista_id:
+                continue
+            if perfil_id in ocupados or perfil_id in (corrida.motoristas_tentados or []):
+                continue
+            corrida.motorista_id = perfil_id
+            corrida.aceita_em = None
+            corrida.iniciada_em = None
+            corrida.concluida_em = None
+            corrida.atualizado_em = agora
+            corrida.oferta_expira_em = corrida.prazo_oferta()
+            corrida.motoristas_tentados = _limitar_motoristas_tentados(
+                (corrida.motoristas_tentados or []) + [perfil_id]
+            )
+            ocupados.add(perfil_id)
+            atribuidas.append(corrida)
+        if atribuidas:
+            Corrida.objects.bulk_update(
+                atribuidas,
+                [
+                    "motorista",
+                    "atualizado_em",
+                    "motoristas_tentados",
+                    "aceita_em",
+                    "iniciada_em",
+                    "concluida_em",
+                    "oferta_expira_em",
+                ],
+            )
+            for corrida in atribuidas:
+                notify_corrida(corrida, event_type="ride_assigned")
+            # bulk_update não dispara post_save: atualiza o mapa de corridas ativas à mão.
+            transaction.on_commit(lambda: [corrida_salva(corrida) for corrida in atribuidas])
+    return atribuidas
+
+
+def expirar_oferta(corrida: Corrida, agora=None) -> bool:
+    """
+    Devolve para a fila a corrida cujo motorista deixou o prazo de aceite passar e tenta outro
+    motorista (no modo "lote" ela fica para o próximo tick). Espera a linha já travada.
+    """
+    if corrida.status != "aguardando" or not corrida.motorista_id:
+        return False
+    if not corrida.oferta_expira_em or corrida.oferta_expira_em > (agora or timezone.now()):
+        return False
+    motorista_expirado_id = corrida.motorista_id
+    corrida.motoristas_tentados = _limitar_motoristas_tentados(
+        (corrida.motoristas_tentados or []) + [motorista_expirado_id]
+    )
+    corrida.motorista = None
+    corrida.aceita_em = None
+    corrida.iniciada_em = None
+    corrida.concluida_em = None
+    corrida.save(
+        update_fields=[
+            "status",
+            "motorista",
+            "atualizado_em",
+            "motoristas_tentados",
+            "aceita_em",
+            "iniciada_em",
+            "concluida_em",
+        ]
+    )
+    novo = atribuir_motorista_proximo(corrida, excluir_motorista_id=motorista_expirado_id, allow_reset=False)
+    if novo is None:
+        notify_corrida(corrida, event_type="ride_update")
+    return True
+
+
+def varrer_corridas(limite: Optional[int] = None) -> dict:
+    """
+    Um passo da varredura agendada: expira ofertas vencidas (pelo índice de oferta_expira_em) e,
+    no modo imediato, tenta de novo o despacho das corridas que seguem sem motorista.
+    """
+    limite = limite or int(getattr(settings, "DISPATCH_BATCH_MAX_CORRIDAS", 1000))
+    agora = timezone.now()
+    vencidas = list(
+        Corrida.objects.filter(
+            status="aguardando",
+            motorista__isnull=False,
+            oferta_expira_em__lte=agora,
+        )
+        .order_by("oferta_expira_em")
+        .values_list("id", flat=True)[:limite]
+    )
+    expiradas = 0
+    for corrida_id in vencidas:
+        with transaction.atomic():
+            corrida = Corrida.objects.select_for_update().filter(pk=corrida_id).first()
+            if corrida and expirar_oferta(corrida, agora=agora):
+                expiradas += 1
+
+    reatribuidas = 0
+    if not despacho_em_lote() and _motoristas_livres():
+        sem_motorista = list(
+            Corrida.objects.filter(
+                status="aguardando",
+                motorista__isnull=True,
+                origem_lat__isnull=False,
+                origem_lng__isnull=False,
+            )
+            .order_by("criado_em")
+            .values_list("id", flat=True)[:limite]
+        )
+        for corrida_id in sem_motorista:
+            with transaction.atomic():
+                corrida = Corrida.objects.select_for_update().filter(pk=corrida_id).first()
+                if not corrida or corrida.status != "aguardando" or corrida.motorista_id:
+                    continue
+                if atribuir_motorista_proximo(corrida, allow_reset=False):
+                    reatribuidas += 1
+    return {"expiradas": expiradas, "reatribuidas": reatribuidas}
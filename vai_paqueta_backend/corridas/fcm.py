@@ -1,18 +1,58 @@
+"""
+Envio de push pelo FCM (API HTTP v1), uma requisição por token.
+
+As requisições saem por um pool de threads limitado (FCM_MAX_WORKERS) e cada resposta é classificada:
+tokens que o FCM diz não existirem mais são desativados em FcmDeviceToken, erros transitórios (429, 5xx,
+rede) voltam em novas rodadas com backoff exponencial (respeitando Retry-After) até FCM_MAX_TENTATIVAS, e o
+resto conta como falha. Com FCM_ENDPOINT_URL o envio vai para esse endpoint sem autenticação (um FCM
+falso local, para testes offline).
+"""
+
 from __future__ import annotations
 
-from typing import Iterable
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Iterable, Optional
 
+import firebase_admin
+import requests
 from django.conf import settings
+from firebase_admin import credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+
+from .models import FcmDeviceToken
+
+FCM_URL = "https://fcm.googleapis.com/v1/projects/{0}/messages:send"
+
+OK = "ok"
+INVALIDO = "invalido"
+TRANSITORIO = "transitorio"
+FALHA = "falha"
+
+# errorCode do FcmError que significa token morto (app desinstalado, token de outro projeto).
+_ERROS_TOKEN = {"UNREGISTERED", "SENDER_ID_MISMATCH"}
+_STATUS_TRANSITORIOS = {429, 500, 502, 503, 504}
+
+_lock = threading.Lock()
+_transportes: dict[tuple, tuple[requests.Session, str]] = {}
+_pools: dict[int, ThreadPoolExecutor] = {}
 
-import firebase_admin
-from firebase_admin import credentials, messaging
 
+@dataclass
+class ResultadoPush:
+    success_count: int = 0
+    failure_count: int = 0
+    tokens_invalidos: list[str] = field(default_factory=list)
+    rodadas: int = 0
 
-class _SimpleBatchResponse:
-    def __init__(self, success_count: int, failure_count: int):
-        self.success_count = success_count
-        self.failure_count = failure_count
+
+def _config(nome: str, padrao):
+    return getattr(settings, nome, padrao)
 
 
 def _init_firebase() -> None:
@@ -28,6 +68,109 @@ def _init_firebase() -> None:
     firebase_admin.initialize_app(cred)
 
 
+def _transporte() -> tuple[requests.Session, str]:
+    """Sessão HTTP (com pool de conexões do tamanho do pool de threads) e URL de envio."""
+    endpoint = _config("FCM_ENDPOINT_URL", "")
+    workers = _workers()
+    chave = (endpoint, workers)
+    with _lock:
+        if chave in _transportes:
+            return _transportes[chave]
+        if endpoint:
+            sessao, url = requests.Session(), endpoint
+        else:
+            _init_firebase()
+            app = firebase_admin.get_app()
+            sessao = AuthorizedSession(app.credential.get_credential())
+            url = FCM_URL.format(app.project_id)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        sessao.mount("https://", adapter)
+        sessao.mount("http://", adapter)
+        _transportes[chave] = (sessao, url)
+        return sessao, url
+
+
+def _workers() -> int:
+    return max(1, int(_config("FCM_MAX_WORKERS", 16)))
+
+
+def _pool() -> ThreadPoolExecutor:
+    workers = _workers()
+    with _lock:
+        if workers not in _pools:
+            _pools[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fcm")
+        return _pools[workers]
+
+
+def _mensagem(title: str, body: str, data: dict[str, str], android_channel_id: Optional[str]) -> dict:
+    """Mensagem compartilhada por todos os destinatários; o token entra por requisição."""
+    mensagem = {
+        "notification": {"title": title, "body": body},
+        "data": data,
+        "apns": {
+            "headers": {"apns-priority": "10"},
+            "payload": {"aps": {"sound": "default"}},
+        },
+    }
+    if android_channel_id:
+        mensagem["android"] = {"priority": "high", "notification": {"channel_id": android_channel_id}}
+    return mensagem
+
+
+def _retry_after(resposta: requests.Response) -> Optional[float]:
+    valor = resposta.headers.get("Retry-After")
+    try:
+        return max(0.0, float(valor)) if valor else None
+    except ValueError:
+        return None
+
+
+def classificar(status: int, corpo: dict) -> str:
+    """Classe da resposta do FCM v1: ok, invalido (desativar o token), transitorio ou falha."""
+    if 200 <= status < 300:
+        return OK
+    erro = corpo.get("error") if isinstance(corpo, dict) else None
+    erro = erro if isinstance(erro, dict) else {}
+    codigos = {
+        detalhe.get("errorCode")
+        for detalhe in erro.get("details") or []
+        if isinstance(detalhe, dict) and detalhe.get("errorCode")
+    }
+    # Só os códigos explícitos do FcmError desativam o token; um 404/400 genérico é falha.
+    if codigos & _ERROS_TOKEN:
+        return INVALIDO
+    if status in _STATUS_TRANSITORIOS:
+        return TRANSITORIO
+    return FALHA
+
+
+def _enviar_um(sessao: requests.Session, url: str, mensagem: dict, token: str) -> tuple[str, Optional[float]]:
+    payload = {"message": {**mensagem, "token": token}}
+    try:
+        resposta = sessao.post(url, json=payload, timeout=float(_config("FCM_TIMEOUT_SECONDS", 10.0)))
+    except requests.RequestException:
+        return TRANSITORIO, None
+    try:
+        corpo = resposta.json()
+    except ValueError:
+        corpo = {}
+    return classificar(resposta.status_code, corpo), _retry_after(resposta)
+
+
+def _atraso(rodada: int, retry_after: float) -> float:
+    base = float(_config("FCM_BACKOFF_SECONDS", 0.5))
+    teto = float(_config("FCM_BACKOFF_MAX_SECONDS", 10.0))
+    # Jitter só para baixo do backoff; o Retry-After do FCM é um mínimo.
+    return min(teto, max(retry_after, base * (2**rodada) * random.uniform(0.5, 1.0)))
+
+
+def desativar_tokens(tokens: Iterable[str]) -> int:
+    tokens = list(tokens)
+    if not tokens:
+        return 0
+    return FcmDeviceToken.objects.filter(token__in=tokens, ativo=True).update(ativo=False)
+
+
 def send_push_to_tokens(
     *,
     tokens: Iterable[str],
@@ -35,51 +178,37 @@ def send_push_to_tokens(
     body: str,
     data: dict[str, str] | None = None,
     android_channel_id: str | None = None,
-) -> messaging.BatchResponse | None:
-    tokens_list = [token for token in tokens if token]
+) -> ResultadoPush | None:
+    tokens_list = list(dict.fromkeys(token for token in tokens if token))
     if not tokens_list:
         return None
-    _init_firebase()
-    notification = messaging.Notification(title=title, body=body)
-    android = None
-    if android_channel_id:
-        android = messaging.AndroidConfig(
-            priority="high",
-            notification=messaging.AndroidNotification(channel_id=android_channel_id),
-        )
-    apns = messaging.APNSConfig(
-        headers={"apns-priority": "10"},
-        payload=messaging.APNSPayload(aps=messaging.Aps(sound="default")),
-    )
-    message = messaging.MulticastMessage(
-        tokens=tokens_list,
-        notification=notification,
-        data=data or {},
-        android=android,
-        apns=apns,
-    )
-    try:
-        # Prefer the per-message API to avoid /batch endpoint issues.
-        send_each = getattr(messaging, "send_each_for_multicast", None)
-        if send_each:
-            return send_each(message)
-        return messaging.send_multicast(message)
-    except Exception:
-        # Fallback: envia token a token.
-        success = 0
-        failure = 0
-        for token in tokens_list:
-            try:
-                messaging.send(
-                    messaging.Message(
-                        token=token,
-                        notification=notification,
-                        data=data or {},
-                        android=android,
-                        apns=apns,
-                    )
-                )
-                success += 1
-            except Exception:
-                failure += 1
-        return _SimpleBatchResponse(success, failure)
+    sessao, url = _transporte()
+    pool = _pool()
+    mensagem = _mensagem(title, body, data or {}, android_channel_id)
+    resultado = ResultadoPush()
+    max_tentativas = max(1, int(_config("FCM_MAX_TENTATIVAS", 3)))
+    pendentes = tokens_list
+    for rodada in range(max_tentativas):
+        resultado.rodadas += 1
+        respostas = pool.map(lambda token: (token, *_enviar_um(sessao, url, mensagem, token)), pendentes)
+        transitorios: list[str] = []
+        retry_after = 0.0
+        for token, classe, espera in respostas:
+            if classe == OK:
+                resultado.success_count += 1
+            elif classe == TRANSITORIO:
+                transitorios.append(token)
+                retry_after = max(retry_after, espera or 0.0)
+            else:
+                resultado.failure_count += 1
+                if classe == INVALIDO:
+                    resultado.tokens_invalidos.append(token)
+        if not transitorios:
+            break
+        if rodada + 1 == max_tentativas:
+            resultado.failure_count += len(transitorios)
+            break
+        time.sleep(_atraso(rodada, retry_after))
+        pendentes = transitorios
+    desativar_tokens(resultado.tokens_invalidos)
+    return resultado
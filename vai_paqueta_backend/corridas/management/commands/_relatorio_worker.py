@@ -0,0 +1,28 @@
+"""
+Processos do relatorio_corridas --workers.
+
+Sem imports do Django no topo: com "spawn" (Windows, macOS) o filho importa este módulo para
+achar o initializer antes de o Django estar configurado. O "_" no nome impede que o Django o
+trate como comando.
+"""
+import os
+
+_comando = None
+
+
+def iniciar(settings_module: str) -> None:
+    global _comando
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        # spawn: processo novo; com fork o registro já veio pronto do pai.
+        django.setup()
+    from .relatorio_corridas import Command
+
+    _comando = Command()
+
+
+def linha_corrida(corrida, pings, plot_dir, tiles, tile_zoom, plot_formato):
+    return _comando._linha_corrida(corrida, plot_dir, tiles, tile_zoom, pings=pings, plot_formato=plot_formato)
@@ -1,19 +1,29 @@
-import base64
 import csv
-import math
+import multiprocessing
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, time
 from pathlib import Path
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.dateparse import parse_date, parse_datetime
 
 from corridas.models import Corrida, LocalizacaoPing, UserContato
 from geo import views as geo_views
+from geo.rendering import MODOS_TILE, TileAssets, png_trajeto, svg_trajeto
 
-_ROUTE_MESH_TRIM_THRESHOLD_M = 10
+from . import _relatorio_worker
 
+_ROUTE_MESH_TRIM_THRESHOLD_M = 10
+# Corridas em voo por worker no modo --workers: limita a memória (linhas prontas esperando a ordem).
+_JANELA_POR_WORKER = 4
+# Corridas por consulta de pings: um OR de (motorista, janela) por corrida, bem abaixo do limite de
+# parâmetros do SQLite.
+_LOTE_PINGS = 200
 
 class Command(BaseCommand):
     help = "Gera um relatório detalhado (CSV) das corridas concluídas."
@@ -43,7 +53,17 @@ class Command(BaseCommand):
         parser.add_argument(
             "--plot-dir",
             dest="plot_dir",
-            help="Se informado, salva um SVG por corrida com o trajeto do motorista (pings entre início e fim).",
+            help="Se informado, salva um SVG (ou PNG, ver --plot-formato) por corrida com o trajeto do motorista (pings entre início e fim).",
+        )
+        parser.add_argument(
+            "--plot-formato",
+            dest="plot_formato",
+            choices=("svg", "png"),
+            default="svg",
+            help=(
+                "Formato dos trajetos do --plot-dir: svg ou png (raster, bem menor que o SVG com tiles embutidas; "
+                "requer Pillow). O caminho vai na coluna trajeto_svg nos dois casos. Padrão: svg."
+            ),
         )
         parser.add_argument(
             "--tile-dir",
@@ -57,6 +77,35 @@ class Command(BaseCommand):
             default=16,
             help="Zoom das tiles a serem usadas (padrão: 16).",
         )
+        parser.add_argument(
+            "--tile-modo",
+            dest="tile_modo",
+            choices=MODOS_TILE,
+            help=(
+                "embed: tiles em base64 dentro do SVG; href: só a URL da tile (SVG bem menor, exige acesso às "
+                "tiles). Padrão: TILE_SVG_MODO."
+            ),
+        )
+        parser.add_argument(
+            "--tile-href-base",
+            dest="tile_href_base",
+            help="Base das URLs no modo href (ex: https://site/static/landing/assets/tiles). Padrão: file:// do --tile-dir.",
+        )
+        parser.add_argument(
+            "--tile-b64-dir",
+            dest="tile_b64_dir",
+            help="Depósito de tiles já codificadas em base64 (z/x/y.b64), reaproveitado entre execuções. Padrão: TILE_B64_DIR.",
+        )
+        parser.add_argument(
+            "--workers",
+            dest="workers",
+            type=int,
+            default=1,
+            help=(
+                "Processos para montar as linhas (pings, rota e SVG) em paralelo; o CSV sai na mesma ordem "
+                "(padrão: 1)."
+            ),
+        )
 
     def handle(self, *args, **options):
         inicio = self._parse_datetime_arg(options.get("inicio"), is_end=False) if options.get("inicio") else None
@@ -69,15 +118,25 @@ class Command(BaseCommand):
             plot_path = (Path(settings.BASE_DIR) / plot_path).resolve()
         if plot_path:
             plot_path.mkdir(parents=True, exist_ok=True)
+        plot_formato = options.get("plot_formato") or "svg"
+        if plot_path and plot_formato == "png":
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                raise CommandError("--plot-formato png requer Pillow (pip install pillow).")
         tile_root = self._resolve_tile_root(options.get("tile_dir"))
         tile_zoom = int(options.get("tile_zoom") or 16)
+        tiles = None
+        if tile_root:
+            b64_dir = options.get("tile_b64_dir")
+            tiles = TileAssets.padrao(
+                tile_root,
+                modo=options.get("tile_modo"),
+                href_base=options.get("tile_href_base"),
+                b64_dir=Path(b64_dir).expanduser() if b64_dir else None,
+            )
 
-        queryset = Corrida.objects.filter(status="concluida").select_related(
-            "cliente__user",
-            "motorista__user",
-            "cliente__user__contato",
-            "motorista__user__contato",
-        )
+        queryset = self._corridas_concluidas()
         if inicio:
             queryset = queryset.filter(criado_em__gte=inicio)
         if fim:
@@ -86,7 +145,15 @@ class Command(BaseCommand):
         if limite:
             queryset = queryset[:limite]
 
-        exportados, duracao_media = self._exportar_csv(queryset, output_path, plot_path, tile_root, tile_zoom)
+        exportados, duracao_media = self._exportar_csv(
+            queryset,
+            output_path,
+            plot_path,
+            tiles,
+            tile_zoom,
+            max(1, int(options.get("workers") or 1)),
+            plot_formato=plot_formato,
+        )
         if exportados == 0:
             self.stdout.write(self.style.WARNING("Nenhuma corrida concluída encontrada para os filtros informados."))
             return
@@ -96,6 +163,14 @@ class Command(BaseCommand):
             resumo += f" | duração média: {duracao_media:.2f} min"
         self.stdout.write(self.style.SUCCESS(resumo))
 
+    def _corridas_concluidas(self):
+        return Corrida.objects.filter(status="concluida").select_related(
+            "cliente__user",
+            "motorista__user",
+            "cliente__user__contato",
+            "motorista__user__contato",
+        )
+
     def _parse_datetime_arg(self, valor: str, is_end: bool = False) -> datetime:
         dt = parse_datetime(valor)
         if dt is None:
@@ -143,14 +218,6 @@ class Command(BaseCommand):
             return None
         return (fim - inicio).total_seconds() / 60
 
-    def _latlng_to_pixel(self, lat: float, lng: float, zoom: int) -> tuple[float, float]:
-        lat = max(min(lat, 85.05112878), -85.05112878)
-        n = 2**zoom
-        x = (lng + 180.0) / 360.0
-        lat_rad = math.radians(lat)
-        y = (1 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2
-        return x * n * 256, y * n * 256
-
     def _coord_from_decimal(self, lat, lng):
         if lat is None or lng is None:
             return None
@@ -228,24 +295,94 @@ class Command(BaseCommand):
             return root
         return None
 
-    def _pings_da_corrida(self, corrida: Corrida):
+    def _janela_pings(self, corrida: Corrida):
         if not corrida.motorista_id:
-            return []
+            return None
         inicio = corrida.iniciada_em or corrida.aceita_em or corrida.criado_em
         fim = corrida.concluida_em or corrida.atualizado_em
         if not inicio or not fim:
+            return None
+        return inicio, fim
+
+    def _pings_da_corrida(self, corrida: Corrida):
+        janela = self._janela_pings(corrida)
+        if not janela:
             return []
         return list(
             LocalizacaoPing.objects.filter(
                 perfil_id=corrida.motorista_id,
-                criado_em__gte=inicio,
-                criado_em__lte=fim,
+                criado_em__gte=janela[0],
+                criado_em__lte=janela[1],
             )
-            .order_by("criado_em")
+            .order_by("criado_em", "id")
             .values_list("latitude", "longitude", "criado_em")
         )
 
-    def _gerar_svg_trajeto(self, corrida: Corrida, pings, plot_dir: Path | None, tile_root: Path | None, tile_zoom: int):
+    def _pings_em_lote(self, corridas: list[Corrida]) -> dict[int, list]:
+        """
+        Pings de um lote de corridas numa consulta só (OR das janelas motorista/intervalo), ordenada por
+        motorista e horário e repartida num merge: cada ping vai para as corridas cuja janela o contém.
+        O resultado por corrida é o mesmo de _pings_da_corrida.
+        """
+        resultado: dict[int, list] = {corrida.id: [] for corrida in corridas}
+        filtro = Q()
+        por_motorista: dict[int, list] = defaultdict(list)
+        for corrida in corridas:
+            janela = self._janela_pings(corrida)
+            if not janela:
+                continue
+            filtro |= Q(perfil_id=corrida.motorista_id, criado_em__gte=janela[0], criado_em__lte=janela[1])
+            por_motorista[corrida.motorista_id].append((janela[0], janela[1], corrida.id))
+        if not por_motorista:
+            return resultado
+        for janelas in por_motorista.values():
+            janelas.sort(key=lambda janela: janela[0])
+
+        pings = (
+            LocalizacaoPing.objects.filter(filtro)
+            .order_by("perfil_id", "criado_em", "id")
+            .values_list("perfil_id", "latitude", "longitude", "criado_em")
+        )
+        motorista_atual = None
+        pendentes: deque = deque()
+        abertas: list = []
+        for perfil_id, lat, lng, criado_em in pings.iterator():
+            if perfil_id != motorista_atual:
+                motorista_atual = perfil_id
+                pendentes = deque(por_motorista[perfil_id])
+                abertas = []
+            while pendentes and pendentes[0][0] <= criado_em:
+                abertas.append(pendentes.popleft())
+            if any(janela[1] < criado_em for janela in abertas):
+                abertas = [janela for janela in abertas if janela[1] >= criado_em]
+            for _, _, corrida_id in abertas:
+                resultado[corrida_id].append((lat, lng, criado_em))
+        return resultado
+
+    def _corridas_com_pings(self, queryset):
+        lote: list[Corrida] = []
+        for corrida in queryset.iterator(chunk_size=_LOTE_PINGS):
+            lote.append(corrida)
+            if len(lote) >= _LOTE_PINGS:
+                yield from self._com_pings(lote)
+                lote = []
+        if lote:
+            yield from self._com_pings(lote)
+
+    def _com_pings(self, lote: list[Corrida]):
+        pings = self._pings_em_lote(lote)
+        for corrida in lote:
+            yield corrida, pings[corrida.id]
+
+    def _gerar_trajeto(
+        self,
+        corrida: Corrida,
+        pings,
+        plot_dir: Path | None,
+        tiles: TileAssets | None,
+        tile_zoom: int,
+        plot_formato: str = "svg",
+    ):
         if not plot_dir or not pings:
             return None
 
@@ -262,92 +399,32 @@ class Command(BaseCommand):
         if len(route_points) < 2:
             route_points = list(zip(lats, lngs))
 
-        # Converte para pixels globais no esquema WebMercator para alinhar com tiles.
-        pixels = [self._latlng_to_pixel(lat, lng, tile_zoom) for lat, lng in route_points]
-        px_vals = [p[0] for p in pixels]
-        py_vals = [p[1] for p in pixels]
-        if not px_vals or not py_vals:
-            return None
-
-        n_tiles = 2**tile_zoom
-        margin_tiles = 1
-        tile_min_x = max(0, int(math.floor(min(px_vals) / 256)) - margin_tiles)
-        tile_max_x = min(n_tiles - 1, int(math.floor(max(px_vals) / 256)) + margin_tiles)
-        tile_min_y = max(0, int(math.floor(min(py_vals) / 256)) - margin_tiles)
-        tile_max_y = min(n_tiles - 1, int(math.floor(max(py_vals) / 256)) + margin_tiles)
-
-        width = (tile_max_x - tile_min_x + 1) * 256
-        height = (tile_max_y - tile_min_y + 1) * 256
-        offset_x = tile_min_x * 256
-        offset_y = tile_min_y * 256
-
-        coords = []
-        for px, py in pixels:
-            coords.append((px - offset_x, py - offset_y))
-        path_data = " ".join(f"{x:.2f},{y:.2f}" for x, y in coords)
-        route_path = path_data
         inicio_txt = times[0].isoformat() if times else ""
         fim_txt = times[-1].isoformat() if times else ""
-
-        # Monta background com tiles locais (se existirem).
-        images_svg = []
-        if tile_root:
-            for tile_x in range(tile_min_x, tile_max_x + 1):
-                for tile_y in range(tile_min_y, tile_max_y + 1):
-                    tile_path = tile_root / str(tile_zoom) / str(tile_x) / f"{tile_y}.png"
-                    if not tile_path.exists():
-                        continue
-                    try:
-                        data = tile_path.read_bytes()
-                    except OSError:
-                        continue
-                    encoded = base64.b64encode(data).decode("ascii")
-                    href = f"data:image/png;base64,{encoded}"
-                    x = (tile_x - tile_min_x) * 256
-                    y = (tile_y - tile_min_y) * 256
-                    images_svg.append(
-                        f'<image href="{href}" x="{x}" y="{y}" width="256" height="256" preserveAspectRatio="none" />'
-                    )
-
-        svg = [
-            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">',
-            '<rect width="100%" height="100%" fill="#f8fafc" />',
-        ]
-        svg.extend(images_svg)
-
-        _, roads, _ = geo_views._load_road_graph()
-        road_paths: list[str] = []
-        if isinstance(roads, list):
-            for road in roads:
-                points = road.get("points") or []
-                coords_pixels: list[tuple[float, float]] = []
-                for lat, lng in points:
-                    px, py = self._latlng_to_pixel(float(lat), float(lng), tile_zoom)
-                    coords_pixels.append((px - offset_x, py - offset_y))
-                if len(coords_pixels) < 2:
-                    continue
-                if not any(0 <= px <= width and 0 <= py <= height for px, py in coords_pixels):
-                    continue
-                path_data = " ".join(f"{x:.2f},{y:.2f}" for x, y in coords_pixels)
-                color = road.get("color") or "#94a3b8"
-                road_paths.append(
-                    f'<polyline points="{path_data}" fill="none" stroke="{color}" stroke-width="1" stroke-linejoin="round" stroke-linecap="round" stroke-opacity="0.5" />'
-                )
-        svg.extend(road_paths)
-        svg.append(f'<polyline points="{route_path}" fill="none" stroke="#0f172a" stroke-width="2" stroke-linejoin="round" stroke-linecap="round" />')
-        svg.append(f'<circle cx="{coords[0][0]:.2f}" cy="{coords[0][1]:.2f}" r="5" fill="#22c55e" stroke="#14532d" />')
-        svg.append(f'<circle cx="{coords[-1][0]:.2f}" cy="{coords[-1][1]:.2f}" r="5" fill="#ef4444" stroke="#7f1d1d" />')
-        svg.append(f'<text x="12" y="{height - 20}" font-size="12" fill="#334155" font-family="sans-serif">Início: {inicio_txt}</text>')
-        svg.append(f'<text x="12" y="{height - 6}" font-size="12" fill="#334155" font-family="sans-serif">Fim: {fim_txt}</text>')
-        svg.append("</svg>")
+        legenda = (f"Início: {inicio_txt}", f"Fim: {fim_txt}")
+        if plot_formato == "png":
+            destino = plot_dir / f"corrida_{corrida.id}_trajeto.png"
+            return png_trajeto(route_points, tile_zoom, tiles, destino, legenda=legenda)
+        svg = svg_trajeto(route_points, tile_zoom, tiles, legenda=legenda)
+        if svg is None:
+            return None
 
         destino = plot_dir / f"corrida_{corrida.id}_trajeto.svg"
-        destino.write_text("\n".join(svg), encoding="utf-8")
+        destino.write_text(svg, encoding="utf-8")
         return destino
 
-    def _linha_corrida(self, corrida: Corrida, plot_dir: Path | None, tile_root: Path | None, tile_zoom: int):
-        pings = self._pings_da_corrida(corrida)
-        trajeto_svg = self._gerar_svg_trajeto(corrida, pings, plot_dir, tile_root, tile_zoom)
+    def _linha_corrida(
+        self,
+        corrida: Corrida,
+        plot_dir: Path | None,
+        tiles: TileAssets | None,
+        tile_zoom: int,
+        pings=None,
+        plot_formato: str = "svg",
+    ):
+        if pings is None:
+            pings = self._pings_da_corrida(corrida)
+        trajeto_svg = self._gerar_trajeto(corrida, pings, plot_dir, tiles, tile_zoom, plot_formato)
         concluida_em = corrida.concluida_em or corrida.atualizado_em
         duracao_min = self._diff_minutes(corrida.criado_em, concluida_em)
         tempo_ate_aceite = self._diff_minutes(corrida.criado_em, corrida.aceita_em)
@@ -389,7 +466,53 @@ class Command(BaseCommand):
         }
         return linha, duracao_min
 
-    def _exportar_csv(self, queryset, output_path: Path, plot_dir: Path | None, tile_root: Path | None, tile_zoom: int) -> tuple[int, float | None]:
+    def _linhas(
+        self,
+        queryset,
+        plot_dir: Path | None,
+        tiles: TileAssets | None,
+        tile_zoom: int,
+        workers: int,
+        plot_formato: str = "svg",
+    ):
+        if workers <= 1:
+            for corrida, pings in self._corridas_com_pings(queryset):
+                yield self._linha_corrida(corrida, plot_dir, tiles, tile_zoom, pings=pings, plot_formato=plot_formato)
+            return
+        # Os filhos (fork) não podem herdar a conexão aberta do pai; cada um abre a sua.
+        connections.close_all()
+        # fork onde existe (Linux); no Windows só há spawn, e o initializer configura o Django no filho.
+        metodo = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(metodo),
+            initializer=_relatorio_worker.iniciar,
+            initargs=(settings.SETTINGS_MODULE,),
+        ) as pool:
+            # O primeiro submit cria todos os processos: faz isso antes de abrir o cursor da consulta.
+            pool.submit(int).result()
+            # Janela deslizante: no máximo workers × _JANELA_POR_WORKER corridas em voo; as linhas
+            # saem na ordem da consulta, esperando a mais antiga.
+            em_voo = deque()
+            for corrida, pings in self._corridas_com_pings(queryset):
+                em_voo.append(
+                    pool.submit(_relatorio_worker.linha_corrida, corrida, pings, plot_dir, tiles, tile_zoom, plot_formato)
+                )
+                if len(em_voo) >= workers * _JANELA_POR_WORKER:
+                    yield em_voo.popleft().result()
+            while em_voo:
+                yield em_voo.popleft().result()
+
+    def _exportar_csv(
+        self,
+        queryset,
+        output_path: Path,
+        plot_dir: Path | None,
+        tiles: TileAssets | None,
+        tile_zoom: int,
+        workers: int = 1,
+        plot_formato: str = "svg",
+    ) -> tuple[int, float | None]:
         fieldnames = [
             "corrida_id",
             "status",
@@ -425,8 +548,7 @@ class Command(BaseCommand):
         with output_path.open("w", newline="", encoding="utf-8") as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
-            for corrida in queryset.iterator():
-                linha, duracao_min = self._linha_corrida(corrida, plot_dir, tile_root, tile_zoom)
+            for linha, duracao_min in self._linhas(queryset, plot_dir, tiles, tile_zoom, workers, plot_formato):
                 writer.writerow(linha)
                 total += 1
                 if duracao_min is not None:
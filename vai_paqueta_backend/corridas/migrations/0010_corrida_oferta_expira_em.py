@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def preencher_prazo_oferta(apps, schema_editor):
+    # Ofertas pendentes herdam o prazo antigo (atualizado_em + 2 minutos) para a varredura assumir.
+    Corrida = apps.get_model("corridas", "Corrida")
+    pendentes = Corrida.objects.filter(status="aguardando", motorista__isnull=False)
+    for corrida in pendentes.only("id", "atualizado_em"):
+        Corrida.objects.filter(pk=corrida.pk).update(oferta_expira_em=corrida.atualizado_em + timedelta(minutes=2))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corridas', '0009_localizacaoping_bearing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='corrida',
+            name='oferta_expira_em',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='Prazo para o motorista aceitar a corrida oferecida (usado pela varredura de expiração).', null=True),
+        ),
+        migrations.RunPython(preencher_prazo_oferta, migrations.RunPython.noop),
+    ]
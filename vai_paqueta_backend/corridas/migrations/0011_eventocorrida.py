@@ -0,0 +1,47 @@
+# Generated by Django 5.0.6 on 2026-10-19 02:20
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corridas', '0010_corrida_oferta_expira_em'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FcmDeviceToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.TextField(unique=True)),
+                ('plataforma', models.CharField(blank=True, max_length=50)),
+                ('ativo', models.BooleanField(default=True)),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+                ('perfil', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fcm_tokens', to='corridas.perfil')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EventoCorrida',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('canal', models.CharField(choices=[('ws', 'WebSocket'), ('fcm', 'Push (FCM)')], default='ws', max_length=10)),
+                ('tipo', models.CharField(max_length=40)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('grupos', models.JSONField(blank=True, default=list)),
+                ('tentativas', models.PositiveIntegerField(default=0)),
+                ('disponivel_em', models.DateTimeField(default=django.utils.timezone.now, help_text='Próxima tentativa; enquanto um publicador trabalha no evento, marca o fim da reserva.')),
+                ('publicado_em', models.DateTimeField(blank=True, null=True)),
+                ('erro', models.TextField(blank=True)),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('corrida', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='eventos', to='corridas.corrida')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['publicado_em', 'id'], name='evento_pendente_idx')],
+            },
+        ),
+    ]
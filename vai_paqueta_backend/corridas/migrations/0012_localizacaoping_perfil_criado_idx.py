@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-19 03:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corridas', '0011_eventocorrida'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='localizacaoping',
+            index=models.Index(fields=['perfil', 'criado_em'], name='ping_perfil_criado_idx'),
+        ),
+    ]
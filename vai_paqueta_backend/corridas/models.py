@@ -1,7 +1,12 @@
 import uuid
+from datetime import timedelta
+
 from django.conf import settings
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.utils import timezone
+
+from .constants import OFERTA_MAX_AGE_MINUTES
 
 
 class UserContato(models.Model):
@@ -73,10 +78,29 @@ class Corrida(models.Model):
     criado_em = models.DateTimeField(auto_now_add=True)
     atualizado_em = models.DateTimeField(auto_now=True)
     motoristas_tentados = models.JSONField(default=list, blank=True)
+    oferta_expira_em = models.DateTimeField(
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text="Prazo para o motorista aceitar a corrida oferecida (usado pela varredura de expiração).",
+    )
 
     def __str__(self):
         return f"Corrida {self.id} - {self.status}"
 
+    def prazo_oferta(self):
+        if self.status == "aguardando" and self.motorista_id:
+            return timezone.now() + timedelta(minutes=OFERTA_MAX_AGE_MINUTES)
+        return None
+
+    def save(self, *args, **kwargs):
+        # O prazo acompanha atualizado_em: qualquer gravação renova (ou limpa) a oferta pendente.
+        self.oferta_expira_em = self.prazo_oferta()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "oferta_expira_em" not in update_fields:
+            kwargs["update_fields"] = [*update_fields, "oferta_expira_em"]
+        super().save(*args, **kwargs)
+
 
 class LocalizacaoPing(models.Model):
     perfil = models.ForeignKey(Perfil, related_name="pings", on_delete=models.CASCADE)
@@ -86,6 +110,10 @@ class LocalizacaoPing(models.Model):
     bearing = models.FloatField(null=True, blank=True, help_text="Direção da bússola em graus (0-360).")
     criado_em = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Janela de pings de um motorista (relatório): faixa em criado_em dentro do perfil.
+        indexes = [models.Index(fields=["perfil", "criado_em"], name="ping_perfil_criado_idx")]
+
     def __str__(self):
         return f"Ping {self.perfil_id} ({self.latitude}, {self.longitude})"
 
@@ -100,3 +128,39 @@ class FcmDeviceToken(models.Model):
 
     def __str__(self):
         return f"FCM {self.perfil_id} ({self.plataforma})"
+
+
+class EventoCorrida(models.Model):
+    """
+    Outbox de eventos de corrida: gravado na mesma transação da mudança de estado e publicado
+    depois (WebSocket ou FCM) por corridas.outbox.publicar_eventos, em ordem por corrida.
+    """
+
+    CANAL_WS = "ws"
+    CANAL_FCM = "fcm"
+    CANAL_CHOICES = [
+        (CANAL_WS, "WebSocket"),
+        (CANAL_FCM, "Push (FCM)"),
+    ]
+
+    corrida = models.ForeignKey(Corrida, related_name="eventos", on_delete=models.CASCADE)
+    canal = models.CharField(max_length=10, choices=CANAL_CHOICES, default=CANAL_WS)
+    tipo = models.CharField(max_length=40)
+    payload = models.JSONField(default=dict, blank=True)
+    grupos = models.JSONField(default=list, blank=True)
+    tentativas = models.PositiveIntegerField(default=0)
+    disponivel_em = models.DateTimeField(
+        default=timezone.now,
+        help_text="Próxima tentativa; enquanto um publicador trabalha no evento, marca o fim da reserva.",
+    )
+    publicado_em = models.DateTimeField(null=True, blank=True)
+    erro = models.TextField(blank=True)
+    criado_em = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [models.Index(fields=["publicado_em", "id"], name="evento_pendente_idx")]
+
+    def __str__(self):
+        return f"Evento {self.tipo} ({self.canal}) - corrida {self.corrida_id}"
+
@@ -0,0 +1,360 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import Callable, Iterable, Optional
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import replay
+from .models import Corrida, EventoCorrida
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_MAX_SEGUNDOS = 300
+_CHAVE_VARREDURA = "corridas:varredura"
+
+
+def _config(nome: str, padrao):
+    return getattr(settings, nome, padrao)
+
+
+async def enviar_grupos(channel_layer, groups: list[str], message: dict) -> None:
+    # Um único salto assíncrono para todos os grupos; falha em um grupo não impede os demais.
+    resultados = await asyncio.gather(
+        *(channel_layer.group_send(group, message) for group in groups),
+        return_exceptions=True,
+    )
+    for resultado in resultados:
+        if isinstance(resultado, BaseException):
+            raise resultado
+
+
+def registrar_evento(
+    corrida: Corrida,
+    tipo: str,
+    payload: dict,
+    grupos: Iterable[str] = (),
+    canal: str = EventoCorrida.CANAL_WS,
+    disponivel_em=None,
+) -> EventoCorrida:
+    """
+    Grava o evento na transação corrente e pede a publicação logo após o commit.
+    Com `disponivel_em` o evento só sai a partir desse instante (envio adiado).
+    """
+    evento = EventoCorrida.objects.create(
+        corrida=corrida,
+        canal=canal,
+        tipo=tipo,
+        payload=payload,
+        grupos=list(dict.fromkeys(grupos)),
+        disponivel_em=disponivel_em or timezone.now(),
+    )
+    transaction.on_commit(lambda: _publicar_apos_commit(canal))
+    return evento
+
+
+def _publicar_apos_commit(canal: str) -> None:
+    if canal == EventoCorrida.CANAL_FCM:
+        # Push pode levar segundos (timeouts e novas tentativas): nunca no request nem na thread do tempo real.
+        publicador_fcm.acordar()
+        return
+    if isinstance(get_channel_layer(), InMemoryChannelLayer):
+        # As filas em memória pertencem ao loop do servidor ASGI: publica daqui mesmo (ambiente de dev).
+        publicar_eventos(canal=EventoCorrida.CANAL_WS)
+        return
+    publicador.acordar()
+
+
+def _reservar(limite: int, canal: Optional[str] = None) -> list[EventoCorrida]:
+    """
+    Escolhe os próximos eventos respeitando a ordem por (corrida, canal): um evento só sai se
+    nenhum anterior da mesma corrida/canal estiver em espera (backoff) ou reservado por outro
+    publicador. Os escolhidos ficam reservados por OUTBOX_LEASE_SECONDS.
+    """
+    agora = timezone.now()
+    max_tentativas = int(_config("OUTBOX_MAX_TENTATIVAS", 8))
+    with transaction.atomic():
+        pendentes = EventoCorrida.objects.select_for_update().filter(
+            publicado_em__isnull=True, tentativas__lt=max_tentativas
+        )
+        if canal:
+            pendentes = pendentes.filter(canal=canal)
+        pendentes = pendentes.order_by("id")[: limite * 5]
+        bloqueadas: set[tuple[int, str]] = set()
+        escolhidos: list[EventoCorrida] = []
+        for evento in pendentes:
+            chave = (evento.corrida_id, evento.canal)
+            if chave in bloqueadas:
+                continue
+            if evento.disponivel_em > agora:
+                bloqueadas.add(chave)
+                continue
+            escolhidos.append(evento)
+            if len(escolhidos) >= limite:
+                break
+        if escolhidos:
+            lease = timedelta(seconds=float(_config("OUTBOX_LEASE_SECONDS", 30)))
+            EventoCorrida.objects.filter(pk__in=[evento.pk for evento in escolhidos]).update(
+                disponivel_em=agora + lease
+            )
+    return escolhidos
+
+
+def _com_seq(evento: EventoCorrida) -> dict:
+    # O id do evento serve de número de sequência: cresce dentro de cada corrida.
+    return {**evento.payload, "seq": evento.pk}
+
+
+async def _publicar_ws(channel_layer, cadeias: dict[int, list[EventoCorrida]]) -> dict[int, Optional[BaseException]]:
+    """
+    Cada corrida é uma cadeia sequencial (mantém a ordem); as corridas andam em paralelo.
+    Na primeira falha a cadeia para e os eventos seguintes ficam sem resultado.
+    """
+    resultados: dict[int, Optional[BaseException]] = {}
+
+    async def _cadeia(eventos: list[EventoCorrida]) -> None:
+        for evento in eventos:
+            message = {"type": "corrida.event", "event": _com_seq(evento)}
+            try:
+                await enviar_grupos(channel_layer, evento.grupos, message)
+            except Exception as exc:
+                resultados[evento.pk] = exc
+                return
+            resultados[evento.pk] = None
+
+    await asyncio.gather(*(_cadeia(eventos) for eventos in cadeias.values()))
+    return resultados
+
+
+def _publicar_fcm(evento: EventoCorrida) -> None:
+    if evento.tipo == "ride_available":
+        from .tasks import notificar_sem_motoristas
+
+        resultado = notificar_sem_motoristas(evento.corrida_id)
+        if resultado.get("detail") == "erro_envio":
+            raise RuntimeError(resultado.get("error") or "erro_envio")
+        return
+    if evento.tipo == "ride_available_resumo":
+        from .tasks import notificar_resumo_corridas
+
+        resultado = notificar_resumo_corridas()
+        if resultado.get("detail") == "erro_envio":
+            raise RuntimeError(resultado.get("error") or "erro_envio")
+        return
+    raise ValueError(f"Evento FCM desconhecido: {evento.tipo}")
+
+
+def publicar_eventos(
+    limite: Optional[int] = None, executar: Optional[Callable] = None, canal: Optional[str] = None
+) -> dict:
+    """
+    Publica um lote do outbox (só do `canal`, se informado). `executar` roda a corrotina de envio
+    (padrão: async_to_sync); o publicador em segundo plano passa o run_until_complete do seu loop.
+    """
+    limite = limite or int(_config("OUTBOX_BATCH_SIZE", 100))
+    eventos = _reservar(limite, canal)
+    if not eventos:
+        return {"publicados": 0, "falhas": 0}
+
+    resultados: dict[int, Optional[BaseException]] = {}
+    cadeias_ws: dict[int, list[EventoCorrida]] = defaultdict(list)
+    for evento in eventos:
+        if evento.canal == EventoCorrida.CANAL_WS:
+            cadeias_ws[evento.corrida_id].append(evento)
+    if cadeias_ws:
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            for cadeia in cadeias_ws.values():
+                resultados.update(dict.fromkeys((evento.pk for evento in cadeia), None))
+        else:
+            if executar is None:
+                resultados.update(async_to_sync(_publicar_ws)(channel_layer, cadeias_ws))
+            else:
+                resultados.update(executar(_publicar_ws(channel_layer, cadeias_ws)))
+
+    corridas_com_falha_fcm: set[int] = set()
+    for evento in eventos:
+        if evento.canal != EventoCorrida.CANAL_FCM or evento.corrida_id in corridas_com_falha_fcm:
+            continue
+        try:
+            _publicar_fcm(evento)
+        except Exception as exc:
+            resultados[evento.pk] = exc
+            corridas_com_falha_fcm.add(evento.corrida_id)
+            continue
+        resultados[evento.pk] = None
+
+    agora = timezone.now()
+    publicados = [pk for pk, erro in resultados.items() if erro is None]
+    if publicados:
+        EventoCorrida.objects.filter(pk__in=publicados).update(publicado_em=agora, erro="")
+        _guardar_replay(
+            [evento for evento in eventos if evento.canal == EventoCorrida.CANAL_WS and evento.pk in publicados]
+        )
+    falhas = 0
+    nao_tentados = []
+    for evento in eventos:
+        if evento.pk not in resultados:
+            nao_tentados.append(evento.pk)
+            continue
+        erro = resultados[evento.pk]
+        if erro is None:
+            continue
+        falhas += 1
+        espera = min(2 ** evento.tentativas, BACKOFF_MAX_SEGUNDOS)
+        EventoCorrida.objects.filter(pk=evento.pk).update(
+            tentativas=evento.tentativas + 1,
+            disponivel_em=agora + timedelta(seconds=espera),
+            erro=str(erro)[:500],
+        )
+    if nao_tentados:
+        # Ficaram atrás de uma falha na mesma corrida: liberam a reserva e esperam o anterior.
+        EventoCorrida.objects.filter(pk__in=nao_tentados).update(disponivel_em=agora)
+    return {"publicados": len(publicados), "falhas": falhas}
+
+
+def _guardar_replay(eventos: list[EventoCorrida]) -> None:
+    por_corrida: dict[int, list[tuple[int, dict]]] = defaultdict(list)
+    for evento in eventos:
+        por_corrida[evento.corrida_id].append((evento.pk, _com_seq(evento)))
+    for corrida_id, itens in por_corrida.items():
+        try:
+            replay.guardar(corrida_id, itens)
+        except Exception:
+            # Sem buffer o cliente só perde o atalho: na reconexão cai no sync completo.
+            pass
+
+
+def limpar_eventos_publicados() -> int:
+    limite = timezone.now() - timedelta(hours=float(_config("OUTBOX_RETENCAO_HORAS", 24)))
+    apagados, _ = EventoCorrida.objects.filter(publicado_em__lt=limite).delete()
+    return apagados
+
+
+async def _enviar_diretos(diretos: list[tuple[object, list[str], dict]]) -> None:
+    await asyncio.gather(
+        *(enviar_grupos(layer, groups, message) for layer, groups, message in diretos),
+        return_exceptions=True,
+    )
+
+
+class _Publicador:
+    """
+    Thread daemon com um loop asyncio persistente que esvazia um canal do outbox logo após cada
+    commit (e a cada OUTBOX_DRAIN_SECONDS, para as novas tentativas). A do WebSocket também faz
+    envios diretos, sem outbox, para eventos efêmeros como a localização do motorista, e, nos
+    processos web (iniciar), a varredura de ofertas expiradas a cada RIDE_SWEEP_SECONDS, para
+    deploys sem beat. O push FCM tem a sua própria thread: um envio lento não atrasa o tempo real.
+    Recriada após fork (workers do Celery/gunicorn herdam o objeto, mas não a thread).
+    """
+
+    def __init__(self, canal: str, nome: str, varredura: bool = False):
+        self._canal = canal
+        self._nome = nome
+        self._varredura = varredura
+        self._lock = threading.Lock()
+        self._acordar = threading.Event()
+        self._pid: int | None = None
+        self._diretos: list[tuple[object, list[str], dict]] = []
+        self._outbox_pendente = False
+        self._varrer = False
+
+    def _garantir_thread(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._diretos = []
+            self._acordar = threading.Event()
+            threading.Thread(target=self._executar, name=self._nome, daemon=True).start()
+
+    def iniciar(self) -> None:
+        """
+        Sobe a thread na carga do servidor web (asgi/wsgi) e, com RIDE_SWEEP_NO_PROCESSO, liga a
+        varredura de ofertas expiradas neste processo, mesmo sem nenhum commit para acordá-la.
+        """
+        self._varrer = self._varredura and bool(_config("RIDE_SWEEP_NO_PROCESSO", False))
+        self._garantir_thread()
+        self._acordar.set()
+
+    def acordar(self) -> None:
+        self._garantir_thread()
+        with self._lock:
+            self._outbox_pendente = True
+        self._acordar.set()
+
+    def enviar(self, channel_layer, groups: list[str], message: dict) -> None:
+        self._garantir_thread()
+        with self._lock:
+            self._diretos.append((channel_layer, groups, message))
+        self._acordar.set()
+
+    def _executar(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        intervalo = float(_config("OUTBOX_DRAIN_SECONDS", 5.0))
+        intervalo_varredura = float(_config("RIDE_SWEEP_SECONDS", 5.0))
+        proxima_varredura = time.monotonic() + intervalo_varredura
+        while True:
+            espera = min(intervalo, intervalo_varredura) if self._varrer else intervalo
+            expirou = not self._acordar.wait(timeout=espera)
+            self._acordar.clear()
+            with self._lock:
+                diretos, self._diretos = self._diretos, []
+                drenar = self._outbox_pendente or expirou
+                self._outbox_pendente = False
+            if diretos:
+                loop.run_until_complete(_enviar_diretos(diretos))
+            if self._varrer and time.monotonic() >= proxima_varredura:
+                proxima_varredura = time.monotonic() + intervalo_varredura
+                _varrer_corridas(intervalo_varredura)
+            if not drenar:
+                continue
+            close_old_connections()
+            try:
+                while publicar_eventos(executar=loop.run_until_complete, canal=self._canal)["publicados"]:
+                    pass
+            except Exception:
+                # O lote volta para o outbox quando a reserva expira; tenta de novo no próximo ciclo.
+                pass
+            finally:
+                close_old_connections()
+
+
+def _varrer_corridas(intervalo: float) -> None:
+    # Com vários processos web, um só varre por intervalo (trava no cache compartilhado). Se o
+    # cache estiver fora, a trava não é confirmada e o processo varre assim mesmo.
+    if not cache.add(_CHAVE_VARREDURA, os.getpid(), timeout=max(1, int(intervalo))):
+        if cache.get(_CHAVE_VARREDURA) is not None:
+            return
+    from .dispatch import varrer_corridas
+
+    close_old_connections()
+    try:
+        varrer_corridas()
+    except Exception:
+        # Ofertas vencidas continuam vencidas; a próxima varredura tenta de novo.
+        logger.exception("Falha na varredura de corridas expiradas.")
+    finally:
+        close_old_connections()
+
+
+publicador = _Publicador(EventoCorrida.CANAL_WS, "outbox-corridas", varredura=True)
+publicador_fcm = _Publicador(EventoCorrida.CANAL_FCM, "outbox-push")
+
+
+def iniciar_publicadores() -> None:
+    """Sobe as threads do outbox na carga do servidor web (asgi/wsgi)."""
+    publicador.iniciar()
+    publicador_fcm.iniciar()
@@ -0,0 +1,16 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class CriadoEmCursorPagination(CursorPagination):
+    """
+    Paginação por cursor (keyset) em (criado_em, id), da mais recente para a mais antiga.
+    O custo de cada página não depende do tamanho do histórico.
+    """
+
+    ordering = ("-criado_em", "-id")
+    page_size_query_param = "page_size"
+
+    def __init__(self):
+        self.page_size = getattr(settings, "API_PAGE_SIZE", 50)
+        self.max_page_size = getattr(settings, "API_MAX_PAGE_SIZE", 200)
@@ -0,0 +1,153 @@
+"""
+Presença dos ecotaxistas: quem está com o app de motorista conectado ou mandou ping recentemente.
+
+O DriverConsumer marca o motorista no connect e a cada ping (WebSocket ou REST) e o retira no
+disconnect; cada marcação vale PRESENCE_TTL_SECONDS. "Há alguém online?" e "quantos?" viram uma
+consulta O(1) no registro em vez de varrer LocalizacaoPing.
+
+Com Redis (PRESENCE_BACKEND=redis) o registro é um sorted set compartilhado entre processos
+(score = instante em que a presença expira); sem Redis, fica na memória do processo.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .breaker import Disjuntor
+from .constants import PING_MAX_AGE_MINUTES
+from .models import LocalizacaoPing
+
+_CHAVE = "corridas:presenca:ecotaxistas"
+
+
+def _ttl() -> float:
+    return float(getattr(settings, "PRESENCE_TTL_SECONDS", PING_MAX_AGE_MINUTES * 60))
+
+
+class _PresencaLocal:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expira: dict[int, float] = {}
+        self._proxima_poda = 0.0
+
+    def marcar(self, perfil_id: int, ttl: float) -> None:
+        with self._lock:
+            self._expira[perfil_id] = time.monotonic() + ttl
+
+    def remover(self, perfil_id: int) -> None:
+        with self._lock:
+            self._expira.pop(perfil_id, None)
+
+    def contar(self) -> int:
+        agora = time.monotonic()
+        with self._lock:
+            # Poda no máximo uma vez por segundo; entre podas, expirados recentes ainda contam.
+            if agora >= self._proxima_poda:
+                self._expira = {pid: quando for pid, quando in self._expira.items() if quando > agora}
+                self._proxima_poda = agora + 1.0
+            return len(self._expira)
+
+
+class _PresencaRedis:
+    def __init__(self, url: str):
+        self._url = url
+        self._cliente = None
+        self._disjuntor = Disjuntor("presenca")
+
+    def _redis(self):
+        if self._cliente is None:
+            import redis
+
+            timeout = float(getattr(settings, "REDIS_TIMEOUT_SECONDS", 0.5))
+            self._cliente = redis.Redis.from_url(
+                self._url, socket_connect_timeout=timeout, socket_timeout=timeout
+            )
+        return self._cliente
+
+    def _executar(self, operacao):
+        # Disjuntor aberto: falha na hora e quem chama usa o caminho alternativo (banco ou nada).
+        if not self._disjuntor.permitir():
+            raise RuntimeError("Registro de presença indisponível.")
+        try:
+            resultado = operacao(self._redis())
+        except Exception:
+            self._disjuntor.falha()
+            raise
+        self._disjuntor.sucesso()
+        return resultado
+
+    def marcar(self, perfil_id: int, ttl: float) -> None:
+        def _marcar(cliente):
+            agora = time.time()
+            pipe = cliente.pipeline(transaction=False)
+            pipe.zadd(_CHAVE, {perfil_id: agora + ttl})
+            # Limpa quem expirou e deixa a chave sumir sozinha se ninguém mais marcar presença.
+            pipe.zremrangebyscore(_CHAVE, "-inf", agora)
+            pipe.expire(_CHAVE, int(ttl) + 1)
+            pipe.execute()
+
+        self._executar(_marcar)
+
+    def remover(self, perfil_id: int) -> None:
+        self._executar(lambda cliente: cliente.zrem(_CHAVE, perfil_id))
+
+    def contar(self) -> int:
+        return int(self._executar(lambda cliente: cliente.zcount(_CHAVE, f"({time.time()}", "+inf")))
+
+
+def _criar_registro():
+    backend = getattr(settings, "PRESENCE_BACKEND", "local")
+    if backend == "redis":
+        return _PresencaRedis(getattr(settings, "PRESENCE_REDIS_URL", settings.REDIS_URL))
+    return _PresencaLocal()
+
+
+_registro = None
+
+
+def _obter_registro():
+    global _registro
+    if _registro is None:
+        _registro = _criar_registro()
+    return _registro
+
+
+def marcar_online(perfil_id: int) -> None:
+    try:
+        _obter_registro().marcar(perfil_id, _ttl())
+    except Exception:
+        # Presença é auxiliar: falha no Redis não pode derrubar o ping.
+        pass
+
+
+def marcar_offline(perfil_id: int) -> None:
+    # Com duas conexões do mesmo motorista, fechar uma o tira do registro até o próximo ping da outra.
+    try:
+        _obter_registro().remover(perfil_id)
+    except Exception:
+        pass
+
+
+def contar_online() -> int:
+    return _obter_registro().contar()
+
+
+def ha_ping_recente() -> bool:
+    """
+    Checagem antiga, pela tabela de pings; custo cresce com o volume de LocalizacaoPing.
+    """
+    limite = timezone.now() - timedelta(minutes=PING_MAX_AGE_MINUTES)
+    return LocalizacaoPing.objects.filter(perfil__tipo="ecotaxista", criado_em__gte=limite).exists()
+
+
+def ha_ecotaxista_online() -> bool:
+    try:
+        return contar_online() > 0
+    except Exception:
+        # Registro indisponível: volta para a consulta nos pings recentes.
+        return ha_ping_recente()
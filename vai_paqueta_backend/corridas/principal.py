@@ -0,0 +1,98 @@
+"""
+Cache do principal autenticado (usuário + perfil) por user id, compartilhado entre a API (DRF) e os
+WebSockets (channels).
+
+Sem ele cada requisição consulta User na autenticação e Perfil de novo em cada view/consumer. Com o
+principal em cache, o perfil já vem anexado ao usuário (`user.perfil_app` não consulta o banco). A
+entrada vale PRINCIPAL_CACHE_SECONDS e é apagada a cada gravação de User ou Perfil (após o commit).
+
+O cache guarda só primitivos (ids, is_staff, tipo do perfil), nunca o objeto inteiro com o hash da
+senha. No acerto o User e o Perfil são remontados com esses campos e os demais adiados: ler, por exemplo,
+`user.email` consulta o banco como um campo de `.only()`, e `save()` grava só os campos carregados.
+"""
+
+from __future__ import annotations
+
+from typing import Callable
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import Perfil
+
+
+def _chave(user_id) -> str:
+    return f"auth:principal:{user_id}"
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "PRINCIPAL_CACHE_SECONDS", 60))
+
+
+def _principal(user, perfil: Perfil | None) -> tuple:
+    if perfil is None:
+        return (user.pk, user.is_staff, None, None)
+    return (user.pk, user.is_staff, perfil.pk, perfil.tipo)
+
+
+def _instancia_parcial(modelo, campos: dict):
+    # from_db espera os valores na ordem dos campos do modelo; os que faltam ficam adiados.
+    nomes = [campo.attname for campo in modelo._meta.concrete_fields if campo.attname in campos]
+    return modelo.from_db(router.db_for_read(modelo), nomes, [campos[nome] for nome in nomes])
+
+
+def _remontar(principal: tuple):
+    user_id, is_staff, perfil_id, tipo = principal
+    # Só usuários ativos entram no cache, e desativar grava o User (invalida a entrada).
+    user = _instancia_parcial(get_user_model(), {"id": user_id, "is_active": True, "is_staff": is_staff})
+    perfil = None
+    if perfil_id is not None:
+        perfil = _instancia_parcial(Perfil, {"id": perfil_id, "user_id": user_id, "tipo": tipo})
+    return _anexar_perfil(user, perfil)
+
+
+def _anexar_perfil(user, perfil: Perfil | None):
+    if perfil is not None:
+        # Atribuir o lado OneToOne também preenche o cache reverso user.perfil_app.
+        perfil.user = user
+    return user
+
+
+def usuario_do_token(validated_token, carregar: Callable):
+    """
+    Usuário do token (com o perfil anexado), do cache quando possível. `carregar` é o get_user
+    original da autenticação JWT: roda no cache miss e em qualquer caso que precise do erro dela.
+    """
+    user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+    # Com CHECK_REVOKE_TOKEN a checagem precisa do hash da senha, que não vai para o cache.
+    if user_id is None or api_settings.CHECK_REVOKE_TOKEN:
+        return carregar(validated_token)
+    principal = cache.get(_chave(user_id))
+    if principal is not None:
+        return _remontar(principal)
+    user = carregar(validated_token)
+    perfil = Perfil.objects.filter(user=user).first()
+    cache.set(_chave(user_id), _principal(user, perfil), _ttl())
+    return _anexar_perfil(user, perfil)
+
+
+def invalidar(user_id) -> None:
+    if user_id is not None:
+        transaction.on_commit(lambda: cache.delete(_chave(user_id)))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _invalidar_usuario(sender, instance, **kwargs):
+    invalidar(instance.pk)
+
+
+@receiver(post_save, sender=Perfil)
+@receiver(post_delete, sender=Perfil)
+def _invalidar_perfil(sender, instance: Perfil, **kwargs):
+    invalidar(instance.user_id)
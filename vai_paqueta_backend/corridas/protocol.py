@@ -0,0 +1,103 @@
+"""
+Subprotocolo binário opcional dos WebSockets de corrida (negociado via Sec-WebSocket-Protocol).
+
+Só os quadros de alta frequência são binários; o resto (eventos de corrida, subscribe, sync) segue
+em JSON como quadro de texto. Layout little-endian, coordenadas em micrograus (int32):
+
+- ping (app -> servidor):      B tipo=1 | i lat | i lng | f precisao_m | f bearing | I corrida_id
+- localização (servidor -> app): B tipo=2 | I corrida_id | i lat | i lng | f precisao_m | f bearing | Q ping_em (ms)
+- pong (servidor -> app):      B tipo=3
+
+Campos opcionais ausentes vão como NaN (floats) ou 0 (corrida_id).
+"""
+
+from __future__ import annotations
+
+import math
+import struct
+from datetime import datetime, timezone
+from typing import Optional
+
+SUBPROTOCOLO_BINARIO = "vaipaqueta.bin.v1"
+
+TIPO_PING = 1
+TIPO_LOCALIZACAO = 2
+TIPO_PONG = 3
+
+_PING = struct.Struct("<BiiffI")
+_LOCALIZACAO = struct.Struct("<BIiiffQ")
+PONG = bytes([TIPO_PONG])
+
+_MICRO = 1_000_000
+
+
+def _opcional(valor: Optional[float]) -> float:
+    return math.nan if valor is None else float(valor)
+
+
+def _de_opcional(valor: float) -> Optional[float]:
+    return None if math.isnan(valor) else valor
+
+
+def codificar_ping(
+    lat: float,
+    lng: float,
+    precisao_m: Optional[float] = None,
+    bearing: Optional[float] = None,
+    corrida_id: Optional[int] = None,
+) -> bytes:
+    return _PING.pack(
+        TIPO_PING,
+        round(lat * _MICRO),
+        round(lng * _MICRO),
+        _opcional(precisao_m),
+        _opcional(bearing),
+        corrida_id or 0,
+    )
+
+
+def decodificar_ping(dados: bytes) -> Optional[dict]:
+    if len(dados) != _PING.size or dados[0] != TIPO_PING:
+        return None
+    _, lat, lng, precisao_m, bearing, corrida_id = _PING.unpack(dados)
+    return {
+        "latitude": lat / _MICRO,
+        "longitude": lng / _MICRO,
+        "precisao_m": _de_opcional(precisao_m),
+        "bearing": _de_opcional(bearing),
+        "corrida_id": corrida_id or None,
+    }
+
+
+def codificar_localizacao(payload: dict) -> bytes:
+    """
+    Quadro binário equivalente ao payload JSON "driver_location" de realtime.notify_driver_location.
+    """
+    ping_em = payload.get("ping_em")
+    if isinstance(ping_em, str):
+        ping_em = datetime.fromisoformat(ping_em)
+    ms = int(ping_em.timestamp() * 1000) if ping_em else 0
+    return _LOCALIZACAO.pack(
+        TIPO_LOCALIZACAO,
+        payload.get("corrida_id") or 0,
+        round(float(payload["latitude"]) * _MICRO),
+        round(float(payload["longitude"]) * _MICRO),
+        _opcional(payload.get("precisao_m")),
+        _opcional(payload.get("bearing")),
+        ms,
+    )
+
+
+def decodificar_localizacao(dados: bytes) -> Optional[dict]:
+    if len(dados) != _LOCALIZACAO.size or dados[0] != TIPO_LOCALIZACAO:
+        return None
+    _, corrida_id, lat, lng, precisao_m, bearing, ms = _LOCALIZACAO.unpack(dados)
+    return {
+        "type": "driver_location",
+        "corrida_id": corrida_id or None,
+        "latitude": lat / _MICRO,
+        "longitude": lng / _MICRO,
+        "precisao_m": _de_opcional(precisao_m),
+        "bearing": _de_opcional(bearing),
+        "ping_em": datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat() if ms else None,
+    }
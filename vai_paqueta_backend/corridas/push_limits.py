@@ -0,0 +1,109 @@
+"""
+Coalescência e limite de taxa dos pushes de "corrida disponível", por motorista.
+
+Numa rajada de pedidos (chegada da barca), cada corrida sem motorista online avisaria todos os
+ecotaxistas de novo. Aqui o primeiro aviso abre uma janela de PUSH_JANELA_SECONDS para o motorista: as
+corridas seguintes dentro dela só somam um contador, entregue depois num resumo ("3 novas corridas"). Um
+balde de fichas por motorista (PUSH_BALDE_CAPACIDADE fichas, uma nova a cada PUSH_BALDE_RECARGA_SECONDS)
+limita o total de pushes. O estado fica no cache do Django (Redis em produção, memória local em dev), com
+get_many/set_many para não fazer uma ida ao cache por motorista.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def _config(nome: str, padrao):
+    return getattr(settings, nome, padrao)
+
+
+def janela_segundos() -> int:
+    return int(_config("PUSH_JANELA_SECONDS", 30))
+
+
+def _chave_janela(perfil_id: int) -> str:
+    return f"push:janela:{perfil_id}"
+
+
+def _chave_pendentes(perfil_id: int) -> str:
+    return f"push:pendentes:{perfil_id}"
+
+
+def _chave_balde(perfil_id: int) -> str:
+    return f"push:balde:{perfil_id}"
+
+
+def _consumir_fichas(perfil_ids: list[int]) -> set[int]:
+    """Tira uma ficha do balde de cada motorista; devolve quem tinha ficha."""
+    capacidade = float(_config("PUSH_BALDE_CAPACIDADE", 3))
+    if capacidade <= 0 or not perfil_ids:
+        return set(perfil_ids)
+    recarga = max(0.001, float(_config("PUSH_BALDE_RECARGA_SECONDS", 60)))
+    agora = time.time()
+    chaves = {_chave_balde(perfil_id): perfil_id for perfil_id in perfil_ids}
+    estados = cache.get_many(list(chaves))
+    liberados: set[int] = set()
+    novos = {}
+    for chave, perfil_id in chaves.items():
+        fichas, desde = estados.get(chave, (capacidade, agora))
+        fichas = min(capacidade, fichas + (agora - desde) / recarga)
+        if fichas >= 1:
+            fichas -= 1
+            liberados.add(perfil_id)
+        novos[chave] = (fichas, agora)
+    # Depois de capacidade × recarga o balde está cheio de novo: a chave pode expirar.
+    cache.set_many(novos, timeout=int(capacidade * recarga) + 1)
+    return liberados
+
+
+def separar_envios(perfil_ids: Iterable[int]) -> tuple[list[int], list[int]]:
+    """
+    Divide os motoristas de uma corrida nova entre quem recebe o push agora (abriu uma janela e tem
+    ficha) e quem fica para o resumo (já está numa janela ou estourou o balde).
+    """
+    perfil_ids = list(dict.fromkeys(perfil_ids))
+    janela = janela_segundos()
+    if janela <= 0:
+        # Sem janela não há resumo: quem estourou o balde simplesmente não recebe.
+        liberados = _consumir_fichas(perfil_ids)
+        return [p for p in perfil_ids if p in liberados], [p for p in perfil_ids if p not in liberados]
+    abertas = cache.get_many([_chave_janela(perfil_id) for perfil_id in perfil_ids])
+    candidatos = [perfil_id for perfil_id in perfil_ids if _chave_janela(perfil_id) not in abertas]
+    cache.set_many({_chave_janela(perfil_id): 1 for perfil_id in candidatos}, timeout=janela)
+    liberados = _consumir_fichas(candidatos)
+    imediatos = [perfil_id for perfil_id in candidatos if perfil_id in liberados]
+    coalescidos = [perfil_id for perfil_id in perfil_ids if perfil_id not in liberados]
+    _somar_pendentes(coalescidos)
+    return imediatos, coalescidos
+
+
+def _somar_pendentes(perfil_ids: list[int]) -> None:
+    if not perfil_ids:
+        return
+    chaves = [_chave_pendentes(perfil_id) for perfil_id in perfil_ids]
+    atuais = cache.get_many(chaves)
+    # Sem incr atômico em lote: duas rajadas simultâneas podem perder uma unidade do contador, o que só
+    # muda o número exibido no resumo.
+    cache.set_many({chave: atuais.get(chave, 0) + 1 for chave in chaves}, timeout=janela_segundos() * 10)
+
+
+def retirar_pendentes(perfil_ids: Iterable[int]) -> dict[int, int]:
+    """Contadores de corridas coalescidas por motorista (zerados aqui), já filtrados pelo balde."""
+    chaves = {_chave_pendentes(perfil_id): perfil_id for perfil_id in perfil_ids}
+    pendentes = {chaves[chave]: n for chave, n in cache.get_many(list(chaves)).items() if n}
+    if not pendentes:
+        return {}
+    cache.delete_many([_chave_pendentes(perfil_id) for perfil_id in pendentes])
+    liberados = _consumir_fichas(list(pendentes))
+    return {perfil_id: n for perfil_id, n in pendentes.items() if perfil_id in liberados}
+
+
+def reservar_resumo() -> bool:
+    """True para quem deve agendar o próximo resumo (no máximo um por janela)."""
+    janela = janela_segundos()
+    return janela > 0 and cache.add("push:resumo_agendado", 1, timeout=janela)
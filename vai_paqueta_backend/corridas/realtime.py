@@ -1,13 +1,20 @@
 from __future__ import annotations
 
+import math
 from typing import Iterable, Optional
 
 from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 
+from .active_rides import corrida_ativa_do_motorista
+from .coalescer import CoalescedorLocalizacao
 from .models import Corrida
-from .serializers import CorridaSerializer
+from .protocol import codificar_localizacao
+from .outbox import enviar_grupos, publicador, registrar_evento
+from .serializers import CORRIDA_RELACIONADOS, CorridaSerializer
 
 ACTIVE_STATUSES = ["aguardando", "aceita", "em_andamento"]
 
@@ -24,23 +31,75 @@ def group_ride(corrida_id: int) -> str:
     return f"ride_{corrida_id}"
 
 
+def group_cell(i: int, j: int) -> str:
+    return f"cell_{i}_{j}"
+
+
+def _tamanho_celula() -> float:
+    return float(getattr(settings, "NEARBY_CELL_DEG", 0.01))
+
+
+def celula(lat: float, lng: float) -> tuple[int, int]:
+    tamanho = _tamanho_celula()
+    return math.floor(lat / tamanho), math.floor(lng / tamanho)
+
+
+def celulas_bbox(sul: float, oeste: float, norte: float, leste: float, limite: int) -> list[str]:
+    """
+    Grupos das células da grade que cobrem o retângulo; acima de `limite`, só as mais próximas do centro.
+    """
+    i0, j0 = celula(min(sul, norte), min(oeste, leste))
+    i1, j1 = celula(max(sul, norte), max(oeste, leste))
+    if (i1 - i0 + 1) * (j1 - j0 + 1) > limite:
+        ci, cj = (i0 + i1) // 2, (j0 + j1) // 2
+        raio = max(0, (math.isqrt(max(1, limite)) - 1) // 2)
+        i0, i1 = max(i0, ci - raio), min(i1, ci + raio)
+        j0, j1 = max(j0, cj - raio), min(j1, cj + raio)
+    return [group_cell(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+
 def _broadcast(groups: Iterable[str], payload: dict) -> None:
     channel_layer = get_channel_layer()
     if not channel_layer:
         return
-    for group in groups:
-        async_to_sync(channel_layer.group_send)(group, {"type": "corrida.event", "event": payload})
+    groups = list(dict.fromkeys(groups))
+    message = {"type": "corrida.event", "event": payload}
+    if payload.get("type") == "driver_location":
+        # Codificado uma vez aqui para os consumidores no subprotocolo binário.
+        message["binario"] = codificar_localizacao(payload)
+    if isinstance(channel_layer, InMemoryChannelLayer):
+        # As filas em memória pertencem ao loop do servidor ASGI; envia daqui mesmo, num único salto.
+        async_to_sync(enviar_grupos)(channel_layer, groups, message)
+        return
+    publicador.enviar(channel_layer, groups, message)
+
+
+coalescedor_localizacao = CoalescedorLocalizacao(enviar=_broadcast)
+# Mesma regra de taxa para o mapa de motoristas próximos, mas por motorista (chave = perfil_id).
+coalescedor_proximos = CoalescedorLocalizacao(enviar=_broadcast)
+
+
+def _com_relacionados(corrida: Corrida) -> Corrida:
+    # Perfis já carregados (select_related da view) são reaproveitados; senão busca tudo numa consulta.
+    cache = corrida._state.fields_cache
+    if "cliente" in cache and (not corrida.motorista_id or "motorista" in cache):
+        return corrida
+    return Corrida.objects.select_related(*CORRIDA_RELACIONADOS).filter(pk=corrida.pk).first() or corrida
 
 
 def notify_corrida(corrida: Corrida, event_type: str = "ride_update") -> None:
-    data = CorridaSerializer(corrida).data
+    data = CorridaSerializer(_com_relacionados(corrida)).data
     payload = {"type": event_type, "corrida": data}
     groups = [group_ride(corrida.id)]
     if corrida.cliente_id:
         groups.append(group_passenger(corrida.cliente_id))
     if corrida.motorista_id:
         groups.append(group_driver(corrida.motorista_id))
-    _broadcast(groups, payload)
+    # A última posição pendente sai antes da mudança de status.
+    coalescedor_localizacao.descarregar(corrida.id)
+    # Serializado agora (retrato do momento do evento) e gravado no outbox na mesma transação:
+    # nada sai se ela for desfeita, e o request não espera o fan-out.
+    registrar_evento(corrida, event_type, payload, groups)
 
 
 def notify_driver_location(
@@ -53,25 +112,70 @@ def notify_driver_location(
     ping_em=None,
     corrida_id: Optional[int] = None,
 ) -> None:
-    corrida = None
-    if corrida_id:
-        corrida = Corrida.objects.filter(id=corrida_id, status__in=ACTIVE_STATUSES).first()
-    if not corrida:
-        corrida = (
-            Corrida.objects.filter(motorista_id=perfil_id, status__in=ACTIVE_STATUSES)
-            .order_by("-atualizado_em", "-criado_em")
-            .first()
-        )
-    if not corrida or not corrida.cliente_id:
+    # Sem consulta ao banco no caminho do ping: o mapa motorista -> corrida ativa fica em cache.
+    # O corrida_id enviado pelo app é ignorado; vale sempre a corrida ativa deste motorista.
+    ativa = corrida_ativa_do_motorista(perfil_id)
+    if not ativa or not ativa[1]:
         return
+    ativa_id, cliente_id = ativa
     payload = {
         "type": "driver_location",
-        "corrida_id": corrida.id,
+        "corrida_id": ativa_id,
         "latitude": latitude,
         "longitude": longitude,
         "precisao_m": precisao_m,
         "bearing": bearing, # Include bearing
         "ping_em": (ping_em or timezone.now()).isoformat(),
     }
-    groups = [group_ride(corrida.id), group_passenger(corrida.cliente_id)]
-    _broadcast(groups, payload)
+    groups = [group_ride(ativa_id), group_passenger(cliente_id)]
+    if isinstance(get_channel_layer(), InMemoryChannelLayer):
+        # Em dev os envios precisam sair da thread do request (filas presas ao loop do ASGI).
+        _broadcast(groups, payload)
+        return
+    coalescedor_localizacao.publicar(ativa_id, groups, payload, latitude, longitude)
+
+
+def _chave_celula(perfil_id: int) -> str:
+    return f"corridas:celula_motorista:{perfil_id}"
+
+
+def notify_motorista_proximo(
+    *,
+    perfil_id: int,
+    latitude: float,
+    longitude: float,
+    bearing: Optional[float] = None,
+    ping_em=None,
+) -> None:
+    """
+    Publica a posição do motorista no grupo da célula onde ele está (mapa de motoristas próximos).
+    """
+    grupo = group_cell(*celula(latitude, longitude))
+    anterior = cache.get(_chave_celula(perfil_id))
+    if anterior != grupo:
+        cache.set(_chave_celula(perfil_id), grupo, int(getattr(settings, "PRESENCE_TTL_SECONDS", 300)))
+        if anterior:
+            _broadcast([anterior], {"type": "driver_gone", "perfil_id": perfil_id})
+    # Compacto: ~1 m de precisão e sem os campos que o mapa não usa.
+    payload = {
+        "type": "driver_nearby",
+        "perfil_id": perfil_id,
+        "latitude": round(latitude, 5),
+        "longitude": round(longitude, 5),
+        "bearing": round(bearing) if bearing is not None else None,
+        "ping_em": (ping_em or timezone.now()).isoformat(),
+    }
+    if isinstance(get_channel_layer(), InMemoryChannelLayer):
+        _broadcast([grupo], payload)
+        return
+    coalescedor_proximos.publicar(perfil_id, [grupo], payload, latitude, longitude)
+
+
+def notify_motorista_saiu(perfil_id: int) -> None:
+    anterior = cache.get(_chave_celula(perfil_id))
+    if not anterior:
+        return
+    cache.delete(_chave_celula(perfil_id))
+    coalescedor_proximos.descarregar(perfil_id)
+    _broadcast([anterior], {"type": "driver_gone", "perfil_id": perfil_id})
+
@@ -0,0 +1,84 @@
+"""
+Buffer de replay dos eventos de corrida, para retomar sessões WebSocket sem `sync` completo.
+
+Cada evento publicado pelo outbox leva `seq` (o id do EventoCorrida, crescente dentro da corrida).
+O cache guarda os últimos REPLAY_BUFFER_SIZE eventos de cada corrida e até onde o histórico foi
+descartado: um cliente que reconecta com o último `seq` visto recebe só o que perdeu, ou None
+quando o buffer já não cobre a lacuna (aí cabe o `sync`).
+"""
+
+from __future__ import annotations
+
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def _chave(corrida_id: int) -> str:
+    return f"corridas:replay:{corrida_id}"
+
+
+def _tamanho() -> int:
+    return int(getattr(settings, "REPLAY_BUFFER_SIZE", 50))
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "REPLAY_TTL_SECONDS", 3600))
+
+
+def guardar(corrida_id: int, eventos: Iterable[tuple[int, dict]]) -> None:
+    """
+    Acrescenta eventos (seq, payload) já publicados, em ordem de seq.
+    """
+    novos = sorted(eventos, key=lambda item: item[0])
+    if not novos:
+        return
+    buffer = cache.get(_chave(corrida_id))
+    if not buffer:
+        # Buffer novo (ou expirado): nada antes do primeiro evento guardado pode ser reenviado.
+        buffer = {"descartado_ate": novos[0][0] - 1, "eventos": []}
+    vistos = {seq for seq, _ in buffer["eventos"]}
+    eventos = buffer["eventos"] + [[seq, payload] for seq, payload in novos if seq not in vistos]
+    eventos.sort(key=lambda item: item[0])
+    excesso = len(eventos) - _tamanho()
+    if excesso > 0:
+        buffer["descartado_ate"] = max(buffer["descartado_ate"], eventos[excesso - 1][0])
+        eventos = eventos[excesso:]
+    buffer["eventos"] = eventos
+    cache.set(_chave(corrida_id), buffer, _ttl())
+
+
+def _participantes(payload: dict) -> set[int]:
+    corrida = payload.get("corrida") or {}
+    ids = set()
+    for papel in ("cliente", "motorista"):
+        perfil = corrida.get(papel) or {}
+        if perfil.get("id"):
+            ids.add(perfil["id"])
+    return ids
+
+
+def _eventos_desde(buffer: Optional[dict], perfil_id: int, seq: int) -> Optional[list[dict]]:
+    if not buffer or not buffer["eventos"]:
+        return None
+    # Autoriza pelo evento mais recente: quem saiu da corrida (motorista trocado) não retoma.
+    if perfil_id not in _participantes(buffer["eventos"][-1][1]):
+        return None
+    if seq < buffer["descartado_ate"]:
+        return None
+    return [payload for evento_seq, payload in buffer["eventos"] if evento_seq > seq]
+
+
+async def aeventos_desde(corrida_id: int, perfil_id: int, seq: int) -> Optional[list[dict]]:
+    """
+    Eventos da corrida com seq maior que `seq`, se o perfil participa dela e o buffer cobre a lacuna.
+    """
+    return _eventos_desde(await cache.aget(_chave(corrida_id)), perfil_id, seq)
+
+
+def ultimo_seq(corrida_id: int) -> Optional[int]:
+    buffer = cache.get(_chave(corrida_id))
+    if not buffer or not buffer["eventos"]:
+        return None
+    return buffer["eventos"][-1][0]
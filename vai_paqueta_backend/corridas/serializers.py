@@ -1,9 +1,28 @@
+from django.db.models import OuterRef, Subquery
 from django.utils import timezone
 from rest_framework import serializers
 
 from .models import Corrida, LocalizacaoPing, Perfil, UserContato
 
 
+class CamposSelecionaveisMixin:
+    """
+    Permite às listagens pedirem só alguns campos: `?fields=id,status,criado_em`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is None or request.method != "GET":
+            return
+        campos = request.query_params.get("fields")
+        if not campos:
+            return
+        pedidos = {campo.strip() for campo in campos.split(",") if campo.strip()}
+        for campo in set(self.fields) - pedidos:
+            self.fields.pop(campo)
+
+
 class PerfilSerializer(serializers.ModelSerializer):
     telefone = serializers.SerializerMethodField()
 
@@ -21,7 +40,54 @@ class PerfilSerializer(serializers.ModelSerializer):
             return None
 
 
-class CorridaSerializer(serializers.ModelSerializer):
+# Relações lidas pelo CorridaSerializer (perfis e telefones); use em select_related.
+CORRIDA_RELACIONADOS = ("cliente__user__contato", "motorista__user__contato")
+
+
+_CAMPOS_ULTIMO_PING = ("perfil_id", "id", "latitude", "longitude", "bearing", "criado_em")
+
+
+def _pings_recentes():
+    # Mais recente primeiro; (perfil, criado_em) é coberto por ping_perfil_criado_idx.
+    return LocalizacaoPing.objects.order_by("-criado_em", "-id")
+
+
+def ultimos_pings(perfil_ids) -> dict:
+    """
+    Último ping de cada perfil numa única consulta. Para um perfil só é um LIMIT 1 no índice; para
+    vários, uma subconsulta correlacionada (LIMIT 1 por perfil) escolhe os ids, sem varrer o histórico.
+    Perfis sem ping aparecem com None, para não serem consultados de novo.
+    """
+    ids = {perfil_id for perfil_id in perfil_ids if perfil_id}
+    if not ids:
+        return {}
+    if len(ids) == 1:
+        linhas = _pings_recentes().filter(perfil_id=next(iter(ids))).values(*_CAMPOS_ULTIMO_PING)[:1]
+    else:
+        ultimo_id = Subquery(_pings_recentes().filter(perfil_id=OuterRef("pk")).values("id")[:1])
+        linhas = LocalizacaoPing.objects.filter(
+            pk__in=Perfil.objects.filter(pk__in=ids).annotate(ultimo_ping_id=ultimo_id).values("ultimo_ping_id")
+        ).values(*_CAMPOS_ULTIMO_PING)
+    pings = dict.fromkeys(ids)
+    for linha in linhas:
+        pings[linha.pop("perfil_id")] = linha
+    return pings
+
+
+_CAMPOS_PING = {"motorista_lat", "motorista_lng", "motorista_ping_em", "motorista_bearing"}
+
+
+class CorridaListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        # Resolve o último ping de todos os motoristas da página de uma vez.
+        corridas = list(data.all() if hasattr(data, "all") else data)
+        if not _CAMPOS_PING.intersection(self.child.fields):
+            return super().to_representation(corridas)
+        self.child._pings_por_motorista.update(ultimos_pings(corrida.motorista_id for corrida in corridas))
+        return super().to_representation(corridas)
+
+
+class CorridaSerializer(CamposSelecionaveisMixin, serializers.ModelSerializer):
     cliente = PerfilSerializer(read_only=True)
     motorista = PerfilSerializer(read_only=True)
     motorista_lat = serializers.SerializerMethodField()
@@ -53,18 +119,19 @@ class CorridaSerializer(serializers.ModelSerializer):
             "server_time",
         ]
         read_only_fields = ["id", "cliente", "motorista", "status", "lugares", "criado_em", "atualizado_em"]
+        list_serializer_class = CorridaListSerializer
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # motorista_id -> último ping (ou None); evita repetir a consulta em cada campo.
+        self._pings_por_motorista = {}
 
     def _ultimo_ping(self, obj):
-        if not obj.motorista:
+        if not obj.motorista_id:
             return None
-        from .models import LocalizacaoPing
-
-        return (
-            LocalizacaoPing.objects.filter(perfil=obj.motorista)
-            .order_by("-criado_em")
-            .values("latitude", "longitude", "bearing", "criado_em")
-            .first()
-        )
+        if obj.motorista_id not in self._pings_por_motorista:
+            self._pings_por_motorista.update(ultimos_pings([obj.motorista_id]))
+        return self._pings_por_motorista[obj.motorista_id]
 
     def get_motorista_lat(self, obj):
         ping = self._ultimo_ping(obj)
@@ -112,7 +179,7 @@ class CorridaStatusSerializer(serializers.Serializer):
     motorista_id = serializers.IntegerField(required=False)
 
 
-class LocalizacaoPingSerializer(serializers.ModelSerializer):
+class LocalizacaoPingSerializer(CamposSelecionaveisMixin, serializers.ModelSerializer):
     class Meta:
         model = LocalizacaoPing
         fields = ["id", "perfil", "latitude", "longitude", "precisao_m", "bearing", "criado_em"]
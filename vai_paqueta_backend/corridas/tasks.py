@@ -1,24 +1,71 @@
 from __future__ import annotations
 
+from collections import defaultdict
 from datetime import timedelta
 
 from celery import shared_task
 from django.conf import settings
+from django.db.models import OuterRef, Subquery
 from django.utils import timezone
 
-from .constants import PING_MAX_AGE_MINUTES
+from . import push_limits
+
+from .dispatch import _haversine_km, despachar_lote, despacho_em_lote, varrer_corridas
 from .fcm import send_push_to_tokens
-from .models import Corrida, FcmDeviceToken, LocalizacaoPing, Perfil
+from .models import Corrida, EventoCorrida, FcmDeviceToken, LocalizacaoPing
+from .outbox import limpar_eventos_publicados, publicar_eventos, registrar_evento
+from .presence import ha_ecotaxista_online
 
 
-def _ha_ecotaxista_online() -> bool:
-    limite = timezone.now() - timedelta(minutes=PING_MAX_AGE_MINUTES)
-    return LocalizacaoPing.objects.filter(perfil__tipo="ecotaxista", criado_em__gte=limite).exists()
+def _destinatarios(corrida: Corrida | None, raio_km: float) -> dict[int, list[str]]:
+    """
+    Tokens ativos de todos os ecotaxistas (por perfil) numa consulta só, com a última posição conhecida de
+    cada um. Com raio_km > 0 fica de fora quem foi visto longe da origem; quem nunca mandou ping continua.
+    """
+    ultimo_ping = LocalizacaoPing.objects.filter(perfil_id=OuterRef("perfil_id")).order_by("-id")
+    linhas = (
+        FcmDeviceToken.objects.filter(ativo=True, perfil__tipo="ecotaxista")
+        .annotate(
+            ultima_lat=Subquery(ultimo_ping.values("latitude")[:1]),
+            ultima_lng=Subquery(ultimo_ping.values("longitude")[:1]),
+        )
+        .values_list("perfil_id", "token", "ultima_lat", "ultima_lng")
+    )
+    filtrar = (
+        raio_km > 0 and corrida is not None and corrida.origem_lat is not None and corrida.origem_lng is not None
+    )
+    por_perfil: dict[int, list[str]] = defaultdict(list)
+    for perfil_id, token, lat, lng in linhas:
+        if filtrar and lat is not None and lng is not None:
+            dist = _haversine_km(float(corrida.origem_lat), float(corrida.origem_lng), float(lat), float(lng))
+            if dist > raio_km:
+                continue
+        por_perfil[perfil_id].append(token)
+    return por_perfil
 
 
-def _chunked(tokens: list[str], chunk_size: int = 500):
-    for i in range(0, len(tokens), chunk_size):
-        yield tokens[i : i + chunk_size]
+def _enviar_aviso(tokens: list[str], body: str, data: dict[str, str]) -> dict:
+    # Mensagem única (sem o nome do motorista) para todos: o payload é montado uma vez e cada token
+    # só troca o destinatário; os dados da corrida vão em `data` para o app abrir a oferta.
+    try:
+        response = send_push_to_tokens(
+            tokens=tokens,
+            title="Nova corrida disponível",
+            body=body,
+            data=data,
+            android_channel_id=getattr(settings, "FCM_ANDROID_CHANNEL_ID", None),
+        )
+    except Exception as exc:
+        return {"detail": "erro_envio", "error": str(exc)}
+    if response is None:
+        return {"detail": "ok", "tokens": 0, "success": 0, "failure": 0, "invalid": 0}
+    return {
+        "detail": "ok",
+        "tokens": len(tokens),
+        "success": response.success_count,
+        "failure": response.failure_count,
+        "invalid": len(response.tokens_invalidos),
+    }
 
 
 @shared_task
@@ -26,53 +73,96 @@ def notificar_sem_motoristas(corrida_id: int) -> dict:
     corrida = Corrida.objects.filter(id=corrida_id).first()
     if not corrida or corrida.status != "aguardando":
         return {"detail": "corrida_invalida"}
-    if _ha_ecotaxista_online():
+    if ha_ecotaxista_online():
         return {"detail": "motoristas_online"}
 
-    channel_id = getattr(settings, "FCM_ANDROID_CHANNEL_ID", None)
-    data = {
-        "type": "ride_available",
-        "corrida_id": str(corrida_id),
-        "payload": f"ride:{corrida_id}",
-    }
-    total_tokens = 0
-    total_success = 0
-    total_failure = 0
-
-    perfis = Perfil.objects.filter(tipo="ecotaxista").select_related("user")
-    for perfil in perfis:
-        tokens = list(
-            FcmDeviceToken.objects.filter(perfil=perfil, ativo=True).values_list("token", flat=True)
-        )
-        if not tokens:
-            continue
-        total_tokens += len(tokens)
-        nome = (perfil.nome or (perfil.user.first_name if perfil.user else "") or "").strip()
-        if not nome:
-            nome = "motorista"
-        body = (
-            f"Olá {nome}, há uma nova corrida disponível perto de você. "
-            "Abra o app Vai Paquetá para ver os detalhes."
+    por_perfil = _destinatarios(corrida, float(getattr(settings, "NOTIFY_SEM_MOTORISTAS_RAIO_KM", 0)))
+    imediatos, coalescidos = push_limits.separar_envios(por_perfil)
+    if coalescidos and push_limits.janela_segundos() > 0 and push_limits.reservar_resumo():
+        # O resumo sai pelo próprio outbox, adiado até o fim da janela.
+        registrar_evento(
+            corrida,
+            "ride_available_resumo",
+            {},
+            canal=EventoCorrida.CANAL_FCM,
+            disponivel_em=timezone.now() + timedelta(seconds=push_limits.janela_segundos()),
         )
-        for chunk in _chunked(tokens):
-            try:
-                response = send_push_to_tokens(
-                    tokens=chunk,
-                    title="Nova corrida disponível",
-                    body=body,
-                    data=data,
-                    android_channel_id=channel_id,
-                )
-            except Exception as exc:
-                return {"detail": "erro_envio", "error": str(exc)}
-            if response is None:
-                continue
-            total_success += response.success_count
-            total_failure += response.failure_count
+    resultado = _enviar_aviso(
+        [token for perfil_id in imediatos for token in por_perfil[perfil_id]],
+        "Há uma nova corrida disponível perto de você. Abra o app Vai Paquetá para ver os detalhes.",
+        {
+            "type": "ride_available",
+            "corrida_id": str(corrida_id),
+            "payload": f"ride:{corrida_id}",
+        },
+    )
+    return {**resultado, "coalesced": len(coalescidos)}
 
-    return {
-        "detail": "ok",
-        "tokens": total_tokens,
-        "success": total_success,
-        "failure": total_failure,
-    }
+
+@shared_task
+def notificar_resumo_corridas() -> dict:
+    """
+    Resumo do fim da janela de coalescência: um push por motorista com as corridas que ficaram
+    represadas ("3 novas corridas"), limitado às que ainda esperam motorista.
+    """
+    por_perfil = _destinatarios(None, 0)
+    pendentes = push_limits.retirar_pendentes(por_perfil)
+    if not pendentes:
+        return {"detail": "sem_pendentes"}
+    aguardando = Corrida.objects.filter(status="aguardando", motorista__isnull=True).count()
+    if not aguardando:
+        return {"detail": "corrida_invalida"}
+    if ha_ecotaxista_online():
+        return {"detail": "motoristas_online"}
+
+    por_quantidade: dict[int, list[str]] = defaultdict(list)
+    for perfil_id, quantidade in pendentes.items():
+        por_quantidade[min(quantidade, aguardando)].extend(por_perfil.get(perfil_id, []))
+    totais = {"detail": "ok", "tokens": 0, "success": 0, "failure": 0, "invalid": 0}
+    for quantidade, tokens in por_quantidade.items():
+        if quantidade == 1:
+            body = "Há uma nova corrida disponível perto de você. Abra o app Vai Paquetá para ver os detalhes."
+        else:
+            body = f"Há {quantidade} novas corridas disponíveis perto de você. Abra o app Vai Paquetá para ver."
+        resultado = _enviar_aviso(tokens, body, {"type": "ride_available", "quantidade": str(quantidade)})
+        if resultado["detail"] != "ok":
+            return resultado
+        for chave in ("tokens", "success", "failure", "invalid"):
+            totais[chave] += resultado[chave]
+    return totais
+
+
+@shared_task(ignore_result=True)
+def despachar_corridas_em_lote() -> dict:
+    """
+    Tick do despachante em lote (agendado pelo Celery beat quando DISPATCH_MODE=lote).
+    """
+    if not despacho_em_lote():
+        return {"detail": "modo_imediato"}
+    atribuidas = despachar_lote()
+    return {"detail": "ok", "atribuidas": len(atribuidas)}
+
+
+@shared_task(ignore_result=True)
+def varrer_corridas_expiradas() -> dict:
+    """
+    Varredura periódica (Celery beat): expira ofertas vencidas e tenta despachar corridas sem motorista.
+    """
+    return {"detail": "ok", **varrer_corridas()}
+
+
+@shared_task(ignore_result=True)
+def publicar_eventos_corrida() -> dict:
+    """
+    Rede de segurança do outbox (Celery beat): publica eventos que nenhum processo web publicou
+    (processo reiniciado, channel layer fora do ar) e apaga os já publicados antigos.
+    """
+    publicados = 0
+    falhas = 0
+    while True:
+        resultado = publicar_eventos()
+        publicados += resultado["publicados"]
+        falhas += resultado["falhas"]
+        if not resultado["publicados"]:
+            break
+    return {"detail": "ok", "publicados": publicados, "falhas": falhas, "apagados": limpar_eventos_publicados()}
@@ -0,0 +1,558 @@
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+
+from geo.views import RoadGraph
+
+from . import dispatch, fcm, outbox, presence, principal, protocol
+from .active_rides import corrida_ativa_do_motorista
+from .consumers import PassengerConsumer
+from .management.commands.relatorio_corridas import Command as RelatorioCorridas
+from .models import Corrida, EventoCorrida, FcmDeviceToken, LocalizacaoPing, Perfil, UserContato
+from .realtime import group_passenger, group_ride, notify_corrida, notify_driver_location
+from .serializers import CORRIDA_RELACIONADOS, CorridaSerializer
+
+
+def _ping(perfil, lat, lng, criado_em=None):
+    ping = LocalizacaoPing.objects.create(perfil=perfil, latitude=Decimal(lat), longitude=Decimal(lng))
+    if criado_em is not None:
+        # criado_em é auto_now_add: a data do teste entra por update.
+        LocalizacaoPing.objects.filter(pk=ping.pk).update(criado_em=criado_em)
+        ping.criado_em = criado_em
+    return ping
+
+
+class CorridaSerializerConsultasTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = get_user_model().objects.create_user(username="passageiro", password="x")
+        UserContato.objects.create(user=user, telefone="+5521999990000")
+        cls.cliente = Perfil.objects.create(user=user, tipo="passageiro")
+        agora = timezone.now()
+        cls.motoristas = []
+        for i in range(5):
+            motorista = Perfil.objects.create(tipo="ecotaxista", nome=f"Motorista {i}")
+            Corrida.objects.create(cliente=cls.cliente, motorista=motorista, status="aceita")
+            _ping(motorista, "-22.760000", "-43.100000", agora - timedelta(minutes=2))
+            _ping(motorista, f"-22.76{i}000", "-43.110000", agora - timedelta(minutes=1))
+            cls.motoristas.append(motorista)
+        Corrida.objects.create(cliente=cls.cliente, status="aguardando")
+
+    def _corridas(self):
+        return Corrida.objects.select_related(*CORRIDA_RELACIONADOS).order_by("id")
+
+    def test_listagem_le_os_pings_numa_consulta(self):
+        # Uma consulta para as corridas (com perfis e telefones) e uma para o último ping de todos os motoristas.
+        with self.assertNumQueries(2):
+            dados = CorridaSerializer(self._corridas(), many=True).data
+        self.assertEqual(len(dados), 6)
+        self.assertEqual(dados[0]["cliente"]["telefone"], "+5521999990000")
+        for i, item in enumerate(dados[:5]):
+            self.assertEqual(item["motorista_lat"], float(Decimal(f"-22.76{i}000")))
+        self.assertIsNone(dados[5]["motorista_lat"])
+
+    def test_listagem_sem_campos_de_ping_nao_consulta_pings(self):
+        request = Request(APIRequestFactory().get("/api/corridas/", {"fields": "id,status"}))
+        with self.assertNumQueries(1):
+            dados = CorridaSerializer(self._corridas(), many=True, context={"request": request}).data
+        self.assertEqual(set(dados[0]), {"id", "status"})
+
+
+class CorridaAtivaConsultasTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username="motorista", password="x")
+        cls.motorista = Perfil.objects.create(user=cls.user, tipo="ecotaxista")
+        cliente = Perfil.objects.create(tipo="passageiro")
+        cls.corrida = Corrida.objects.create(cliente=cliente, motorista=cls.motorista, status="aceita")
+        agora = timezone.now()
+        # Histórico do motorista: só o mais recente entra na resposta.
+        for minuto in range(30, 0, -1):
+            _ping(cls.motorista, "-22.750000", "-43.100000", agora - timedelta(minutes=minuto))
+        _ping(cls.motorista, "-22.761234", "-43.101234", agora)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f"/api/corridas/para_motorista/{self.motorista.id}/"
+
+    def test_para_motorista(self):
+        # Corrida com perfis e o último ping do motorista (o mesmo para o ETag e o corpo).
+        with self.assertNumQueries(2):
+            resposta = self.client.get(self.url)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta.data["id"], self.corrida.id)
+        self.assertEqual(resposta.data["motorista_lat"], -22.761234)
+
+    def test_para_motorista_nao_modificado(self):
+        etag = self.client.get(self.url)["ETag"]
+        with self.assertNumQueries(2):
+            resposta = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resposta.status_code, 304)
+
+    def test_novo_ping_muda_o_etag(self):
+        etag = self.client.get(self.url)["ETag"]
+        _ping(self.motorista, "-22.762000", "-43.102000")
+        resposta = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertNotEqual(resposta["ETag"], etag)
+        self.assertEqual(resposta.data["motorista_lat"], -22.762)
+
+    def test_notify_corrida(self):
+        corrida = Corrida.objects.select_related(*CORRIDA_RELACIONADOS).get(pk=self.corrida.pk)
+        # Último ping do motorista e o INSERT do evento no outbox.
+        with self.assertNumQueries(2):
+            notify_corrida(corrida)
+        evento = EventoCorrida.objects.get(corrida=corrida)
+        self.assertEqual(evento.payload["corrida"]["motorista_lat"], -22.761234)
+
+
+class LocalizacaoMotoristaTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.layer = get_channel_layer()
+        async_to_sync(self.layer.flush)()
+        self.cliente = Perfil.objects.create(tipo="passageiro")
+        self.motorista = Perfil.objects.create(tipo="ecotaxista")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.corrida = Corrida.objects.create(cliente=self.cliente, motorista=self.motorista, status="aceita")
+        self.canal = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(group_ride(self.corrida.id), self.canal)
+
+    def _notificar(self):
+        notify_driver_location(perfil_id=self.motorista.id, latitude=-22.76, longitude=-43.1)
+
+    def test_ping_com_mapa_em_cache_nao_consulta_o_banco(self):
+        with self.assertNumQueries(0):
+            self._notificar()
+        mensagem = async_to_sync(self.layer.receive)(self.canal)
+        self.assertEqual(mensagem["event"]["type"], "driver_location")
+        self.assertEqual(mensagem["event"]["corrida_id"], self.corrida.id)
+
+    def test_cache_miss_consulta_uma_vez(self):
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(corrida_ativa_do_motorista(self.motorista.id), (self.corrida.id, self.cliente.id))
+        with self.assertNumQueries(0):
+            self._notificar()
+
+    def test_corrida_concluida_sai_do_mapa(self):
+        self.corrida.status = "concluida"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.corrida.save()
+        # O handler apaga a entrada; a próxima consulta confirma e guarda o negativo.
+        with self.assertNumQueries(1):
+            self.assertIsNone(corrida_ativa_do_motorista(self.motorista.id))
+        with self.assertNumQueries(0):
+            self._notificar()
+        fila = self.layer.channels.get(self.canal)
+        self.assertTrue(fila is None or fila.empty())
+
+
+def _erro_fcm(status: int, codigo: str, codigo_fcm: str | None = None, mensagem: str = "") -> dict:
+    erro = {"code": status, "status": codigo, "message": mensagem}
+    if codigo_fcm:
+        erro["details"] = [
+            {"@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError", "errorCode": codigo_fcm}
+        ]
+    return {"error": erro}
+
+
+class ClassificarRespostaFcmTests(SimpleTestCase):
+    def test_sucesso(self):
+        self.assertEqual(fcm.classificar(200, {"name": "projects/x/messages/1"}), fcm.OK)
+
+    def test_codigos_explicitos_invalidam_o_token(self):
+        self.assertEqual(fcm.classificar(404, _erro_fcm(404, "NOT_FOUND", "UNREGISTERED")), fcm.INVALIDO)
+        self.assertEqual(fcm.classificar(403, _erro_fcm(403, "PERMISSION_DENIED", "SENDER_ID_MISMATCH")), fcm.INVALIDO)
+
+    def test_erro_generico_e_falha(self):
+        self.assertEqual(fcm.classificar(404, _erro_fcm(404, "NOT_FOUND")), fcm.FALHA)
+        self.assertEqual(fcm.classificar(404, {}), fcm.FALHA)
+        corpo = _erro_fcm(400, "INVALID_ARGUMENT", "INVALID_ARGUMENT", "The registration token is not a valid FCM token")
+        self.assertEqual(fcm.classificar(400, corpo), fcm.FALHA)
+
+    def test_transitorios(self):
+        for status in (429, 500, 503):
+            self.assertEqual(fcm.classificar(status, _erro_fcm(status, "UNAVAILABLE", "UNAVAILABLE")), fcm.TRANSITORIO)
+
+
+@override_settings(FCM_ENDPOINT_URL="http://127.0.0.1:9/fcm", FCM_MAX_TENTATIVAS=1)
+class DesativarTokensFcmTests(TestCase):
+    RESPOSTAS = {
+        "ok": (200, {"name": "projects/x/messages/1"}),
+        "desinstalado": (404, _erro_fcm(404, "NOT_FOUND", "UNREGISTERED")),
+        "outro-remetente": (403, _erro_fcm(403, "PERMISSION_DENIED", "SENDER_ID_MISMATCH")),
+        "404-generico": (404, _erro_fcm(404, "NOT_FOUND")),
+        "payload-invalido": (400, _erro_fcm(400, "INVALID_ARGUMENT", "INVALID_ARGUMENT")),
+    }
+
+    def setUp(self):
+        perfil = Perfil.objects.create(tipo="ecotaxista")
+        for token in self.RESPOSTAS:
+            FcmDeviceToken.objects.create(perfil=perfil, token=token)
+
+    def _enviar_um(self, sessao, url, mensagem, token):
+        status, corpo = self.RESPOSTAS[token]
+        return fcm.classificar(status, corpo), None
+
+    def test_desativa_so_tokens_com_codigo_explicito(self):
+        with mock.patch.object(fcm, "_enviar_um", self._enviar_um), self.assertNumQueries(1):
+            resultado = fcm.send_push_to_tokens(tokens=list(self.RESPOSTAS), title="t", body="b")
+        self.assertEqual(resultado.success_count, 1)
+        self.assertEqual(resultado.failure_count, 4)
+        self.assertEqual(sorted(resultado.tokens_invalidos), ["desinstalado", "outro-remetente"])
+        self.assertEqual(
+            set(FcmDeviceToken.objects.filter(ativo=True).values_list("token", flat=True)),
+            {"ok", "404-generico", "payload-invalido"},
+        )
+
+
+class PingsDoRelatorioTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        base = timezone.now() - timedelta(hours=2)
+        cliente = Perfil.objects.create(tipo="passageiro")
+        motorista = Perfil.objects.create(tipo="ecotaxista")
+        outro = Perfil.objects.create(tipo="ecotaxista")
+        # Janelas em minutos a partir de `base`; as três primeiras do mesmo motorista se sobrepõem.
+        janelas = [(motorista, 0, 30), (motorista, 10, 20), (motorista, 25, 50), (outro, 5, 40), (motorista, 70, 80)]
+        cls.corridas = []
+        for perfil, inicio, fim in janelas:
+            cls.corridas.append(
+                Corrida.objects.create(
+                    cliente=cliente,
+                    motorista=perfil,
+                    status="concluida",
+                    iniciada_em=base + timedelta(minutes=inicio),
+                    concluida_em=base + timedelta(minutes=fim),
+                )
+            )
+        cls.corridas.append(Corrida.objects.create(cliente=cliente, status="cancelada"))
+        for minuto in range(-5, 90, 5):
+            _ping(motorista, "-22.760000", f"-43.1{minuto + 5:02d}000", base + timedelta(minutes=minuto))
+            _ping(outro, "-22.770000", f"-43.1{minuto + 5:02d}000", base + timedelta(minutes=minuto, seconds=30))
+
+    def test_lote_usa_uma_consulta(self):
+        comando = RelatorioCorridas()
+        with self.assertNumQueries(1):
+            comando._pings_em_lote(self.corridas)
+
+    def test_lote_igual_a_consulta_por_corrida(self):
+        comando = RelatorioCorridas()
+        lote = comando._pings_em_lote(self.corridas)
+        for corrida in self.corridas:
+            self.assertEqual(lote[corrida.id], comando._pings_da_corrida(corrida), corrida.id)
+        # Limites inclusivos: os pings nos minutos 10 e 20 entram na corrida de 10 a 20.
+        self.assertEqual(len(lote[self.corridas[1].id]), 3)
+        self.assertEqual(lote[self.corridas[5].id], [])
+
+
+class PublicacaoPushTests(TestCase):
+    def setUp(self):
+        cliente = Perfil.objects.create(tipo="passageiro")
+        self.corrida = Corrida.objects.create(cliente=cliente)
+
+    def test_evento_fcm_nao_e_enviado_na_thread_do_commit(self):
+        with mock.patch.object(outbox.publicador_fcm, "acordar") as acordar, mock.patch.object(
+            outbox, "_publicar_fcm"
+        ) as publicar_fcm:
+            with self.captureOnCommitCallbacks(execute=True):
+                outbox.registrar_evento(self.corrida, "ride_available", {}, canal=EventoCorrida.CANAL_FCM)
+        acordar.assert_called_once_with()
+        publicar_fcm.assert_not_called()
+
+    def test_publicacao_do_websocket_ignora_eventos_fcm(self):
+        outbox.registrar_evento(self.corrida, "ride_available", {}, canal=EventoCorrida.CANAL_FCM)
+        outbox.registrar_evento(self.corrida, "ride_update", {"type": "ride_update"}, [group_ride(self.corrida.id)])
+        with mock.patch.object(outbox, "_publicar_fcm") as publicar_fcm:
+            resultado = outbox.publicar_eventos(canal=EventoCorrida.CANAL_WS)
+        self.assertEqual(resultado, {"publicados": 1, "falhas": 0})
+        publicar_fcm.assert_not_called()
+        self.assertTrue(EventoCorrida.objects.filter(canal=EventoCorrida.CANAL_FCM, publicado_em__isnull=True).exists())
+
+
+@override_settings(WS_MAX_RIDE_SUBSCRIPTIONS=2)
+class AssinaturasWebSocketTests(TestCase):
+    def setUp(self):
+        self.layer = get_channel_layer()
+        async_to_sync(self.layer.flush)()
+        self.user = get_user_model().objects.create_user(username="passageiro-ws", password="x")
+        self.perfil = Perfil.objects.create(user=self.user, tipo="passageiro")
+        self.corridas = [Corrida.objects.create(cliente=self.perfil).id for _ in range(3)]
+        outro = Perfil.objects.create(tipo="passageiro")
+        self.corrida_alheia = Corrida.objects.create(cliente=outro).id
+
+    def _membros(self, grupo: str) -> set[str]:
+        return set(self.layer.groups.get(grupo, {}))
+
+    async def _conectar(self) -> WebsocketCommunicator:
+        comunicador = WebsocketCommunicator(PassengerConsumer.as_asgi(), "/ws/passenger/")
+        comunicador.scope["user"] = self.user
+        conectado, _ = await comunicador.connect()
+        self.assertTrue(conectado)
+        self.assertEqual((await comunicador.receive_json_from())["type"], "connected")
+        return comunicador
+
+    def test_limite_de_assinaturas_e_limpeza(self):
+        async_to_sync(self._limite_de_assinaturas_e_limpeza)()
+
+    async def _limite_de_assinaturas_e_limpeza(self):
+        primeira, segunda, terceira = self.corridas
+        comunicador = await self._conectar()
+        canal = next(iter(self._membros(group_passenger(self.perfil.id))))
+
+        # Corrida de outro passageiro: recusada, sem resposta e sem grupo.
+        await comunicador.send_json_to({"type": "subscribe_ride", "ride_id": self.corrida_alheia})
+        self.assertTrue(await comunicador.receive_nothing())
+        self.assertNotIn(canal, self._membros(group_ride(self.corrida_alheia)))
+
+        for ride_id in (primeira, segunda):
+            await comunicador.send_json_to({"type": "subscribe_ride", "ride_id": ride_id})
+            self.assertEqual(await comunicador.receive_json_from(), {"type": "subscribed", "ride_id": ride_id})
+
+        # Acima do limite a mais antiga sai antes de a nova entrar.
+        await comunicador.send_json_to({"type": "subscribe_ride", "ride_id": terceira})
+        self.assertEqual(await comunicador.receive_json_from(), {"type": "unsubscribed", "ride_id": primeira})
+        self.assertEqual(await comunicador.receive_json_from(), {"type": "subscribed", "ride_id": terceira})
+        self.assertNotIn(canal, self._membros(group_ride(primeira)))
+        self.assertIn(canal, self._membros(group_ride(segunda)))
+        self.assertIn(canal, self._membros(group_ride(terceira)))
+
+        await comunicador.send_json_to({"type": "unsubscribe_ride", "ride_id": segunda})
+        self.assertEqual(await comunicador.receive_json_from(), {"type": "unsubscribed", "ride_id": segunda})
+        self.assertNotIn(canal, self._membros(group_ride(segunda)))
+
+        await comunicador.disconnect()
+        self.assertNotIn(canal, self._membros(group_ride(terceira)))
+        self.assertNotIn(canal, self._membros(group_passenger(self.perfil.id)))
+
+    def test_bbox_nao_finito_responde_erro(self):
+        async_to_sync(self._bbox_nao_finito_responde_erro)()
+
+    async def _bbox_nao_finito_responde_erro(self):
+        comunicador = await self._conectar()
+        # NaN/Infinity chegam como texto JSON válido para o json do Python.
+        for bbox in ("[NaN, -43.12, -22.74, -43.08]", "[-22.78, -Infinity, -22.74, Infinity]"):
+            await comunicador.send_to(text_data=f'{{"type": "subscribe_nearby", "bbox": {bbox}}}')
+            self.assertEqual(await comunicador.receive_json_from(), {"type": "error", "detail": "bbox inválido."})
+        await comunicador.send_json_to({"type": "subscribe_nearby", "bbox": [-22.78, -43.12, -22.74, -43.08]})
+        resposta = await comunicador.receive_json_from()
+        self.assertEqual(resposta["type"], "nearby_subscribed")
+        self.assertGreater(resposta["celulas"], 0)
+        await comunicador.disconnect()
+
+
+class PrincipalCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username="principal", password="x", email="p@x.com")
+        self.perfil = Perfil.objects.create(user=self.user, tipo="ecotaxista")
+        self.token = AccessToken.for_user(self.user)
+        self.carregar = JWTAuthentication().get_user
+
+    def test_cache_guarda_so_primitivos(self):
+        principal.usuario_do_token(self.token, self.carregar)
+        self.assertEqual(
+            cache.get(principal._chave(self.user.pk)), (self.user.pk, False, self.perfil.pk, "ecotaxista")
+        )
+
+    def test_acerto_remonta_usuario_com_perfil_sem_consultas(self):
+        principal.usuario_do_token(self.token, self.carregar)
+        carregar = mock.Mock()
+        with self.assertNumQueries(0):
+            user = principal.usuario_do_token(self.token, carregar)
+            self.assertEqual(user.pk, self.user.pk)
+            self.assertFalse(user.is_staff)
+            self.assertEqual(user.perfil_app.pk, self.perfil.pk)
+            self.assertEqual(user.perfil_app.tipo, "ecotaxista")
+        carregar.assert_not_called()
+        # Os demais campos são adiados: lidos do banco só quando usados.
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, "p@x.com")
+        # save() de instância com campos adiados grava só os carregados.
+        user.first_name = "Nome"
+        with self.assertNumQueries(1):
+            user.save()
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.username), ("Nome", "principal"))
+
+    def test_gravar_usuario_invalida(self):
+        principal.usuario_do_token(self.token, self.carregar)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = True
+            self.user.save()
+        self.assertIsNone(cache.get(principal._chave(self.user.pk)))
+        self.assertTrue(principal.usuario_do_token(self.token, self.carregar).is_staff)
+
+
+class PresencaTests(SimpleTestCase):
+    def setUp(self):
+        presence._registro = None
+        self.addCleanup(setattr, presence, "_registro", None)
+        relogio = mock.patch.object(presence.time, "monotonic", return_value=1000.0)
+        self.relogio = relogio.start()
+        self.addCleanup(relogio.stop)
+
+    @override_settings(PRESENCE_BACKEND="local", PRESENCE_TTL_SECONDS=30)
+    def test_marcacao_expira_depois_do_ttl(self):
+        presence.marcar_online(1)
+        presence.marcar_online(2)
+        self.assertEqual(presence.contar_online(), 2)
+        self.relogio.return_value = 1020.0
+        presence.marcar_online(2)
+        self.relogio.return_value = 1031.0
+        # A de 1 venceu em 1030; a de 2 foi renovada até 1050.
+        self.assertEqual(presence.contar_online(), 1)
+        self.assertTrue(presence.ha_ecotaxista_online())
+        self.relogio.return_value = 1051.0
+        self.assertEqual(presence.contar_online(), 0)
+
+    @override_settings(PRESENCE_BACKEND="local", PRESENCE_TTL_SECONDS=30)
+    def test_offline_sai_na_hora(self):
+        presence.marcar_online(1)
+        presence.marcar_offline(1)
+        self.assertEqual(presence.contar_online(), 0)
+
+
+class ProtocoloBinarioTests(SimpleTestCase):
+    def test_ping_ida_e_volta(self):
+        dados = protocol.codificar_ping(-22.761234, -43.105678, precisao_m=7.5, bearing=90.0, corrida_id=42)
+        self.assertEqual(len(dados), 21)
+        self.assertEqual(
+            protocol.decodificar_ping(dados),
+            {"latitude": -22.761234, "longitude": -43.105678, "precisao_m": 7.5, "bearing": 90.0, "corrida_id": 42},
+        )
+
+    def test_ping_sem_opcionais(self):
+        ping = protocol.decodificar_ping(protocol.codificar_ping(-22.76, -43.1))
+        self.assertIsNone(ping["precisao_m"])
+        self.assertIsNone(ping["bearing"])
+        self.assertIsNone(ping["corrida_id"])
+
+    def test_localizacao_ida_e_volta(self):
+        payload = {
+            "corrida_id": 7,
+            "latitude": "-22.761234",
+            "longitude": "-43.105678",
+            "precisao_m": None,
+            "bearing": 180.0,
+            "ping_em": "2026-01-02T03:04:05.678000+00:00",
+        }
+        self.assertEqual(
+            protocol.decodificar_localizacao(protocol.codificar_localizacao(payload)),
+            {
+                "type": "driver_location",
+                "corrida_id": 7,
+                "latitude": -22.761234,
+                "longitude": -43.105678,
+                "precisao_m": None,
+                "bearing": 180.0,
+                "ping_em": "2026-01-02T03:04:05.678000+00:00",
+            },
+        )
+
+    def test_quadro_invalido_vira_none(self):
+        ping = protocol.codificar_ping(-22.76, -43.1)
+        self.assertIsNone(protocol.decodificar_ping(ping[:-1]))
+        self.assertIsNone(protocol.decodificar_ping(protocol.PONG))
+        # Tipo trocado com o tamanho certo também é rejeitado.
+        self.assertIsNone(protocol.decodificar_ping(bytes([protocol.TIPO_PONG]) + ping[1:]))
+        self.assertIsNone(protocol.decodificar_localizacao(ping))
+        self.assertEqual(protocol.PONG, b"\x03")
+
+
+def _lng_km(km: float) -> float:
+    # No equador 1 km de longitude ≈ 1/111,195 grau.
+    return km / 111.195
+
+
+@override_settings(DISPATCH_DISTANCE="linha_reta")
+class AtribuicaoEmLoteTests(SimpleTestCase):
+    def _guloso(self, corridas, motoristas):
+        # O despacho imediato: cada corrida, na ordem, leva o motorista livre mais próximo.
+        livres = dict(motoristas)
+        total = 0.0
+        for _, lat, lng, _ in corridas:
+            distancias = dispatch.distancias_ate_origem(lat, lng, livres)
+            perfil_id = min(distancias, key=distancias.get)
+            total += distancias.pop(perfil_id)
+            del livres[perfil_id]
+        return total
+
+    def test_hungaro_minimiza_o_total_onde_o_guloso_nao(self):
+        # Corridas em 0 km e 1 km; motoristas em 0,6 km e -1 km. O guloso dá o de 0,6 km à primeira
+        # (0,6 + 2,0 = 2,6 km); o ótimo cruza (1,0 + 0,4 = 1,4 km).
+        corridas = [(1, 0.0, 0.0, []), (2, 0.0, _lng_km(1.0), [])]
+        motoristas = {10: (0.0, _lng_km(0.6)), 20: (0.0, _lng_km(-1.0))}
+        pares = dispatch.resolver_atribuicao(corridas, motoristas)
+        self.assertEqual({(corrida, motorista) for corrida, motorista, _ in pares}, {(1, 20), (2, 10)})
+        self.assertAlmostEqual(sum(dist for _, _, dist in pares), 1.4, places=3)
+        self.assertAlmostEqual(self._guloso(corridas, motoristas), 2.6, places=3)
+
+    def test_tentados_e_raio_ficam_de_fora(self):
+        corridas = [(1, 0.0, 0.0, [10]), (2, 0.0, _lng_km(1.0), [])]
+        motoristas = {10: (0.0, _lng_km(0.1)), 20: (0.0, _lng_km(10.0))}
+        # 10 já recusou a corrida 1 e 20 está fora do raio das duas: só sobra 10 na corrida 2.
+        pares = dispatch.resolver_atribuicao(corridas, motoristas, raio_km=3.0)
+        self.assertEqual([(corrida, motorista) for corrida, motorista, _ in pares], [(2, 10)])
+
+    def test_mais_corridas_que_motoristas(self):
+        corridas = [(i, 0.0, _lng_km(float(i)), []) for i in range(1, 5)]
+        pares = dispatch.resolver_atribuicao(corridas, {10: (0.0, _lng_km(2.9))})
+        self.assertEqual([(corrida, motorista) for corrida, motorista, _ in pares], [(3, 10)])
+
+    def test_hungaro_direto(self):
+        # A linha 0 prefere a coluna 1, mas só ela é barata para a linha 1: o ótimo é 2 + 1,5; o guloso
+        # por linha daria 1 + 9.
+        self.assertEqual(dispatch._hungaro([[2.0, 1.0, 9.0], [9.0, 1.5, 9.0]]), [0, 1])
+        self.assertEqual(dispatch._hungaro([]), [])
+
+
+class DistanciaPorEstradaTests(SimpleTestCase):
+    def setUp(self):
+        dispatch.limpar_cache_distancias()
+        self.addCleanup(dispatch.limpar_cache_distancias)
+
+    def _grafo(self):
+        # Origem no nó 0; o nó 1 fica a 0,3 km em linha reta mas a 5 km pela malha, o nó 2 a 0,8 km e 1 km.
+        nos = [(0.0, 0.0), (0.0, _lng_km(0.3)), (0.0, _lng_km(-0.8))]
+        arestas = {0: [(1, 5000.0), (2, 1000.0)], 1: [(0, 5000.0)], 2: [(0, 1000.0)]}
+        return RoadGraph(nodes=nos, edges=arestas)
+
+    def test_estrada_muda_o_motorista_escolhido(self):
+        grafo = self._grafo()
+        corridas = [(1, 0.0, 0.0, [])]
+        motoristas = {10: grafo.nodes[1], 20: grafo.nodes[2]}
+        with mock.patch.object(dispatch, "grafo_de_vias", return_value=grafo):
+            por_estrada = dispatch.resolver_atribuicao(corridas, motoristas, raio_km=10, modo_distancia="estrada")
+        em_linha_reta = dispatch.resolver_atribuicao(corridas, motoristas, raio_km=10, modo_distancia="linha_reta")
+        self.assertEqual([(c, m) for c, m, _ in por_estrada], [(1, 20)])
+        self.assertAlmostEqual(por_estrada[0][2], 1.0, places=3)
+        self.assertEqual([(c, m) for c, m, _ in em_linha_reta], [(1, 10)])
+
+    def test_cache_por_no_vale_so_para_o_mesmo_grafo(self):
+        grafo = self._grafo()
+        motoristas = {10: grafo.nodes[1]}
+        with mock.patch.object(grafo, "distances_from", wraps=grafo.distances_from) as busca:
+            for _ in range(2):
+                dispatch.distancias_ate_origem(0.0, 0.0, motoristas, modo="estrada", grafo=grafo)
+        self.assertEqual(busca.call_count, 1)
+        # Malha recarregada: outro objeto, as buscas antigas não valem.
+        novo = self._grafo()
+        novo.edges[0] = [(1, 2000.0)]
+        novo.edges[1] = [(0, 2000.0)]
+        distancias = dispatch.distancias_ate_origem(0.0, 0.0, motoristas, modo="estrada", grafo=novo)
+        self.assertAlmostEqual(distancias[10], 2.0, places=3)
@@ -1,4 +1,3 @@
-import math
 import uuid
 from datetime import datetime, timedelta, timezone
 
@@ -12,100 +11,46 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .constants import PING_MAX_AGE_MINUTES
-from .models import Corrida, FcmDeviceToken, LocalizacaoPing, Perfil
+from .models import Corrida, EventoCorrida, FcmDeviceToken, LocalizacaoPing, Perfil
+from .outbox import registrar_evento
+from .pagination import CriadoEmCursorPagination
+from .presence import ha_ecotaxista_online, marcar_online
 from .serializers import (
+    CORRIDA_RELACIONADOS,
     CorridaCreateSerializer,
     CorridaSerializer,
     CorridaStatusSerializer,
     FcmDeviceTokenSerializer,
     LocalizacaoPingSerializer,
     PerfilSerializer,
+    ultimos_pings,
 )
-from .tasks import notificar_sem_motoristas
-from .realtime import notify_corrida, notify_driver_location
+from .realtime import (
+    notify_corrida,
+    notify_driver_location,
+    notify_motorista_proximo,
+)
+from .dispatch import (
+    _auto_atribuir_por_ping,
+    _haversine_km,
+    _limitar_motoristas_tentados,
+    atribuir_motorista_proximo,
+    expirar_oferta,
+)
 
 ACTIVE_STATUSES = ["aguardando", "aceita", "em_andamento"]
 DISTANCIA_MAX_INICIO_KM = 0.25  # motorista precisa estar próximo da origem para iniciar
 TEMPO_CANCELAMENTO_APOS_ACEITE = timedelta(minutes=2)
 TEMPO_CANCELAMENTO_APOS_INICIO = timedelta(minutes=1)
 TEMPO_FINALIZAR_PASSAGEIRO = timedelta(minutes=3)
-MAX_MOTORISTAS_TENTADOS = 50
-AUTO_MATCH_RADIUS_KM = 3.0
-AUTO_MATCH_LIMIT = 50
-
-
-def _haversine_km(lat1, lon1, lat2, lon2):
-    # Distância aproximada em km entre dois pontos lat/lng
-    r = 6371
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
-    return 2 * r * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-
-def _limitar_motoristas_tentados(lista):
-    if not lista:
-        return []
-    unique = list(dict.fromkeys(int(x) for x in lista if x is not None))
-    if len(unique) > MAX_MOTORISTAS_TENTADOS:
-        unique = unique[-MAX_MOTORISTAS_TENTADOS:]
-    return unique
-
-
-def _ha_ecotaxista_online() -> bool:
-    limite_tempo = datetime.now(timezone.utc) - timedelta(minutes=PING_MAX_AGE_MINUTES)
-    return LocalizacaoPing.objects.filter(perfil__tipo="ecotaxista", criado_em__gte=limite_tempo).exists()
-
-
-def _auto_atribuir_por_ping(perfil: Perfil, lat: float, lng: float) -> Corrida | None:
-    if perfil.tipo != "ecotaxista":
-        return None
-    if Corrida.objects.filter(motorista=perfil, status__in=ACTIVE_STATUSES).exists():
-        return None
-    candidatas = (
-        Corrida.objects.filter(
-            status="aguardando",
-            motorista__isnull=True,
-            origem_lat__isnull=False,
-            origem_lng__isnull=False,
-        )
-        .order_by("-criado_em")[:AUTO_MATCH_LIMIT]
-    )
-    melhor = None
-    melhor_dist = None
-    for corrida in candidatas:
-        if perfil.id in (corrida.motoristas_tentados or []):
-            continue
-        dist = _haversine_km(lat, lng, float(corrida.origem_lat), float(corrida.origem_lng))
-        if dist > AUTO_MATCH_RADIUS_KM:
-            continue
-        if melhor_dist is None or dist < melhor_dist:
-            melhor = corrida
-            melhor_dist = dist
-    if not melhor:
-        return None
-    with transaction.atomic():
-        corrida = Corrida.objects.select_for_update().get(pk=melhor.id)
-        if corrida.status != "aguardando" or corrida.motorista_id:
-            return None
-        if Corrida.objects.filter(motorista=perfil, status__in=ACTIVE_STATUSES).exists():
-            return None
-        corrida.motorista = perfil
-        tentativa_lista = set(corrida.motoristas_tentados or [])
-        tentativa_lista.add(perfil.id)
-        corrida.motoristas_tentados = _limitar_motoristas_tentados(list(tentativa_lista))
-        corrida.save(update_fields=["motorista", "status", "atualizado_em", "motoristas_tentados"])
-        notify_corrida(corrida, event_type="ride_assigned")
-        return corrida
 
 
 def _perfil_usuario(user, tipo: str | None = None) -> Perfil:
     if not user or not user.is_authenticated:
         raise PermissionDenied("Autenticação obrigatória.")
     try:
-        perfil = Perfil.objects.get(user=user)
+        # perfil_app vem anexado pelo cache do principal (corridas.principal) na autenticação.
+        perfil = user.perfil_app
     except Perfil.DoesNotExist as exc:
         raise PermissionDenied("Perfil não encontrado para o usuário autenticado.") from exc
     if tipo:
@@ -136,6 +81,22 @@ def _perfil_autorizado(request, perfil_id: int | None = None, tipo: str | None =
     return perfil
 
 
+def _etag_corrida(corrida: Corrida | None, pings: dict) -> str:
+    """
+    Muda quando a corrida é gravada ou o motorista manda ping: o que o CorridaSerializer mostra.
+    `pings` é o ultimos_pings do motorista, o mesmo que vai para o corpo da resposta.
+    """
+    if not corrida:
+        return '"0"'
+    ultimo_ping = pings.get(corrida.motorista_id) if corrida.motorista_id else None
+    return f'"{corrida.id}-{corrida.atualizado_em.timestamp():.6f}-{ultimo_ping["id"] if ultimo_ping else 0}"'
+
+
+def _etags_if_none_match(request) -> set[str]:
+    valor = request.headers.get("If-None-Match") or ""
+    return {etag.strip().removeprefix("W/") for etag in valor.split(",") if etag.strip()}
+
+
 class DeviceRegisterView(APIView):
     """
     Atualiza o modo do usuário (passageiro/ecotaxista) e associa dados do device ao próprio usuário.
@@ -215,8 +176,9 @@ class DeviceFcmRegisterView(APIView):
 
 
 class CorridaViewSet(viewsets.ModelViewSet):
-    queryset = Corrida.objects.select_related("cliente__user", "motorista__user").all()
+    queryset = Corrida.objects.select_related(*CORRIDA_RELACIONADOS).all()
     serializer_class = CorridaSerializer
+    pagination_class = CriadoEmCursorPagination
     http_method_names = ["get", "post", "patch"]
     permission_classes = [IsAuthenticated]
 
@@ -236,7 +198,7 @@ class CorridaViewSet(viewsets.ModelViewSet):
         if not user or not user.is_authenticated:
             return qs.none()
         try:
-            perfil = Perfil.objects.get(user=user)
+            perfil = user.perfil_app
         except Perfil.DoesNotExist:
             return qs.none()
         if perfil_id:
@@ -254,44 +216,9 @@ class CorridaViewSet(viewsets.ModelViewSet):
 
     def _corrida_expirada(self, corrida: Corrida) -> bool:
         """
-        Considera expirada apenas se aguardando com motorista atribuído por mais de 2 minutos.
+        Expira na hora a oferta vencida que ainda não passou pela varredura (corrida já travada).
         """
-        if corrida.status != "aguardando":
-            return False
-        if not corrida.motorista_id:
-            return False
-        referencia = corrida.atualizado_em or corrida.criado_em
-        if not referencia:
-            return False
-        agora = datetime.now(timezone.utc)
-        if agora - referencia > timedelta(minutes=2):
-            motorista_expirado_id = corrida.motorista_id
-            corrida.motoristas_tentados = _limitar_motoristas_tentados(
-                (corrida.motoristas_tentados or []) + [motorista_expirado_id]
-            )
-            corrida.status = "aguardando"
-            corrida.motorista = None
-            corrida.aceita_em = None
-            corrida.iniciada_em = None
-            corrida.concluida_em = None
-            corrida.save(
-                update_fields=[
-                    "status",
-                    "motorista",
-                    "atualizado_em",
-                    "motoristas_tentados",
-                    "aceita_em",
-                    "iniciada_em",
-                    "concluida_em",
-                ]
-            )
-            self._atribuir_motorista_proximo(
-                corrida,
-                excluir_motorista_id=motorista_expirado_id,
-                allow_reset=False,
-            )
-            return True
-        return False
+        return expirar_oferta(corrida)
 
     def _atribuir_motorista_proximo(
         self, corrida: Corrida, excluir_motorista_id: int | None = None, allow_reset: bool = True
@@ -299,64 +226,9 @@ class CorridaViewSet(viewsets.ModelViewSet):
         """
         Seleciona automaticamente um ecotaxista próximo baseado em pings recentes.
         """
-        if corrida.origem_lat is None or corrida.origem_lng is None:
-            return None
-        limite_tempo = datetime.now(timezone.utc) - timedelta(minutes=PING_MAX_AGE_MINUTES)
-        pings = (
-            LocalizacaoPing.objects.select_related("perfil__user")
-            .filter(perfil__tipo="ecotaxista", criado_em__gte=limite_tempo)
-            .order_by("-criado_em")
-        )
-        vistos = set()
-        candidatos = []
-        excluidos = set(corrida.motoristas_tentados or [])
-        total_pingados = 0
-        for ping in pings:
-            if ping.perfil_id in vistos:
-                continue
-            if excluir_motorista_id and ping.perfil_id == excluir_motorista_id:
-                continue
-            total_pingados += 1
-            if ping.perfil_id in excluidos:
-                continue
-            dist = _haversine_km(
-                float(corrida.origem_lat),
-                float(corrida.origem_lng),
-                float(ping.latitude),
-                float(ping.longitude),
-            )
-            vistos.add(ping.perfil_id)
-            candidatos.append((dist, ping.perfil))
-        candidatos.sort(key=lambda x: x[0])
-        if not candidatos and allow_reset and excluidos and total_pingados:
-            # Tentou todos os pingados; limpa tentados e tenta novamente
-            corrida.motoristas_tentados = []
-            corrida.save(update_fields=["motoristas_tentados", "atualizado_em"])
-            return self._atribuir_motorista_proximo(corrida, excluir_motorista_id=excluir_motorista_id, allow_reset=False)
-        if not candidatos:
-            return None
-        novo_motorista = candidatos[0][1]
-        corrida.motorista = novo_motorista
-        corrida.status = "aguardando"
-        corrida.aceita_em = None
-        corrida.iniciada_em = None
-        corrida.concluida_em = None
-        tentativa_lista = set(corrida.motoristas_tentados or [])
-        tentativa_lista.add(novo_motorista.id)
-        corrida.motoristas_tentados = _limitar_motoristas_tentados(list(tentativa_lista))
-        corrida.save(
-            update_fields=[
-                "motorista",
-                "status",
-                "atualizado_em",
-                "motoristas_tentados",
-                "aceita_em",
-                "iniciada_em",
-                "concluida_em",
-            ]
+        return atribuir_motorista_proximo(
+            corrida, excluir_motorista_id=excluir_motorista_id, allow_reset=allow_reset
         )
-        notify_corrida(corrida, event_type="ride_assigned")
-        return novo_motorista
 
     def _dist_motorista_origem_km(self, corrida: Corrida) -> float | None:
         """
@@ -380,6 +252,7 @@ class CorridaViewSet(viewsets.ModelViewSet):
         )
 
     @action(detail=False, methods=["post"], url_path="solicitar")
+    @transaction.atomic
     def solicitar(self, request):
         serializer = CorridaCreateSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -408,12 +281,9 @@ class CorridaViewSet(viewsets.ModelViewSet):
             destino_endereco=data.get("destino_endereco", ""),
         )
         motorista = self._atribuir_motorista_proximo(corrida)
-        if not motorista and not _ha_ecotaxista_online():
-            try:
-                notificar_sem_motoristas.delay(corrida.id)
-            except Exception:
-                # Evita quebrar a criação da corrida se o broker estiver indisponível.
-                pass
+        if not motorista and not ha_ecotaxista_online():
+            # Push para os motoristas sai pelo outbox: sobrevive a broker/FCM fora do ar.
+            registrar_evento(corrida, "ride_available", {"corrida_id": corrida.id}, canal=EventoCorrida.CANAL_FCM)
         notify_corrida(corrida, event_type="ride_created")
         return Response(CorridaSerializer(corrida).data, status=status.HTTP_201_CREATED)
 
@@ -528,6 +398,7 @@ class CorridaViewSet(viewsets.ModelViewSet):
             return Response(CorridaSerializer(corrida).data)
 
     @action(detail=True, methods=["post"], url_path="cancelar")
+    @transaction.atomic
     def cancelar(self, request, pk=None):
         corrida = self.get_object()
         perfil_id = request.data.get("perfil_id")
@@ -566,6 +437,7 @@ class CorridaViewSet(viewsets.ModelViewSet):
         return Response(CorridaSerializer(corrida).data)
 
     @action(detail=True, methods=["post"], url_path="reatribuir")
+    @transaction.atomic
     def reatribuir(self, request, pk=None):
         """
         Libera a corrida para reatribuição após timeout ou rejeição.
@@ -607,6 +479,7 @@ class CorridaViewSet(viewsets.ModelViewSet):
         return Response(CorridaSerializer(corrida).data)
 
     @action(detail=True, methods=["post"], url_path="rejeitar")
+    @transaction.atomic
     def rejeitar(self, request, pk=None):
         corrida = self.get_object()
         motorista_id = request.data.get("motorista_id")
@@ -643,6 +516,7 @@ class CorridaViewSet(viewsets.ModelViewSet):
         return Response(CorridaSerializer(corrida).data)
 
     @action(detail=True, methods=["post"], url_path="status")
+    @transaction.atomic
     def atualizar_status(self, request, pk=None):
         corrida = self.get_object()
         if not request.user.is_staff:
@@ -710,20 +584,18 @@ class CorridaViewSet(viewsets.ModelViewSet):
         _perfil_autorizado(request, motorista_id_int, tipo="ecotaxista")
 
         corrida = (
-            Corrida.objects.filter(
+            self.queryset.filter(
                 motorista_id=motorista_id_int,
                 status__in=ACTIVE_STATUSES,
             )
             .order_by("-atualizado_em", "-criado_em")
             .first()
         )
-        if not corrida:
-            return Response({}, status=status.HTTP_200_OK)
-        if self._corrida_expirada(corrida):
-            corrida.refresh_from_db()
-        if not corrida.motorista_id or corrida.motorista_id != motorista_id_int or corrida.status not in ACTIVE_STATUSES:
-            return Response({}, status=status.HTTP_200_OK)
-        return Response(CorridaSerializer(corrida).data)
+        vencida = corrida and corrida.oferta_expira_em and corrida.oferta_expira_em <= datetime.now(timezone.utc)
+        if vencida and corrida.status == "aguardando":
+            # Oferta vencida: a varredura devolve a corrida para a fila.
+            corrida = None
+        return self._corrida_ativa_condicional(request, corrida)
 
     @action(
         detail=False,
@@ -741,27 +613,38 @@ class CorridaViewSet(viewsets.ModelViewSet):
         _perfil_autorizado(request, passageiro_id_int, tipo="passageiro")
 
         corrida = (
-            Corrida.objects.filter(
+            self.queryset.filter(
                 cliente_id=passageiro_id_int,
                 status__in=ACTIVE_STATUSES,
             )
             .order_by("-atualizado_em", "-criado_em")
             .first()
         )
-        if not corrida:
-            return Response({}, status=status.HTTP_200_OK)
-        if self._corrida_expirada(corrida):
-            corrida.refresh_from_db()
-        if corrida.status == "aguardando" and not corrida.motorista_id:
-            # tenta reatribuir periodicamente até encontrar alguém
-            self._atribuir_motorista_proximo(corrida, allow_reset=False)
-            corrida.refresh_from_db()
-        return Response(CorridaSerializer(corrida).data)
+        return self._corrida_ativa_condicional(request, corrida)
+
+    def _corrida_ativa_condicional(self, request, corrida):
+        """
+        Resposta de para_motorista/para_passageiro com ETag: se o If-None-Match do app ainda vale,
+        devolve 304 sem serializar. O último ping do motorista é lido uma vez, para o ETag e o corpo.
+        """
+        pings = ultimos_pings([corrida.motorista_id]) if corrida else {}
+        etag = _etag_corrida(corrida, pings)
+        if etag in _etags_if_none_match(request):
+            resposta = Response(status=status.HTTP_304_NOT_MODIFIED)
+        elif corrida:
+            serializer = CorridaSerializer(corrida)
+            serializer._pings_por_motorista.update(pings)
+            resposta = Response(serializer.data, status=status.HTTP_200_OK)
+        else:
+            resposta = Response({}, status=status.HTTP_200_OK)
+        resposta["ETag"] = etag
+        return resposta
 
 
 class LocalizacaoPingViewSet(viewsets.ModelViewSet):
     queryset = LocalizacaoPing.objects.select_related("perfil__user").all()
     serializer_class = LocalizacaoPingSerializer
+    pagination_class = CriadoEmCursorPagination
     http_method_names = ["get", "post"]
     permission_classes = [IsAuthenticated]
 
@@ -805,6 +688,8 @@ class LocalizacaoPingViewSet(viewsets.ModelViewSet):
 
         ping = serializer.save(perfil=perfil, bearing=bearing)
         print(f"DEBUG: LocalizacaoPingViewSet.perform_create - Saved ping.bearing: {ping.bearing}") # ADD THIS LINE
+        if perfil.tipo == "ecotaxista":
+            marcar_online(perfil.id)
 
         try:
             _auto_atribuir_por_ping(
@@ -823,6 +708,14 @@ class LocalizacaoPingViewSet(viewsets.ModelViewSet):
             bearing=ping.bearing, # Pass bearing
             ping_em=ping.criado_em,
         )
+        if perfil.tipo == "ecotaxista":
+            notify_motorista_proximo(
+                perfil_id=perfil.id,
+                latitude=float(ping.latitude),
+                longitude=float(ping.longitude),
+                bearing=ping.bearing,
+                ping_em=ping.criado_em,
+            )
 
 
 class MotoristasProximosView(APIView):
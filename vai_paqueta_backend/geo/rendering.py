@@ -0,0 +1,501 @@
+"""
+Desenho dos SVGs de trajeto, compartilhado pelo relatorio_corridas e pelo laboratório de relatório.
+
+O recorte é o retângulo de tiles (WebMercator, 256 px) que cobre a rota com uma tile de margem; por cima
+das tiles vão as vias da malha manual, a rota e os marcadores de início e fim.
+
+As vias são projetadas uma vez por zoom (CamadaVias, em pixels globais) com um índice por tile: cada SVG
+só pega as vias com vértice nas tiles do seu recorte e as translada, sem reprojetar a malha inteira.
+
+png_trajeto desenha o mesmo trajeto em PNG (Pillow, dependência opcional): as tiles são coladas uma faixa
+de 256 px de altura por vez e cada faixa já vai comprimida para o arquivo, então a memória fica em uma
+faixa, não no mosaico inteiro.
+
+Cada SVG embute as tiles do seu recorte em base64 e corridas vizinhas usam as mesmas tiles. Em vez de ler
+e codificar o PNG a cada SVG, o base64 fica num LRU em memória (TILE_CACHE_MAX_ITENS tiles, chave z/x/y) e,
+opcionalmente, num depósito em disco de tiles já codificadas (TILE_B64_DIR, arquivos z/x/y.b64), que
+sobrevive entre execuções do relatório. No modo "href" o SVG só referencia a tile pela URL, sem embutir:
+fica pequeno, mas depende de a tile estar acessível para quem abre o arquivo.
+"""
+
+from __future__ import annotations
+
+import base64
+import math
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Sequence
+
+from django.conf import settings
+
+from geo import views as geo_views
+from geo.tiles import TILE_SIZE, colar_tiles
+
+MODOS_TILE = ("embed", "href")
+_MARGEM_TILES = 1
+
+_LRU_LOCK = threading.Lock()
+_LRU: OrderedDict[tuple[str, str], str] = OrderedDict()
+
+
+def _max_itens() -> int:
+    return max(0, int(getattr(settings, "TILE_CACHE_MAX_ITENS", 512)))
+
+
+def _lru_get(chave: tuple[str, str]) -> str | None:
+    with _LRU_LOCK:
+        valor = _LRU.get(chave)
+        if valor is not None:
+            _LRU.move_to_end(chave)
+        return valor
+
+
+def _lru_set(chave: tuple[str, str], valor: str) -> None:
+    limite = _max_itens()
+    if limite <= 0:
+        return
+    with _LRU_LOCK:
+        _LRU[chave] = valor
+        _LRU.move_to_end(chave)
+        while len(_LRU) > limite:
+            _LRU.popitem(last=False)
+
+
+class TileAssets:
+    """
+    Fonte das tiles de um diretório z/x/y.png para os SVGs. `modo` "embed" gera data URIs em base64;
+    "href" aponta para `href_base`/z/x/y.png (padrão: URI file:// do próprio diretório).
+    """
+
+    def __init__(
+        self,
+        root: Path | None,
+        modo: str = "embed",
+        href_base: str | None = None,
+        b64_dir: Path | None = None,
+    ):
+        if modo not in MODOS_TILE:
+            raise ValueError(f"Modo de tile inválido: {modo}")
+        self.root = root
+        self.modo = modo
+        if href_base is None and root is not None:
+            href_base = root.resolve().as_uri()
+        self.href_base = (href_base or "").rstrip("/")
+        self.b64_dir = b64_dir
+
+    @classmethod
+    def padrao(
+        cls,
+        root: Path | None,
+        modo: str | None = None,
+        href_base: str | None = None,
+        b64_dir: Path | None = None,
+    ) -> TileAssets:
+        """Instância com o que não vier nos argumentos tirado dos settings (TILE_SVG_MODO etc.)."""
+        if b64_dir is None and getattr(settings, "TILE_B64_DIR", ""):
+            b64_dir = Path(settings.TILE_B64_DIR)
+        return cls(
+            root,
+            modo=modo or getattr(settings, "TILE_SVG_MODO", "embed"),
+            href_base=href_base or getattr(settings, "TILE_HREF_BASE", "") or None,
+            b64_dir=b64_dir,
+        )
+
+    def _caminho(self, zoom: int, tile_x: int, tile_y: int) -> Path:
+        return self.root / str(zoom) / str(tile_x) / f"{tile_y}.png"
+
+    def _base64(self, zoom: int, tile_x: int, tile_y: int) -> str | None:
+        relativo = f"{zoom}/{tile_x}/{tile_y}"
+        chave = (str(self.root), relativo)
+        encoded = _lru_get(chave)
+        if encoded is not None:
+            return encoded
+        tile_path = self._caminho(zoom, tile_x, tile_y)
+        encoded = self._ler_b64(relativo, tile_path)
+        if encoded is None:
+            try:
+                data = tile_path.read_bytes()
+            except OSError:
+                # Tile ausente não entra no cache: pode ser baixada depois sem reiniciar o processo.
+                return None
+            encoded = base64.b64encode(data).decode("ascii")
+            self._gravar_b64(relativo, encoded)
+        _lru_set(chave, encoded)
+        return encoded
+
+    def _ler_b64(self, relativo: str, tile_path: Path) -> str | None:
+        if not self.b64_dir:
+            return None
+        destino = self.b64_dir / f"{relativo}.b64"
+        try:
+            # Só vale se for mais novo que o PNG (tile rebaixada invalida o pré-codificado).
+            if destino.stat().st_mtime < tile_path.stat().st_mtime:
+                return None
+            return destino.read_text(encoding="ascii")
+        except OSError:
+            return None
+
+    def _gravar_b64(self, relativo: str, encoded: str) -> None:
+        if not self.b64_dir:
+            return
+        destino = self.b64_dir / f"{relativo}.b64"
+        try:
+            destino.parent.mkdir(parents=True, exist_ok=True)
+            # Escreve num temporário e renomeia: workers paralelos não leem arquivo pela metade.
+            temporario = destino.with_name(f"{destino.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            temporario.write_text(encoded, encoding="ascii")
+            temporario.replace(destino)
+        except OSError:
+            pass
+
+    def href(self, zoom: int, tile_x: int, tile_y: int) -> str | None:
+        if self.root is None:
+            return None
+        if self.modo == "href":
+            relativo = f"{zoom}/{tile_x}/{tile_y}"
+            chave = (f"href:{self.root}:{self.href_base}", relativo)
+            url = _lru_get(chave)
+            if url is None:
+                if not self._caminho(zoom, tile_x, tile_y).exists():
+                    return None
+                url = f"{self.href_base}/{relativo}.png"
+                _lru_set(chave, url)
+            return url
+        encoded = self._base64(zoom, tile_x, tile_y)
+        if encoded is None:
+            return None
+        return f"data:image/png;base64,{encoded}"
+
+    def imagens_svg(self, zoom: int, tile_min_x: int, tile_max_x: int, tile_min_y: int, tile_max_y: int) -> list[str]:
+        """Elementos <image> das tiles do recorte, posicionados a partir do canto (tile_min_x, tile_min_y)."""
+        imagens = []
+        for tile_x in range(tile_min_x, tile_max_x + 1):
+            for tile_y in range(tile_min_y, tile_max_y + 1):
+                href = self.href(zoom, tile_x, tile_y)
+                if href is None:
+                    continue
+                x = (tile_x - tile_min_x) * TILE_SIZE
+                y = (tile_y - tile_min_y) * TILE_SIZE
+                imagens.append(
+                    f'<image href="{href}" x="{x}" y="{y}" width="{TILE_SIZE}" height="{TILE_SIZE}" '
+                    'preserveAspectRatio="none" />'
+                )
+        return imagens
+
+
+def latlng_to_pixel(lat: float, lng: float, zoom: int) -> tuple[float, float]:
+    """Pixel global (WebMercator) de lat/lng no zoom, alinhado com as tiles z/x/y."""
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    n = 2**zoom
+    x = (lng + 180.0) / 360.0
+    lat_rad = math.radians(lat)
+    y = (1 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2
+    return x * n * TILE_SIZE, y * n * TILE_SIZE
+
+
+@dataclass
+class Recorte:
+    zoom: int
+    tile_min_x: int
+    tile_max_x: int
+    tile_min_y: int
+    tile_max_y: int
+
+    @classmethod
+    def da_rota(cls, pixels: Sequence[tuple[float, float]], zoom: int) -> Recorte:
+        n_tiles = 2**zoom
+        px_vals = [p[0] for p in pixels]
+        py_vals = [p[1] for p in pixels]
+        return cls(
+            zoom=zoom,
+            tile_min_x=max(0, int(math.floor(min(px_vals) / TILE_SIZE)) - _MARGEM_TILES),
+            tile_max_x=min(n_tiles - 1, int(math.floor(max(px_vals) / TILE_SIZE)) + _MARGEM_TILES),
+            tile_min_y=max(0, int(math.floor(min(py_vals) / TILE_SIZE)) - _MARGEM_TILES),
+            tile_max_y=min(n_tiles - 1, int(math.floor(max(py_vals) / TILE_SIZE)) + _MARGEM_TILES),
+        )
+
+    @property
+    def width(self) -> int:
+        return (self.tile_max_x - self.tile_min_x + 1) * TILE_SIZE
+
+    @property
+    def height(self) -> int:
+        return (self.tile_max_y - self.tile_min_y + 1) * TILE_SIZE
+
+    @property
+    def offset_x(self) -> int:
+        return self.tile_min_x * TILE_SIZE
+
+    @property
+    def offset_y(self) -> int:
+        return self.tile_min_y * TILE_SIZE
+
+
+class CamadaVias:
+    """
+    Vias projetadas num zoom, com índice tile -> vias que têm vértice nela. O trecho SVG de cada recorte
+    também fica guardado (corridas vizinhas caem no mesmo recorte de tiles).
+    """
+
+    def __init__(self, roads: list[dict[str, object]], zoom: int):
+        self.roads = roads
+        self.zoom = zoom
+        self.vias: list[tuple[list[tuple[float, float]], str]] = []
+        self._indice: dict[tuple[int, int], list[int]] = defaultdict(list)
+        self._trechos: OrderedDict[tuple[int, int, int, int], list[str]] = OrderedDict()
+        self._lock = threading.Lock()
+        for road in roads:
+            pontos = [latlng_to_pixel(float(lat), float(lng), zoom) for lat, lng in road.get("points") or []]
+            if len(pontos) < 2:
+                continue
+            idx = len(self.vias)
+            self.vias.append((pontos, road.get("color") or "#94a3b8"))
+            for tile in {(int(px // TILE_SIZE), int(py // TILE_SIZE)) for px, py in pontos}:
+                self._indice[tile].append(idx)
+
+    def no_recorte(self, recorte: Recorte):
+        """Vias com algum vértice dentro do recorte (bordas inclusive), na ordem do arquivo de vias."""
+        x0, y0 = recorte.offset_x, recorte.offset_y
+        x1, y1 = x0 + recorte.width, y0 + recorte.height
+        candidatas: set[int] = set()
+        # +1: um vértice exatamente na borda direita/inferior cai na tile seguinte.
+        for tile_x in range(recorte.tile_min_x, recorte.tile_max_x + 2):
+            for tile_y in range(recorte.tile_min_y, recorte.tile_max_y + 2):
+                candidatas.update(self._indice.get((tile_x, tile_y), ()))
+        for idx in sorted(candidatas):
+            pontos, cor = self.vias[idx]
+            if any(x0 <= px <= x1 and y0 <= py <= y1 for px, py in pontos):
+                yield pontos, cor
+
+    def svg(self, recorte: Recorte) -> list[str]:
+        chave = (recorte.tile_min_x, recorte.tile_max_x, recorte.tile_min_y, recorte.tile_max_y)
+        with self._lock:
+            trecho = self._trechos.get(chave)
+            if trecho is not None:
+                self._trechos.move_to_end(chave)
+                return trecho
+        trecho = [
+            f'<polyline points="{_pontos_svg(pontos, recorte.offset_x, recorte.offset_y)}" fill="none" '
+            f'stroke="{cor}" stroke-width="1" stroke-linejoin="round" stroke-linecap="round" stroke-opacity="0.5" />'
+            for pontos, cor in self.no_recorte(recorte)
+        ]
+        with self._lock:
+            self._trechos[chave] = trecho
+            while len(self._trechos) > _max_itens():
+                self._trechos.popitem(last=False)
+        return trecho
+
+
+_CAMADAS_LOCK = threading.Lock()
+_CAMADAS: dict[int, CamadaVias] = {}
+
+
+def camada_vias(zoom: int) -> CamadaVias | None:
+    """Camada de vias do zoom, refeita quando _load_road_graph recarrega o arquivo de vias."""
+    _, roads, _ = geo_views._load_road_graph()
+    if not isinstance(roads, list):
+        return None
+    with _CAMADAS_LOCK:
+        camada = _CAMADAS.get(zoom)
+        if camada is not None and camada.roads is roads:
+            return camada
+    camada = CamadaVias(roads, zoom)
+    with _CAMADAS_LOCK:
+        _CAMADAS[zoom] = camada
+    return camada
+
+
+def _pontos_svg(pontos, offset_x: float, offset_y: float) -> str:
+    return " ".join(f"{px - offset_x:.2f},{py - offset_y:.2f}" for px, py in pontos)
+
+
+def svg_trajeto(
+    route_points: Sequence[tuple[float, float]],
+    zoom: int,
+    tiles: TileAssets | None,
+    legenda: Sequence[str] = (),
+) -> str | None:
+    """
+    SVG da rota (lista de lat/lng) sobre as tiles e a malha de vias. `legenda` são linhas de texto no
+    canto inferior esquerdo, de cima para baixo.
+    """
+    pixels = [latlng_to_pixel(lat, lng, zoom) for lat, lng in route_points]
+    if not pixels:
+        return None
+    recorte = Recorte.da_rota(pixels, zoom)
+    width, height = recorte.width, recorte.height
+    offset_x, offset_y = recorte.offset_x, recorte.offset_y
+    coords = [(px - offset_x, py - offset_y) for px, py in pixels]
+
+    svg = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">',
+        '<rect width="100%" height="100%" fill="#f8fafc" />',
+    ]
+    if tiles:
+        svg.extend(
+            tiles.imagens_svg(zoom, recorte.tile_min_x, recorte.tile_max_x, recorte.tile_min_y, recorte.tile_max_y)
+        )
+    camada = camada_vias(zoom)
+    if camada:
+        svg.extend(camada.svg(recorte))
+    route_path = " ".join(f"{x:.2f},{y:.2f}" for x, y in coords)
+    svg.append(
+        f'<polyline points="{route_path}" fill="none" stroke="#0f172a" stroke-width="2" '
+        'stroke-linejoin="round" stroke-linecap="round" />'
+    )
+    svg.append(f'<circle cx="{coords[0][0]:.2f}" cy="{coords[0][1]:.2f}" r="5" fill="#22c55e" stroke="#14532d" />')
+    svg.append(f'<circle cx="{coords[-1][0]:.2f}" cy="{coords[-1][1]:.2f}" r="5" fill="#ef4444" stroke="#7f1d1d" />')
+    for idx, linha in enumerate(legenda):
+        y = height - 6 - 14 * (len(legenda) - 1 - idx)
+        svg.append(f'<text x="12" y="{y}" font-size="12" fill="#334155" font-family="sans-serif">{linha}</text>')
+    svg.append("</svg>")
+    return "\n".join(svg)
+
+
+_PNG_ASSINATURA = b"\x89PNG\r\n\x1a\n"
+# Cor de fundo onde falta tile (a mesma do <rect> do SVG).
+_FUNDO_RGB = (248, 250, 252)
+# Cores do desenho (rota, marcadores, legenda, vias, fundo): sempre presentes na paleta do PNG.
+_CORES_DESENHO = ("#0f172a", "#22c55e", "#14532d", "#ef4444", "#7f1d1d", "#334155", "#94a3b8", "#f8fafc")
+# Tiles do zoom usadas para montar a paleta (espalhadas pelo diretório).
+_AMOSTRA_PALETA = 64
+
+_PALETAS_LOCK = threading.Lock()
+_PALETAS: dict[tuple[str, int], object] = {}
+
+
+def _importar_pillow():
+    try:
+        from PIL import Image, ImageColor, ImageDraw, ImageFont
+    except ImportError as exc:
+        raise RuntimeError("Pillow não instalado: instale com `pip install pillow` para gerar PNG.") from exc
+    return Image, ImageColor, ImageDraw, ImageFont
+
+
+def _chunk_png(tipo: bytes, dados: bytes) -> bytes:
+    return struct.pack(">I", len(dados)) + tipo + dados + struct.pack(">I", zlib.crc32(tipo + dados) & 0xFFFFFFFF)
+
+
+def _fonte(ImageFont):
+    # A fonte embutida do Pillow não tem acentos maiúsculos ("Início"); usa a DejaVu do sistema se houver.
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", 12)
+    except OSError:
+        return ImageFont.load_default(size=12)
+
+
+def _paleta(Image, ImageColor, tiles: TileAssets | None, zoom: int):
+    """
+    Paleta fixa do zoom (imagem "P" para Image.quantize): as cores do desenho mais as mais frequentes numa
+    amostra das tiles. Fixa porque o PLTE vai no arquivo antes das faixas.
+    """
+    root = tiles.root if tiles else None
+    chave = (str(root), zoom)
+    with _PALETAS_LOCK:
+        paleta = _PALETAS.get(chave)
+    if paleta is not None:
+        return paleta
+    caminhos = sorted((root / str(zoom)).glob("*/*.png")) if root else []
+    if len(caminhos) > _AMOSTRA_PALETA:
+        passo = len(caminhos) / _AMOSTRA_PALETA
+        caminhos = [caminhos[int(idx * passo)] for idx in range(_AMOSTRA_PALETA)]
+    lado = max(1, math.ceil(math.sqrt(len(caminhos))))
+    mosaico = Image.new("RGB", (lado * TILE_SIZE, lado * TILE_SIZE), _FUNDO_RGB)
+    for idx, caminho in enumerate(caminhos):
+        try:
+            with Image.open(caminho) as tile:
+                mosaico.paste(tile.convert("RGB"), ((idx % lado) * TILE_SIZE, (idx // lado) * TILE_SIZE))
+        except Exception:  # noqa: BLE001
+            continue
+    n_tiles = 256 - len(_CORES_DESENHO)
+    cores = mosaico.quantize(n_tiles, method=Image.Quantize.MEDIANCUT).getpalette()[: n_tiles * 3]
+    cores += [0] * (n_tiles * 3 - len(cores))
+    for cor in _CORES_DESENHO:
+        cores.extend(ImageColor.getrgb(cor)[:3])
+    paleta = Image.new("P", (1, 1))
+    paleta.putpalette(cores)
+    with _PALETAS_LOCK:
+        _PALETAS[chave] = paleta
+    return paleta
+
+
+def png_trajeto(
+    route_points: Sequence[tuple[float, float]],
+    zoom: int,
+    tiles: TileAssets | None,
+    destino: Path,
+    legenda: Sequence[str] = (),
+) -> Path | None:
+    """
+    Grava em `destino` o PNG da rota com o mesmo recorte, vias, cores e marcadores do svg_trajeto. Cada
+    faixa de tiles é composta (tiles, vias a 50% de opacidade, rota, marcadores, legenda), reduzida à
+    paleta do zoom e comprimida direto no arquivo.
+    """
+    Image, ImageColor, ImageDraw, ImageFont = _importar_pillow()
+    pixels = [latlng_to_pixel(lat, lng, zoom) for lat, lng in route_points]
+    if not pixels:
+        return None
+    recorte = Recorte.da_rota(pixels, zoom)
+    width, height = recorte.width, recorte.height
+    offset_x, offset_y = recorte.offset_x, recorte.offset_y
+    coords = [(px - offset_x, py - offset_y) for px, py in pixels]
+    camada = camada_vias(zoom)
+    vias = [
+        ([(px - offset_x, py - offset_y) for px, py in pontos], ImageColor.getrgb(cor)[:3] + (128,))
+        for pontos, cor in (camada.no_recorte(recorte) if camada else ())
+    ]
+    paleta = _paleta(Image, ImageColor, tiles, zoom)
+    fonte = _fonte(ImageFont)
+
+    compressor = zlib.compressobj(6)
+    with destino.open("wb") as arquivo:
+        arquivo.write(_PNG_ASSINATURA)
+        # 8 bits, tipo de cor 3 (paleta).
+        arquivo.write(_chunk_png(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)))
+        arquivo.write(_chunk_png(b"PLTE", bytes(paleta.getpalette()[: 256 * 3])))
+        for tile_y in range(recorte.tile_min_y, recorte.tile_max_y + 1):
+            topo = (tile_y - recorte.tile_min_y) * TILE_SIZE
+
+            def _y(pontos):
+                return [(x, y - topo) for x, y in pontos]
+
+            faixa = Image.new("RGBA", (width, TILE_SIZE), _FUNDO_RGB + (255,))
+            if tiles is not None and tiles.root is not None:
+                colar_tiles(faixa, tiles.root, zoom, recorte.tile_min_x, recorte.tile_max_x, tile_y, tile_y)
+            if vias:
+                sobreposicao = Image.new("RGBA", faixa.size, (0, 0, 0, 0))
+                desenho_vias = ImageDraw.Draw(sobreposicao)
+                for pontos, cor in vias:
+                    desenho_vias.line(_y(pontos), fill=cor, width=1, joint="curve")
+                faixa = Image.alpha_composite(faixa, sobreposicao)
+            desenho = ImageDraw.Draw(faixa)
+            if len(coords) >= 2:
+                desenho.line(_y(coords), fill="#0f172a", width=2, joint="curve")
+            for (x, y), preenchimento, contorno in (
+                (coords[0], "#22c55e", "#14532d"),
+                (coords[-1], "#ef4444", "#7f1d1d"),
+            ):
+                y -= topo
+                desenho.ellipse((x - 5, y - 5, x + 5, y + 5), fill=preenchimento, outline=contorno)
+            for idx, linha in enumerate(legenda):
+                # Mesma linha de base do <text> do SVG; só desenha nas faixas que o texto toca.
+                base = height - 6 - 14 * (len(legenda) - 1 - idx)
+                if topo - 4 <= base <= topo + TILE_SIZE + 14:
+                    desenho.text((12, base - topo), linha, fill="#334155", font=fonte, anchor="ls")
+
+            # Sem dithering: mantém as áreas chapadas do mapa chapadas (comprime bem melhor).
+            dados = faixa.convert("RGB").quantize(palette=paleta, dither=Image.Dither.NONE).tobytes()
+            # Filtro 0 (nenhum) em cada linha: um byte de tipo antes dos índices. Os filtros Sub/Up
+            # comprimiram pior nas tiles de teste (já são imagens de paleta).
+            linhas = b"".join(b"\x00" + dados[i : i + width] for i in range(0, len(dados), width))
+            comprimido = compressor.compress(linhas)
+            if comprimido:
+                arquivo.write(_chunk_png(b"IDAT", comprimido))
+        arquivo.write(_chunk_png(b"IDAT", compressor.flush()))
+        arquivo.write(_chunk_png(b"IEND", b""))
+    return destino
@@ -0,0 +1,40 @@
+"""
+Montagem de mosaicos a partir das tiles locais ({z}/{x}/{y}.png), usada pelo png_trajeto (uma faixa por
+vez) e pelo scripts/plot_tiles.py (mosaico inteiro). Não importa o Django, para o script rodar sozinho.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+
+TILE_SIZE = 256
+
+
+def colar_tiles(
+    canvas,
+    tiles_dir: Path,
+    zoom: int,
+    tile_min_x: int,
+    tile_max_x: int,
+    tile_min_y: int,
+    tile_max_y: int,
+) -> list[Path]:
+    """
+    Cola em `canvas` (imagem RGBA do Pillow) as tiles do retângulo, com (tile_min_x, tile_min_y) no canto
+    superior esquerdo. Tiles ausentes ou corrompidas ficam com o fundo do canvas e voltam na lista.
+    """
+    from PIL import Image
+
+    faltando: list[Path] = []
+    for tile_x in range(tile_min_x, tile_max_x + 1):
+        for tile_y in range(tile_min_y, tile_max_y + 1):
+            tile_path = tiles_dir / str(zoom) / str(tile_x) / f"{tile_y}.png"
+            if not tile_path.exists():
+                faltando.append(tile_path)
+                continue
+            try:
+                with Image.open(tile_path) as tile:
+                    posicao = ((tile_x - tile_min_x) * TILE_SIZE, (tile_y - tile_min_y) * TILE_SIZE)
+                    canvas.paste(tile.convert("RGBA"), posicao)
+            except Exception:  # noqa: BLE001 - tile corrompida vira fundo.
+                faltando.append(tile_path)
+    return faltando
@@ -576,6 +576,28 @@ class RoadGraph:
                     heapq.heappush(open_set, (tentative + heuristic, neighbor))
         return [], 0.0
 
+    def distances_from(self, source_id: int, max_distance_m: float | None = None) -> dict[int, float]:
+        """
+        Dijkstra de um para muitos: distância pela malha de `source_id` até cada nó alcançável.
+        As arestas são bidirecionais, então o resultado também vale como busca reversa (de cada nó até a origem).
+        """
+        dist: dict[int, float] = {source_id: 0.0}
+        heap: list[tuple[float, int]] = [(0.0, source_id)]
+        while heap:
+            current_dist, current = heapq.heappop(heap)
+            if current_dist > dist.get(current, float("inf")):
+                continue
+            if max_distance_m is not None and current_dist > max_distance_m:
+                break
+            for neighbor, weight in self.edges.get(current, []):
+                tentative = current_dist + weight
+                if tentative < dist.get(neighbor, float("inf")):
+                    dist[neighbor] = tentative
+                    heapq.heappush(heap, (tentative, neighbor))
+        if max_distance_m is not None:
+            return {node: value for node, value in dist.items() if value <= max_distance_m}
+        return dist
+
 
 def _reconstruct_path(came_from: dict[int, int], current: int) -> list[int]:
     path = [current]
@@ -18,4 +18,9 @@ application = ProtocolTypeRouter(
         "websocket": AllowedHostsOriginValidator(JWTAuthMiddleware(URLRouter(websocket_urlpatterns))),
     }
 )
+
+# Threads do outbox (WebSocket e push); a do WebSocket também varre as ofertas expiradas.
+from corridas.outbox import iniciar_publicadores  # noqa: E402
+
+iniciar_publicadores()
 
@@ -17,6 +17,11 @@ from corridas.models import Corrida, LocalizacaoPing, Perfil, UserContato
 
 
 def _perfil_para_usuario(user: User) -> Perfil:
+    try:
+        # Já anexado pela autenticação (cache do principal) na maioria das requisições.
+        return user.perfil_app
+    except Perfil.DoesNotExist:
+        pass
     perfil, _ = Perfil.objects.get_or_create(
         user=user, defaults={"tipo": "passageiro", "nome": user.first_name, "plataforma": ""}
     )
@@ -2,6 +2,8 @@ from django.middleware.csrf import CsrfViewMiddleware
 from rest_framework.exceptions import PermissionDenied
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
+from corridas.principal import usuario_do_token
+
 
 class CSRFCheck(CsrfViewMiddleware):
     def __init__(self, get_response=None):
@@ -28,6 +30,9 @@ class CookieJWTAuthentication(JWTAuthentication):
         validated_token = self.get_validated_token(raw_token)
         return self.get_user(validated_token), validated_token
 
+    def get_user(self, validated_token):
+        return usuario_do_token(validated_token, super().get_user)
+
     def enforce_csrf(self, request):
         check = CSRFCheck()
         check.process_request(request)
@@ -0,0 +1,56 @@
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.redis import RedisCache
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+from corridas.breaker import Disjuntor
+
+
+class RedisCacheResiliente(RedisCache):
+    """
+    RedisCache que trata o Redis fora do ar como cache vazio: leituras viram miss e escritas são
+    descartadas, então quem usa o cache cai no banco em vez de falhar. Com o disjuntor aberto nem
+    tenta a conexão (sem pagar o timeout dos sockets a cada requisição).
+    """
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        self._disjuntor = Disjuntor("cache")
+
+    def _chamar(self, metodo, padrao, *args, **kwargs):
+        if not self._disjuntor.permitir():
+            return padrao
+        try:
+            resultado = metodo(*args, **kwargs)
+        except (RedisConnectionError, RedisTimeoutError):
+            self._disjuntor.falha()
+            return padrao
+        self._disjuntor.sucesso()
+        return resultado
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._chamar(super().add, False, key, value, timeout, version)
+
+    def get(self, key, default=None, version=None):
+        return self._chamar(super().get, default, key, default, version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._chamar(super().set, None, key, value, timeout, version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._chamar(super().touch, False, key, timeout, version)
+
+    def delete(self, key, version=None):
+        return self._chamar(super().delete, False, key, version)
+
+    def get_many(self, keys, version=None):
+        return self._chamar(super().get_many, {}, keys, version)
+
+    def has_key(self, key, version=None):
+        return self._chamar(super().has_key, False, key, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._chamar(super().set_many, list(data), data, timeout, version)
+
+    def delete_many(self, keys, version=None):
+        self._chamar(super().delete_many, None, keys, version)
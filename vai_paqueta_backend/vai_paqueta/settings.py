@@ -73,6 +73,11 @@ ASGI_APPLICATION = "vai_paqueta.asgi.application"
 
 REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0")
 USE_REDIS = os.environ.get("DJANGO_USE_REDIS", "0" if DEBUG else "1").lower() in ("1", "true", "yes")
+# Redis no caminho das requisições (cache, presença): timeout curto dos sockets e disjuntor que, depois
+# de DISJUNTOR_FALHAS falhas seguidas, deixa de tentar o Redis por DISJUNTOR_ABERTO_SECONDS.
+REDIS_TIMEOUT_SECONDS = float(os.environ.get("REDIS_TIMEOUT_SECONDS", "0.5"))
+DISJUNTOR_FALHAS = int(os.environ.get("DISJUNTOR_FALHAS", "3"))
+DISJUNTOR_ABERTO_SECONDS = float(os.environ.get("DISJUNTOR_ABERTO_SECONDS", "10"))
 if USE_REDIS:
     CHANNEL_LAYERS = {
         "default": {
@@ -85,14 +90,103 @@ else:
         "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
     }
 
+# Cache compartilhado entre processos (web, ASGI, Celery) quando há Redis; em dev, memória local.
+if USE_REDIS:
+    CACHES = {
+        "default": {
+            "BACKEND": "vai_paqueta.cache.RedisCacheResiliente",
+            "LOCATION": os.environ.get("DJANGO_CACHE_URL", REDIS_URL),
+            "OPTIONS": {"socket_connect_timeout": REDIS_TIMEOUT_SECONDS, "socket_timeout": REDIS_TIMEOUT_SECONDS},
+        }
+    }
+else:
+    CACHES = {
+        # Acima do padrão (300) para caber o estado por motorista (principal, pushes) sem descarte.
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "OPTIONS": {"MAX_ENTRIES": 10000}},
+    }
+# Validade das entradas do mapa motorista -> corrida ativa (corridas.active_rides).
+ACTIVE_RIDE_CACHE_SECONDS = int(os.environ.get("ACTIVE_RIDE_CACHE_SECONDS", "300"))
+# Fan-out da localização do motorista: no máximo N envios/s por corrida (0 desliga) e
+# envio imediato quando ele anda mais que LOCATION_FANOUT_MIN_MOVE_M desde o último envio.
+LOCATION_FANOUT_MAX_HZ = float(os.environ.get("LOCATION_FANOUT_MAX_HZ", "1.0"))
+LOCATION_FANOUT_MIN_MOVE_M = float(os.environ.get("LOCATION_FANOUT_MIN_MOVE_M", "30.0"))
+# Replay de eventos por corrida para retomar WebSockets (mensagem "resume").
+REPLAY_BUFFER_SIZE = int(os.environ.get("REPLAY_BUFFER_SIZE", "50"))
+REPLAY_TTL_SECONDS = int(os.environ.get("REPLAY_TTL_SECONDS", "3600"))
+# Registro de presença dos ecotaxistas (corridas.presence): sorted set no Redis ou memória local.
+PRESENCE_BACKEND = os.environ.get("PRESENCE_BACKEND", "redis" if USE_REDIS else "local").strip().lower()
+PRESENCE_REDIS_URL = os.environ.get("PRESENCE_REDIS_URL", REDIS_URL)
+# Sem ping nem conexão por esse tempo, o motorista deixa de contar como online.
+PRESENCE_TTL_SECONDS = int(os.environ.get("PRESENCE_TTL_SECONDS", "300"))
+# Máximo de grupos ride_<id> por conexão WebSocket; acima disso sai a assinatura mais antiga.
+WS_MAX_RIDE_SUBSCRIPTIONS = int(os.environ.get("WS_MAX_RIDE_SUBSCRIPTIONS", "5"))
+# Usuário + perfil autenticados em cache por user id (corridas.principal); invalidado ao gravar User/Perfil.
+PRINCIPAL_CACHE_SECONDS = int(os.environ.get("PRINCIPAL_CACHE_SECONDS", "60"))
+# Grade do mapa de motoristas próximos via WebSocket: lado da célula em graus (~1,1 km) e
+# máximo de células que uma conexão de passageiro assina ("subscribe_nearby").
+NEARBY_CELL_DEG = float(os.environ.get("NEARBY_CELL_DEG", "0.01"))
+WS_MAX_NEARBY_CELLS = int(os.environ.get("WS_MAX_NEARBY_CELLS", "49"))
+
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", REDIS_URL)
 CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", REDIS_URL)
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 
+# Despacho de corridas: "imediato" (guloso, a cada evento) ou "lote" (atribuição global a cada tick).
+DISPATCH_MODE = os.environ.get("DISPATCH_MODE", "imediato").strip().lower()
+DISPATCH_TICK_SECONDS = float(os.environ.get("DISPATCH_TICK_SECONDS", "2.0"))
+DISPATCH_BATCH_MAX_CORRIDAS = int(os.environ.get("DISPATCH_BATCH_MAX_CORRIDAS", "1000"))
+# Pontuação dos motoristas: "linha_reta" (haversine) ou "estrada" (distância pela malha de vias do app geo).
+DISPATCH_DISTANCE = os.environ.get("DISPATCH_DISTANCE", "linha_reta").strip().lower()
+# Quantidade de buscas um-para-muitos (uma por nó de origem) mantidas em cache.
+DISPATCH_ROAD_CACHE_SIZE = int(os.environ.get("DISPATCH_ROAD_CACHE_SIZE", "512"))
+# Intervalo da varredura que expira ofertas vencidas e tenta de novo o despacho das corridas sem motorista.
+RIDE_SWEEP_SECONDS = float(os.environ.get("RIDE_SWEEP_SECONDS", "5.0"))
+# Varredura dentro dos processos web (thread do outbox), para deploys sem Celery beat; desligue
+# (RIDE_SWEEP_NO_PROCESSO=0) quando o beat estiver rodando varrer_corridas_expiradas.
+RIDE_SWEEP_NO_PROCESSO = os.environ.get("RIDE_SWEEP_NO_PROCESSO", "1").lower() in ("1", "true", "yes")
+
+# Outbox de eventos de corrida (corridas.outbox): lote por publicação, tentativas com backoff,
+# reserva de cada lote e intervalo da publicação periódica (thread do processo e Celery beat).
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_MAX_TENTATIVAS = int(os.environ.get("OUTBOX_MAX_TENTATIVAS", "8"))
+OUTBOX_LEASE_SECONDS = float(os.environ.get("OUTBOX_LEASE_SECONDS", "30"))
+OUTBOX_DRAIN_SECONDS = float(os.environ.get("OUTBOX_DRAIN_SECONDS", "5.0"))
+OUTBOX_RETENCAO_HORAS = float(os.environ.get("OUTBOX_RETENCAO_HORAS", "24"))
+
+CELERY_BEAT_SCHEDULE = {
+    "varrer-corridas-expiradas": {
+        "task": "corridas.tasks.varrer_corridas_expiradas",
+        "schedule": RIDE_SWEEP_SECONDS,
+    },
+    "publicar-eventos-corrida": {
+        "task": "corridas.tasks.publicar_eventos_corrida",
+        "schedule": OUTBOX_DRAIN_SECONDS,
+    },
+}
+if DISPATCH_MODE == "lote":
+    CELERY_BEAT_SCHEDULE["despachar-corridas-em-lote"] = {
+        "task": "corridas.tasks.despachar_corridas_em_lote",
+        "schedule": DISPATCH_TICK_SECONDS,
+    }
+
 FIREBASE_SERVICE_ACCOUNT_PATH = os.environ.get("FIREBASE_SERVICE_ACCOUNT_PATH", "")
 FCM_ANDROID_CHANNEL_ID = os.environ.get("FCM_ANDROID_CHANNEL_ID", "vaipaqueta_corridas")
+# Envio de push: endpoint alternativo (servidor falso de testes), pool de envio, tentativas e backoff.
+FCM_ENDPOINT_URL = os.environ.get("FCM_ENDPOINT_URL", "")
+FCM_MAX_WORKERS = int(os.environ.get("FCM_MAX_WORKERS", "16"))
+FCM_MAX_TENTATIVAS = int(os.environ.get("FCM_MAX_TENTATIVAS", "3"))
+FCM_BACKOFF_SECONDS = float(os.environ.get("FCM_BACKOFF_SECONDS", "0.5"))
+FCM_BACKOFF_MAX_SECONDS = float(os.environ.get("FCM_BACKOFF_MAX_SECONDS", "10"))
+FCM_TIMEOUT_SECONDS = float(os.environ.get("FCM_TIMEOUT_SECONDS", "10"))
+# Push de "corrida sem motorista" só para quem foi visto até esse raio da origem (0 = todos os ecotaxistas).
+NOTIFY_SEM_MOTORISTAS_RAIO_KM = float(os.environ.get("NOTIFY_SEM_MOTORISTAS_RAIO_KM", "0"))
+# Pushes de corrida por motorista (corridas.push_limits): janela de coalescência (0 desliga; o resto vira
+# um resumo no fim dela) e balde de fichas (capacidade 0 desliga; uma ficha nova a cada N segundos).
+PUSH_JANELA_SECONDS = int(os.environ.get("PUSH_JANELA_SECONDS", "30"))
+PUSH_BALDE_CAPACIDADE = float(os.environ.get("PUSH_BALDE_CAPACIDADE", "3"))
+PUSH_BALDE_RECARGA_SECONDS = float(os.environ.get("PUSH_BALDE_RECARGA_SECONDS", "60"))
 
 DB_PATH = os.environ.get("DJANGO_DB_PATH")
 DATABASES = {
@@ -136,6 +230,10 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Listagens de corridas e pings são paginadas por cursor (page_size limitado a API_MAX_PAGE_SIZE).
+API_PAGE_SIZE = int(os.environ.get("API_PAGE_SIZE", "50"))
+API_MAX_PAGE_SIZE = int(os.environ.get("API_MAX_PAGE_SIZE", "200"))
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=15),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7),
@@ -166,6 +264,14 @@ ROADS_TRACE_DISTANCE = float(os.environ.get("ROADS_TRACE_DISTANCE", "25.0"))
 # Distância máxima entre vértices antes de gerar pontos extras na malha manual.
 ROADS_DENSIFY_MAX_SEGMENT_M = float(os.environ.get("ROADS_DENSIFY_MAX_SEGMENT_M", "15.0"))
 
+# Tiles de fundo dos SVGs de trajeto (relatorio_corridas e laboratório): quantas ficam em memória já em base64,
+# depósito opcional em disco de tiles pré-codificadas (z/x/y.b64) e modo "embed" (base64 no SVG) ou "href"
+# (URL da tile, base em TILE_HREF_BASE).
+TILE_CACHE_MAX_ITENS = int(os.environ.get("TILE_CACHE_MAX_ITENS", "512"))
+TILE_B64_DIR = os.environ.get("TILE_B64_DIR", "")
+TILE_SVG_MODO = os.environ.get("TILE_SVG_MODO", "embed").strip().lower()
+TILE_HREF_BASE = os.environ.get("TILE_HREF_BASE", "")
+
 # Caminho para o catálogo offline de endereços (usado no backend de geocodificação).
 ADDRESSES_JSON_PATH = os.environ.get(
     "ADDRESSES_JSON_PATH",
@@ -1,6 +1,4 @@
-import base64
 import json
-import math
 from pathlib import Path
 
 from django.conf import settings
@@ -11,6 +9,7 @@ from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 
 from corridas.models import Corrida, Perfil
 from geo import views as geo_views
+from geo.rendering import TileAssets, svg_trajeto
 
 
 def landing(request):
@@ -122,86 +121,8 @@ def relatorio_lab_svg(request):
 
 def _build_svg(route_points):
     tile_root = Path(settings.BASE_DIR) / "static" / "landing" / "assets" / "tiles"
-    tile_zoom = 16
-
-    def latlng_to_pixel(lat, lng, zoom):
-        lat = max(min(lat, 85.05112878), -85.05112878)
-        n = 2**zoom
-        x = (lng + 180.0) / 360.0
-        lat_rad = math.radians(lat)
-        y = (1 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2
-        return x * n * 256, y * n * 256
-
-    pixels = [latlng_to_pixel(lat, lng, tile_zoom) for lat, lng in route_points]
-    px_vals = [p[0] for p in pixels]
-    py_vals = [p[1] for p in pixels]
-    n_tiles = 2**tile_zoom
-    margin_tiles = 1
-    tile_min_x = max(0, int(math.floor(min(px_vals) / 256)) - margin_tiles)
-    tile_max_x = min(n_tiles - 1, int(math.floor(max(px_vals) / 256)) + margin_tiles)
-    tile_min_y = max(0, int(math.floor(min(py_vals) / 256)) - margin_tiles)
-    tile_max_y = min(n_tiles - 1, int(math.floor(max(py_vals) / 256)) + margin_tiles)
-
-    width = (tile_max_x - tile_min_x + 1) * 256
-    height = (tile_max_y - tile_min_y + 1) * 256
-    offset_x = tile_min_x * 256
-    offset_y = tile_min_y * 256
-
-    coords = [(px - offset_x, py - offset_y) for px, py in pixels]
-    path_data = " ".join(f"{x:.2f},{y:.2f}" for x, y in coords)
-
-    images_svg = []
-    if tile_root.exists():
-        for tile_x in range(tile_min_x, tile_max_x + 1):
-            for tile_y in range(tile_min_y, tile_max_y + 1):
-                tile_path = tile_root / str(tile_zoom) / str(tile_x) / f"{tile_y}.png"
-                if not tile_path.exists():
-                    continue
-                try:
-                    data = tile_path.read_bytes()
-                except OSError:
-                    continue
-                encoded = base64.b64encode(data).decode("ascii")
-                href = f"data:image/png;base64,{encoded}"
-                x = (tile_x - tile_min_x) * 256
-                y = (tile_y - tile_min_y) * 256
-                images_svg.append(
-                    f'<image href="{href}" x="{x}" y="{y}" width="256" height="256" preserveAspectRatio="none" />'
-                )
-
-    svg_parts = [
-        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">',
-        '<rect width="100%" height="100%" fill="#f8fafc" />',
-    ]
-    svg_parts.extend(images_svg)
-
-    _, roads, _ = geo_views._load_road_graph()
-    road_list = roads if isinstance(roads, list) else []
-    if road_list:
-        for road in road_list:
-            pts = road.get("points") or []
-            pts_px = []
-            for lat, lng in pts:
-                px, py = latlng_to_pixel(float(lat), float(lng), tile_zoom)
-                pts_px.append((px - offset_x, py - offset_y))
-            if len(pts_px) < 2:
-                continue
-            if not any(0 <= px <= width and 0 <= py <= height for px, py in pts_px):
-                continue
-            path = " ".join(f"{x:.2f},{y:.2f}" for x, y in pts_px)
-            color = road.get("color") or "#94a3b8"
-            svg_parts.append(
-                f'<polyline points="{path}" fill="none" stroke="{color}" stroke-width="1" stroke-linejoin="round" stroke-linecap="round" stroke-opacity="0.5" />'
-            )
-
-    svg_parts.append(
-        f'<polyline points="{path_data}" fill="none" stroke="#0f172a" stroke-width="2" stroke-linejoin="round" stroke-linecap="round" />'
-    )
-    svg_parts.append(
-        f'<circle cx="{coords[0][0]:.2f}" cy="{coords[0][1]:.2f}" r="5" fill="#22c55e" stroke="#14532d" />'
-    )
-    svg_parts.append(
-        f'<circle cx="{coords[-1][0]:.2f}" cy="{coords[-1][1]:.2f}" r="5" fill="#ef4444" stroke="#7f1d1d" />'
+    # No modo href o navegador do laboratório busca as tiles no static.
+    tiles = TileAssets.padrao(
+        tile_root if tile_root.exists() else None, href_base=f"{settings.STATIC_URL}landing/assets/tiles"
     )
-    svg_parts.append("</svg>")
-    return "\n".join(svg_parts)
+    return svg_trajeto(route_points, 16, tiles)
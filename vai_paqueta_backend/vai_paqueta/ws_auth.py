@@ -7,9 +7,10 @@ from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from django.contrib.auth.models import AnonymousUser
-from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 
+from .authentication import CookieJWTAuthentication
+
 
 def _parse_cookies(header_value: str) -> dict[str, str]:
     jar = cookies.SimpleCookie()
@@ -20,7 +21,8 @@ def _parse_cookies(header_value: str) -> dict[str, str]:
 class JWTAuthMiddleware(BaseMiddleware):
     def __init__(self, inner):
         super().__init__(inner)
-        self._jwt = JWTAuthentication()
+        # Mesma autenticação da API, inclusive o cache do principal.
+        self._jwt = CookieJWTAuthentication()
 
     async def __call__(self, scope, receive, send):
         scope["user"] = AnonymousUser()
@@ -5,3 +5,7 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'vai_paqueta.settings')
 
 application = get_wsgi_application()
 
+# Threads do outbox (WebSocket e push); a do WebSocket também varre as ofertas expiradas.
+from corridas.outbox import iniciar_publicadores  # noqa: E402
+
+iniciar_publicadores()